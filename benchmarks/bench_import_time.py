@@ -0,0 +1,91 @@
+#!/usr/local/bin/python3
+'''Benchmark the startup time of the command line tool
+
+Each command is run in a fresh python process several times, and the
+median wall time is reported. The script also checks that the heavy
+imaging packages are not loaded when the tool's modules are imported.
+It exits with a nonzero status if a command is slower than --max_seconds
+or if any heavy package was imported, so it can guard against regressions.
+
+Example:
+
+    python benchmarks/bench_import_time.py --repeats 5 --output import_times.json
+
+'''
+import os, sys, json, time, argparse, subprocess, statistics
+
+#Location of the tool's modules
+package_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'hbcd_qmri_postproc')
+
+#Packages that should only be imported by the processing stages that use them
+heavy_modules = ['ants', 'SimpleITK', 'matplotlib', 'pandas', 'scipy', 'nibabel']
+
+#Commands to time, keyed by name
+commands = {'help' : [sys.executable, os.path.join(package_dir, 'run.py'), '--help'],
+            'import_run' : [sys.executable, '-c', 'import run'],
+            'import_qmri_postproc' : [sys.executable, '-c', 'import qmri_postproc']}
+
+
+def time_command(command, repeats):
+    '''Run a command several times and return the wall time of each run'''
+
+    run_times = []
+    for i in range(repeats):
+        start_time = time.perf_counter()
+        subprocess.run(command, cwd = package_dir, stdout = subprocess.DEVNULL, check = True)
+        run_times.append(time.perf_counter() - start_time)
+
+    return run_times
+
+
+def find_heavy_imports():
+    '''Import the tool's modules in a fresh process and list any heavy packages that were loaded'''
+
+    check_code = ('import sys, run, qmri_postproc, scheduler; '
+                  'print(",".join([m for m in {} if m in sys.modules]))'.format(heavy_modules))
+    output = subprocess.run([sys.executable, '-c', check_code], cwd = package_dir,
+                            stdout = subprocess.PIPE, check = True, text = True).stdout.strip()
+    if output == '':
+        return []
+
+    return output.split(',')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of hbcd_qmri_postproc')
+    parser.add_argument('--repeats', help='number of times each command is run (default 5)', type=int, default=5)
+    parser.add_argument('--max_seconds', '--max-seconds', help='fail if the median time of any command is above this (default 1.0)', type=float, default=1.0)
+    parser.add_argument('--output', help='optional path to a json file where the results will be saved', type=str)
+    args = parser.parse_args()
+
+    results = {'python' : sys.version.split(' ')[0], 'commands' : {}}
+    failed = False
+    for temp_name, temp_command in commands.items():
+        temp_times = time_command(temp_command, args.repeats)
+        temp_median = statistics.median(temp_times)
+        results['commands'][temp_name] = {'median_seconds' : temp_median, 'times_seconds' : temp_times}
+        print('{:<24} median {:.3f} s  (min {:.3f} s, max {:.3f} s)'.format(temp_name, temp_median, min(temp_times), max(temp_times)))
+        if temp_median > args.max_seconds:
+            print('   FAIL: slower than {} s'.format(args.max_seconds))
+            failed = True
+
+    results['heavy_modules_imported'] = find_heavy_imports()
+    if len(results['heavy_modules_imported']):
+        print('FAIL: the following packages were imported at startup: {}'.format(', '.join(results['heavy_modules_imported'])))
+        failed = True
+    else:
+        print('No heavy packages imported at startup')
+
+    if type(args.output) != type(None):
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 5)
+
+    if failed:
+        sys.exit(1)
+
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+#!/usr/local/bin/python3
+'''Benchmark the processing stages of hbcd_qmri_postproc on synthetic phantoms
+
+For every requested phantom size (see phantoms.phantom_sizes) a synthetic
+dataset is made, and the tool is run on it (in a fresh process, as a user
+would run it) --repeats times. The end-to-end wall time of each run is
+measured, and the wall time, CPU time, and peak memory of each stage
+(registration, resampling, write_outputs, roi_stats, qc_plot, ...) are taken
+from the desc-StageTimings.json file written by the tool. The transform found
+by the registration is also compared to the known offset of the phantom's
+qMRI images.
+
+The results can be saved with --output and later passed to --baseline to
+check for regressions. The script exits with a nonzero status if the
+registration does not recover the known transform, or if any stage (or the
+end-to-end run) is slower than the baseline by more than --max_slowdown.
+
+Example:
+
+    python benchmarks/bench_pipeline.py --sizes small medium --repeats 3 --output before.json
+    (make changes)
+    python benchmarks/bench_pipeline.py --sizes small medium --repeats 3 --baseline before.json
+
+Arguments for the tool are passed as one string with --tool_args="--reg_profile fast".
+
+'''
+import os, sys, json, time, shutil, argparse, platform, statistics, subprocess, tempfile
+import numpy as np
+import phantoms
+
+#Location of the tool's modules
+package_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'hbcd_qmri_postproc')
+
+
+def run_pipeline(truth, output_directory, extra_args, groupings_path):
+    '''Run the tool on a phantom and return the end-to-end wall time and the stage timings'''
+
+    if os.path.exists(output_directory):
+        shutil.rmtree(output_directory)
+    command = [sys.executable, os.path.join(package_dir, 'run.py'), truth['bids_directory'], output_directory, 'participant',
+               truth['qmri_directory'], truth['bibsnet_directory'], '--no_checkpoints',
+               '--region_groupings_json', groupings_path] + extra_args
+    start_time = time.perf_counter()
+    subprocess.run(command, stdout = subprocess.DEVNULL, check = True)
+    wall_time = time.perf_counter() - start_time
+
+    anat_out_dir = os.path.join(output_directory, truth['subject_name'], truth['session_name'], 'anat')
+    with open(os.path.join(anat_out_dir, '{}_{}_desc-StageTimings.json'.format(truth['subject_name'], truth['session_name'])), 'r') as f:
+        stage_timings = json.load(f)
+
+    return wall_time, stage_timings
+
+
+def check_registration(truth, output_directory):
+    '''Compare the transform found by the tool to the phantom's known transform
+
+    The error is the distance (mm) between where the estimated and the
+    true transform move points on a grid covering the brain.
+
+    '''
+
+    import SimpleITK as sitk
+
+    anat_out_dir = os.path.join(output_directory, truth['subject_name'], truth['session_name'], 'anat')
+    transform_path = os.path.join(anat_out_dir, '{}_{}_from-QALAS-to-T2w_mode-image_xfm.txt'.format(truth['subject_name'], truth['session_name']))
+    transform = sitk.ReadTransform(transform_path)
+
+    #ITK transforms use LPS coordinates, while the phantom truth is in RAS
+    ras_to_lps = np.array([-1.0, -1.0, 1.0])
+    rotation = np.array(truth['anatomical_to_qmri_rotation'])
+    translation = np.array(truth['anatomical_to_qmri_translation_mm'])
+    errors = []
+    for temp_point in phantoms.get_brain_points():
+        temp_expected = (rotation @ temp_point + translation)*ras_to_lps
+        temp_estimated = np.array(transform.TransformPoint((temp_point*ras_to_lps).tolist()))
+        errors.append(np.linalg.norm(temp_estimated - temp_expected))
+
+    return float(np.mean(errors)), float(np.max(errors))
+
+
+def summarize_runs(wall_times, all_stage_timings):
+    '''Take the median of each measurement over the repeated runs'''
+
+    summary = {'end_to_end' : {'median_seconds' : statistics.median(wall_times), 'times_seconds' : wall_times},
+               'stages' : {}}
+    for temp_stage in all_stage_timings[0]['Stages'].keys():
+        temp_runs = [temp_timings['Stages'][temp_stage] for temp_timings in all_stage_timings]
+        temp_rss = [temp_run['Peak_RSS_MB'] for temp_run in temp_runs if type(temp_run['Peak_RSS_MB']) != type(None)]
+        summary['stages'][temp_stage] = {'median_seconds' : statistics.median([temp_run['Wall_Time_Seconds'] for temp_run in temp_runs]),
+                                         'times_seconds' : [temp_run['Wall_Time_Seconds'] for temp_run in temp_runs],
+                                         'median_cpu_seconds' : statistics.median([temp_run['CPU_Time_Seconds'] for temp_run in temp_runs]),
+                                         'peak_rss_mb' : max(temp_rss) if len(temp_rss) else None}
+
+    return summary
+
+
+def compare_to_baseline(results, baseline, max_slowdown, min_seconds):
+    '''List the measurements that are slower than in the baseline results'''
+
+    regressions = []
+    for temp_size, temp_result in results['sizes'].items():
+        if temp_size not in baseline['sizes']:
+            continue
+        temp_baseline = baseline['sizes'][temp_size]
+        temp_pairs = [('end_to_end', temp_result['end_to_end'], temp_baseline['end_to_end'])]
+        for temp_stage in temp_result['stages'].keys():
+            if temp_stage in temp_baseline['stages']:
+                temp_pairs.append((temp_stage, temp_result['stages'][temp_stage], temp_baseline['stages'][temp_stage]))
+        for temp_name, temp_new, temp_old in temp_pairs:
+            temp_difference = temp_new['median_seconds'] - temp_old['median_seconds']
+            if temp_difference > min_seconds and temp_new['median_seconds'] > temp_old['median_seconds']*(1 + max_slowdown):
+                regressions.append('{} {}: {:.3f} s (baseline {:.3f} s)'.format(temp_size, temp_name, temp_new['median_seconds'], temp_old['median_seconds']))
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the processing stages of hbcd_qmri_postproc on synthetic phantoms')
+    parser.add_argument('--sizes', nargs='+', help='phantom sizes to benchmark (default small)', type=str, choices=list(phantoms.phantom_sizes.keys()), default=['small'])
+    parser.add_argument('--repeats', help='number of times the tool is run on each phantom (default 3)', type=int, default=3)
+    parser.add_argument('--work_dir', '--work-dir', help='folder where phantoms and outputs are stored (default: a temporary folder that is deleted afterwards)', type=str)
+    parser.add_argument('--tool_args', '--tool-args', help='extra arguments passed to the tool, as one string (i.e. --tool_args="--reg_profile fast")', type=str, default='')
+    parser.add_argument('--output', help='optional path to a json file where the results will be saved', type=str)
+    parser.add_argument('--baseline', help='optional path to the results of an earlier run to compare against', type=str)
+    parser.add_argument('--max_slowdown', '--max-slowdown', help='fail if a median time is this fraction slower than the baseline (default 0.25)', type=float, default=0.25)
+    parser.add_argument('--min_seconds', '--min-seconds', help='ignore slowdowns smaller than this many seconds (default 0.1)', type=float, default=0.1)
+    parser.add_argument('--max_registration_error', '--max-registration-error', help='fail if the largest registration error (mm) is above this (default: one qMRI voxel)', type=float)
+    args = parser.parse_args()
+
+    if type(args.work_dir) == type(None):
+        work_dir = tempfile.mkdtemp(prefix = 'hbcd_qmri_postproc_bench_')
+    else:
+        work_dir = args.work_dir
+
+    #Use a fixed seed so that the registrations are repeatable
+    os.environ.setdefault('ANTS_RANDOM_SEED', '1')
+    extra_args = args.tool_args.split()
+
+    results = {'python' : sys.version.split(' ')[0],
+               'platform' : platform.platform(),
+               'cpu_count' : os.cpu_count(),
+               'tool_args' : args.tool_args,
+               'repeats' : args.repeats,
+               'sizes' : {}}
+    failed = False
+    try:
+        for temp_size in args.sizes:
+            temp_phantom_dir = os.path.join(work_dir, temp_size)
+            print('Making {} phantom'.format(temp_size))
+            temp_truth = phantoms.make_phantom_dataset(temp_phantom_dir, size = temp_size)
+            temp_groupings_path = os.path.join(temp_phantom_dir, 'groupings.json')
+            with open(temp_groupings_path, 'w') as f:
+                json.dump({'Cortex' : ['Left-Cerebral-Cortex', 'Right-Cerebral-Cortex'],
+                           'White-Matter' : ['Left-Cerebral-White-Matter', 'Right-Cerebral-White-Matter']}, f, indent = 5)
+
+            temp_output_dir = os.path.join(temp_phantom_dir, 'output')
+            temp_wall_times = []
+            temp_stage_timings = []
+            for i in range(args.repeats):
+                temp_wall_time, temp_timings = run_pipeline(temp_truth, temp_output_dir, extra_args, temp_groupings_path)
+                temp_wall_times.append(temp_wall_time)
+                temp_stage_timings.append(temp_timings)
+            temp_summary = summarize_runs(temp_wall_times, temp_stage_timings)
+
+            temp_max_error = args.max_registration_error
+            if type(temp_max_error) == type(None):
+                temp_max_error = temp_truth['qmri_voxel_size_mm']
+            temp_mean_error, temp_largest_error = check_registration(temp_truth, temp_output_dir)
+            temp_summary['registration'] = {'mean_error_mm' : temp_mean_error, 'max_error_mm' : temp_largest_error,
+                                            'threshold_mm' : temp_max_error, 'passed' : temp_largest_error <= temp_max_error}
+            temp_summary['anatomical_shape'] = temp_truth['anatomical_shape']
+            temp_summary['qmri_shape'] = temp_truth['qmri_shape']
+            results['sizes'][temp_size] = temp_summary
+
+            print('   {:<16} median {:.3f} s'.format('end_to_end', temp_summary['end_to_end']['median_seconds']))
+            for temp_stage, temp_stage_summary in temp_summary['stages'].items():
+                print('   {:<16} median {:.3f} s  (cpu {:.3f} s, peak rss {} MB)'.format(temp_stage, temp_stage_summary['median_seconds'],
+                                                                                        temp_stage_summary['median_cpu_seconds'],
+                                                                                        temp_stage_summary['peak_rss_mb']))
+            print('   Registration error: mean {:.3f} mm, max {:.3f} mm'.format(temp_mean_error, temp_largest_error))
+            if temp_summary['registration']['passed'] == False:
+                print('   FAIL: the registration did not recover the known transform (max error above {:.3f} mm)'.format(temp_max_error))
+                failed = True
+    finally:
+        if type(args.work_dir) == type(None):
+            shutil.rmtree(work_dir)
+
+    if type(args.baseline) != type(None):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.max_slowdown, args.min_seconds)
+        results['regressions'] = regressions
+        if len(regressions):
+            print('FAIL: the following are more than {:.0f}% slower than the baseline:'.format(args.max_slowdown*100))
+            for temp_regression in regressions:
+                print('   {}'.format(temp_regression))
+            failed = True
+        else:
+            print('No regressions compared to {}'.format(args.baseline))
+
+    if type(args.output) != type(None):
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 5)
+
+    if failed:
+        sys.exit(1)
+
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+#!/usr/local/bin/python3
+'''Generate synthetic datasets (phantoms) for benchmarking hbcd_qmri_postproc
+
+A phantom is a set of nested ellipsoids that are labelled like a FreeSurfer
+aseg segmentation (cortex, white matter, ventricles, thalamus, brainstem,
+cerebellum). From the labels the following are generated:
+
+    bids/      sub-<label>/ses-<label>/anat/*_T2w.nii.gz (+ json sidecar)
+    bibsnet/   sub-<label>/ses-<label>/anat/*_space-T2w_desc-aseg_dseg.nii.gz
+               sub-<label>/ses-<label>/anat/*_space-T2w_desc-brain_mask.nii.gz
+    qmri/      sub-<label>/ses-<label>/anat/*_acq-QALAS_{T1map,T2map,PDmap,T1w,T2w}.nii.gz
+               (+ json sidecars)
+
+The qMRI images have a different resolution than the anatomical images and
+the head is moved by a known rigid transform, which is saved (along with the
+rest of the phantom settings) to phantom_truth.json so that the registration
+can be checked. Nothing is downloaded, so phantoms can be made offline.
+
+Example:
+
+    python benchmarks/phantoms.py /tmp/phantom --size medium
+
+'''
+import os, json, argparse
+import numpy as np
+
+#Anatomical voxel size (mm) for each named phantom size. The field of view
+#is fixed, so smaller voxels make larger images (infant_highres is ~9.8 million
+#voxels, which is similar to a high resolution infant T2w image).
+phantom_sizes = {'tiny' : 3.2,
+                 'small' : 2.0,
+                 'medium' : 1.2,
+                 'infant_highres' : 0.8}
+
+#Field of view (mm) of the anatomical and qMRI images
+field_of_view = (160.0, 192.0, 160.0)
+
+#The qMRI voxels are this much larger than the anatomical voxels
+qmri_voxel_scale = 1.1
+
+#Default rigid offset of the qMRI images (rotations in degrees about x/y/z, translation in mm)
+default_rotation_degrees = (4.0, -3.0, 5.0)
+default_translation_mm = (4.0, -3.0, 2.0)
+
+#Ellipsoids (center and radii in mm) making up the phantom. Later entries
+#are drawn over earlier ones. Labels follow the FreeSurfer color table.
+phantom_regions = [(3, (-27.0, 0.0, 5.0), (28.0, 68.0, 48.0)),     #Left-Cerebral-Cortex
+                   (42, (27.0, 0.0, 5.0), (28.0, 68.0, 48.0)),     #Right-Cerebral-Cortex
+                   (2, (-24.0, 0.0, 6.0), (21.0, 60.0, 40.0)),     #Left-Cerebral-White-Matter
+                   (41, (24.0, 0.0, 6.0), (21.0, 60.0, 40.0)),     #Right-Cerebral-White-Matter
+                   (8, (-18.0, -50.0, -30.0), (17.0, 16.0, 12.0)), #Left-Cerebellum-Cortex
+                   (47, (18.0, -50.0, -30.0), (17.0, 16.0, 12.0)), #Right-Cerebellum-Cortex
+                   (16, (0.0, -25.0, -28.0), (8.0, 10.0, 20.0)),   #Brain-Stem
+                   (4, (-10.0, 2.0, 12.0), (5.0, 28.0, 9.0)),      #Left-Lateral-Ventricle
+                   (43, (10.0, 2.0, 12.0), (5.0, 28.0, 9.0)),      #Right-Lateral-Ventricle
+                   (10, (-10.0, -12.0, 0.0), (7.0, 10.0, 7.0)),    #Left-Thalamus
+                   (49, (10.0, -12.0, 0.0), (7.0, 10.0, 7.0))]     #Right-Thalamus
+
+#Tissue values for each label: T1 (ms), T2 (ms), PD (%), T1w and T2w intensities
+tissue_values = {0 : (0.0, 0.0, 0.0, 10.0, 10.0),
+                 3 : (1700.0, 95.0, 85.0, 600.0, 700.0),
+                 42 : (1700.0, 95.0, 85.0, 600.0, 700.0),
+                 2 : (2300.0, 120.0, 90.0, 450.0, 900.0),
+                 41 : (2300.0, 120.0, 90.0, 450.0, 900.0),
+                 8 : (1500.0, 85.0, 82.0, 650.0, 650.0),
+                 47 : (1500.0, 85.0, 82.0, 650.0, 650.0),
+                 16 : (1300.0, 80.0, 78.0, 700.0, 600.0),
+                 4 : (4200.0, 1800.0, 100.0, 150.0, 1600.0),
+                 43 : (4200.0, 1800.0, 100.0, 150.0, 1600.0),
+                 10 : (1400.0, 82.0, 80.0, 680.0, 620.0),
+                 49 : (1400.0, 82.0, 80.0, 680.0, 620.0)}
+
+
+def rotation_matrix(rotation_degrees):
+    '''Make a rotation matrix from rotations (in degrees) about the x, y, and z axes'''
+
+    ax, ay, az = np.deg2rad(rotation_degrees)
+    rx = np.array([[1, 0, 0], [0, np.cos(ax), -np.sin(ax)], [0, np.sin(ax), np.cos(ax)]])
+    ry = np.array([[np.cos(ay), 0, np.sin(ay)], [0, 1, 0], [-np.sin(ay), 0, np.cos(ay)]])
+    rz = np.array([[np.cos(az), -np.sin(az), 0], [np.sin(az), np.cos(az), 0], [0, 0, 1]])
+
+    return rz @ ry @ rx
+
+
+def make_affine(voxel_size):
+    '''Make the (RAS) affine and shape of an image covering the field of view, centered at 0'''
+
+    shape = tuple([int(round(temp_fov/voxel_size)) for temp_fov in field_of_view])
+    affine = np.diag([voxel_size, voxel_size, voxel_size, 1.0])
+    affine[:3,3] = -(np.array(shape) - 1)*voxel_size/2
+
+    return affine, shape
+
+
+def label_volume(affine, shape, rotation = np.eye(3), translation = np.zeros(3)):
+    '''Draw the phantom's labels on an image grid
+
+    The phantom is sampled at the point rotation @ x + translation for
+    every voxel center x, so the returned image shows the phantom moved
+    by the inverse of that transform. The image is drawn one slice at a
+    time to bound the memory used for large images.
+
+    '''
+
+    labels = np.zeros(shape, dtype = np.int16)
+    j, k = np.meshgrid(np.arange(shape[1]), np.arange(shape[2]), indexing = 'ij')
+    for i in range(shape[0]):
+        temp_voxels = np.stack([np.full(j.shape, i), j, k], axis = -1).reshape(-1, 3)
+        temp_points = temp_voxels @ affine[:3,:3].T + affine[:3,3]
+        temp_points = temp_points @ rotation.T + translation
+        temp_labels = np.zeros(temp_points.shape[0], dtype = np.int16)
+        for temp_label, temp_center, temp_radii in phantom_regions:
+            temp_dist = np.sum(((temp_points - np.array(temp_center))/np.array(temp_radii))**2, axis = 1)
+            temp_labels[temp_dist < 1] = temp_label
+        labels[i] = temp_labels.reshape(j.shape)
+
+    return labels
+
+
+def tissue_image(labels, tissue_index, noise_std, rng):
+    '''Make an image with the value of one tissue property for each label, plus Gaussian noise'''
+
+    lookup = np.zeros(max(tissue_values.keys()) + 1, dtype = np.float32)
+    for temp_label, temp_values in tissue_values.items():
+        lookup[temp_label] = temp_values[tissue_index]
+    image = lookup[labels]
+    if noise_std > 0:
+        image += rng.normal(0, noise_std, labels.shape).astype(np.float32)
+
+    return image
+
+
+def save_nifti(data, affine, path, sidecar = None):
+    '''Save a nifti image and (optionally) its json sidecar'''
+
+    import nibabel as nib
+
+    image = nib.Nifti1Image(data, affine)
+    image.set_qform(affine, code = 1)
+    image.set_sform(affine, code = 1)
+    nib.save(image, path)
+    if type(sidecar) != type(None):
+        with open(path.replace('.nii.gz', '.json'), 'w') as f:
+            json.dump(sidecar, f, indent = 5)
+
+    return
+
+
+def make_phantom_dataset(output_directory, size = 'small', voxel_size = None,
+                         subject_name = 'sub-01', session_name = 'ses-01',
+                         rotation_degrees = default_rotation_degrees,
+                         translation_mm = default_translation_mm,
+                         noise_fraction = 0.02, seed = 0):
+    '''Make a synthetic BIDS/BIBSNET/qMRI dataset with one session
+
+    Parameters
+    ----------
+    output_directory : str
+        folder where the bids, bibsnet, and qmri folders are made
+    size : str
+        one of the keys of phantom_sizes
+    voxel_size : float or None
+        anatomical voxel size (mm), overrides size if provided
+    subject_name : str
+        name of the subject (i.e. sub-01)
+    session_name : str
+        name of the session (i.e. ses-01)
+    rotation_degrees : tuple
+        rotation of the qMRI images about the x, y, and z axes
+    translation_mm : tuple
+        translation of the qMRI images
+    noise_fraction : float
+        standard deviation of the noise added to each image, as
+        a fraction of the image's largest tissue value
+    seed : int
+        seed for the noise
+
+    Returns
+    -------
+    truth : dict
+        the phantom settings, along with the paths of the
+        bids/bibsnet/qmri folders and the rigid transform that maps
+        (RAS) points in the anatomical images to the qMRI images
+
+    '''
+
+    if type(voxel_size) == type(None):
+        if size not in phantom_sizes.keys():
+            raise ValueError('Error: Phantom size must be one of {}, but {} was provided'.format(list(phantom_sizes.keys()), size))
+        voxel_size = phantom_sizes[size]
+    rng = np.random.default_rng(seed)
+    rotation = rotation_matrix(rotation_degrees)
+    translation = np.array(translation_mm, dtype = float)
+
+    directories = {}
+    for temp_tree in ['bids', 'bibsnet', 'qmri']:
+        directories[temp_tree] = os.path.join(output_directory, temp_tree)
+        os.makedirs(os.path.join(directories[temp_tree], subject_name, session_name, 'anat'), exist_ok = True)
+        with open(os.path.join(directories[temp_tree], 'dataset_description.json'), 'w') as f:
+            json.dump({'Name' : 'hbcd_qmri_postproc phantom ({})'.format(temp_tree), 'BIDSVersion' : '1.8.0',
+                       'DatasetType' : 'raw' if temp_tree == 'bids' else 'derivative'}, f, indent = 5)
+    prefix = '{}_{}'.format(subject_name, session_name)
+
+    #Anatomical (BIDS/BIBSNET) images
+    anat_affine, anat_shape = make_affine(voxel_size)
+    anat_labels = label_volume(anat_affine, anat_shape)
+    anat_dir = os.path.join(directories['bids'], subject_name, session_name, 'anat')
+    save_nifti(tissue_image(anat_labels, 4, noise_fraction*1600, rng), anat_affine,
+               os.path.join(anat_dir, '{}_run-01_T2w.nii.gz'.format(prefix)),
+               sidecar = {'Manufacturer' : 'Phantom', 'ManufacturersModelName' : 'Synthetic',
+                          'DeviceSerialNumber' : '0', 'AcquisitionDateTime' : '2000-01-01T00:00:00', 'Modality' : 'MR'})
+    bibsnet_dir = os.path.join(directories['bibsnet'], subject_name, session_name, 'anat')
+    save_nifti(anat_labels, anat_affine, os.path.join(bibsnet_dir, '{}_space-T2w_desc-aseg_dseg.nii.gz'.format(prefix)))
+    save_nifti((anat_labels > 0).astype(np.uint8), anat_affine, os.path.join(bibsnet_dir, '{}_space-T2w_desc-brain_mask.nii.gz'.format(prefix)))
+    del anat_labels
+
+    #qMRI images, which see the phantom at rotation @ x + translation
+    qmri_affine, qmri_shape = make_affine(voxel_size*qmri_voxel_scale)
+    qmri_labels = label_volume(qmri_affine, qmri_shape, rotation = rotation, translation = translation)
+    qmri_dir = os.path.join(directories['qmri'], subject_name, session_name, 'anat')
+    qmri_sidecar = {'Manufacturer' : 'Phantom', 'EchoTime' : 0.0023, 'RepetitionTime' : 0.0058}
+    for temp_index, temp_name, temp_max in [(0, 'T1map', 4200), (1, 'T2map', 1800), (2, 'PDmap', 100), (3, 'T1w', 700), (4, 'T2w', 1600)]:
+        temp_sidecar = dict(qmri_sidecar, SeriesDescription = 'QALAS_{}'.format(temp_name), ImageType = ['DERIVED', temp_name])
+        save_nifti(tissue_image(qmri_labels, temp_index, noise_fraction*temp_max, rng), qmri_affine,
+                   os.path.join(qmri_dir, '{}_acq-QALAS_{}.nii.gz'.format(prefix, temp_name)), sidecar = temp_sidecar)
+    del qmri_labels
+
+    truth = {'bids_directory' : directories['bids'],
+             'bibsnet_directory' : directories['bibsnet'],
+             'qmri_directory' : directories['qmri'],
+             'subject_name' : subject_name,
+             'session_name' : session_name,
+             'size' : size,
+             'anatomical_voxel_size_mm' : voxel_size,
+             'anatomical_shape' : list(anat_shape),
+             'qmri_voxel_size_mm' : voxel_size*qmri_voxel_scale,
+             'qmri_shape' : list(qmri_shape),
+             'rotation_degrees' : list(rotation_degrees),
+             'translation_mm' : list(translation_mm),
+             'anatomical_to_qmri_rotation' : rotation.T.tolist(),
+             'anatomical_to_qmri_translation_mm' : (-rotation.T @ translation).tolist(),
+             'noise_fraction' : noise_fraction,
+             'seed' : seed}
+    with open(os.path.join(output_directory, 'phantom_truth.json'), 'w') as f:
+        json.dump(truth, f, indent = 5)
+
+    return truth
+
+
+def get_brain_points(spacing = 10.0):
+    '''Get (RAS) points on a grid covering the phantom's brain, used to check registrations'''
+
+    points = []
+    for temp_x in np.arange(-50, 50.1, spacing):
+        for temp_y in np.arange(-65, 65.1, spacing):
+            for temp_z in np.arange(-40, 50.1, spacing):
+                temp_point = np.array([temp_x, temp_y, temp_z])
+                for temp_label, temp_center, temp_radii in phantom_regions:
+                    if np.sum(((temp_point - np.array(temp_center))/np.array(temp_radii))**2) < 1:
+                        points.append(temp_point)
+                        break
+
+    return np.array(points)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Make a synthetic dataset for benchmarking hbcd_qmri_postproc')
+    parser.add_argument('output_dir', help='folder where the bids, bibsnet, and qmri folders will be made', type=str)
+    parser.add_argument('--size', help='size of the phantom (default small)', type=str, choices=list(phantom_sizes.keys()), default='small')
+    parser.add_argument('--voxel_size', '--voxel-size', help='anatomical voxel size in mm (overrides --size)', type=float)
+    parser.add_argument('--rotation_degrees', '--rotation-degrees', nargs=3, help='rotation of the qMRI images about the x, y, and z axes', type=float, default=list(default_rotation_degrees))
+    parser.add_argument('--translation_mm', '--translation-mm', nargs=3, help='translation of the qMRI images', type=float, default=list(default_translation_mm))
+    parser.add_argument('--seed', help='seed for the image noise (default 0)', type=int, default=0)
+    args = parser.parse_args()
+
+    truth = make_phantom_dataset(args.output_dir, size = args.size, voxel_size = args.voxel_size,
+                                 rotation_degrees = args.rotation_degrees, translation_mm = args.translation_mm,
+                                 seed = args.seed)
+    print('Made phantom with anatomical shape {} and qMRI shape {} in {}'.format(truth['anatomical_shape'], truth['qmri_shape'], args.output_dir))
+
+    return
+
+
+if __name__ == '__main__':
+    main()
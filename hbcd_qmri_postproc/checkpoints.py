@@ -0,0 +1,372 @@
+#!/usr/local/bin/python3
+import os, json, hashlib, shutil, time
+
+#Name of the folder (within a session's output folder) where checkpoints are stored
+checkpoint_folder_name = '.checkpoints'
+
+#Name of the file that marks a checkpoint as complete
+checkpoint_metadata_name = 'checkpoint.json'
+
+#Name of the file (within a session's output folder) that marks the session's
+#outputs as complete. It is written after every output has been flushed.
+completion_marker_name = '.session_complete.json'
+
+#Hashes are remembered for the lifetime of the process so that
+#files used by more than one stage are only read once
+_file_hash_cache = {}
+
+
+def hash_file(file_path):
+    '''Calculate the sha256 hash of the contents of a file
+
+    Parameters
+    ----------
+    file_path : str
+        path to the file to be hashed
+
+    Returns
+    -------
+    file_hash : str
+        hexadecimal sha256 digest of the file contents
+
+    '''
+
+    file_stat = os.stat(file_path)
+    cache_key = (os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns)
+    if cache_key not in _file_hash_cache:
+        file_hash = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for temp_chunk in iter(lambda: f.read(1024*1024), b''):
+                file_hash.update(temp_chunk)
+        _file_hash_cache[cache_key] = file_hash.hexdigest()
+
+    return _file_hash_cache[cache_key]
+
+
+def remember_file_hash(file_path, file_hash):
+    '''Store the hash of a file that is already known (i.e. from the scratch cache) so it is not read again'''
+
+    file_stat = os.stat(file_path)
+    _file_hash_cache[(os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns)] = file_hash
+
+    return
+
+
+def compute_stage_key(stage_name, input_files = None, parameters = None, parent_keys = None):
+    '''Compute a key that identifies the inputs of a processing stage
+
+    Parameters
+    ----------
+    stage_name : str
+        name of the stage (i.e. registration)
+    input_files : dict or None
+        dictionary whose values are paths to files the stage reads.
+        The contents of the files (not their paths) enter the key.
+    parameters : dict or None
+        json serializable parameters that change the stage's outputs
+    parent_keys : list or None
+        keys of the stages whose outputs this stage depends on
+
+    Returns
+    -------
+    stage_key : str
+        hexadecimal sha256 digest of the stage inputs
+
+    '''
+
+    if type(input_files) == type(None):
+        input_files = {}
+    key_contents = {'stage' : stage_name,
+                    'input_files' : {},
+                    'parameters' : parameters,
+                    'parent_keys' : parent_keys}
+    for temp_input in input_files.keys():
+        key_contents['input_files'][temp_input] = hash_file(input_files[temp_input])
+    stage_key = hashlib.sha256(json.dumps(key_contents, sort_keys = True).encode('utf-8')).hexdigest()
+
+    return stage_key
+
+
+def get_checkpoint_root(output_directory, subject_name, session_name):
+    '''Get the folder where checkpoints for a session are stored'''
+
+    return os.path.join(output_directory, subject_name, session_name, checkpoint_folder_name)
+
+
+def get_stage_directory(checkpoint_root, stage_name, stage_key):
+    '''Get the folder for a specific stage/key combination
+
+    Parameters
+    ----------
+    checkpoint_root : str or None
+        folder where the session's checkpoints are stored. If
+        None, checkpointing is disabled and None is returned.
+    stage_name : str
+        name of the stage
+    stage_key : str
+        output of compute_stage_key
+
+    Returns
+    -------
+    stage_directory : str or None
+        path to the folder where the stage's outputs are stored
+
+    '''
+
+    if type(checkpoint_root) == type(None):
+        return None
+
+    return os.path.join(checkpoint_root, '{}-{}'.format(stage_name, stage_key[:24]))
+
+
+def load_checkpoint(stage_directory):
+    '''Load the metadata of a completed checkpoint
+
+    Parameters
+    ----------
+    stage_directory : str or None
+        output of get_stage_directory
+
+    Returns
+    -------
+    checkpoint_metadata : dict or None
+        the metadata that was stored when the checkpoint was
+        committed, or None if no completed checkpoint exists
+
+    '''
+
+    if type(stage_directory) == type(None):
+        return None
+    metadata_path = os.path.join(stage_directory, checkpoint_metadata_name)
+    if os.path.exists(metadata_path) == False:
+        return None
+    try:
+        with open(metadata_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def start_checkpoint(stage_directory):
+    '''Create a temporary folder where a stage's outputs can be written
+
+    Parameters
+    ----------
+    stage_directory : str or None
+        output of get_stage_directory
+
+    Returns
+    -------
+    temporary_directory : str or None
+        folder to write the stage outputs to before calling
+        commit_checkpoint, or None if checkpointing is disabled
+
+    '''
+
+    if type(stage_directory) == type(None):
+        return None
+    temporary_directory = '{}.tmp-{}'.format(stage_directory, os.getpid())
+    if os.path.exists(temporary_directory):
+        shutil.rmtree(temporary_directory)
+    os.makedirs(temporary_directory)
+
+    return temporary_directory
+
+
+def save_to_checkpoint(file_path, temporary_directory, checkpoint_file_name):
+    '''Store a copy of a stage output within a temporary checkpoint folder
+
+    A hard link is used when possible so that no data is duplicated.
+
+    Parameters
+    ----------
+    file_path : str
+        path to the file that should be stored
+    temporary_directory : str or None
+        output of start_checkpoint
+    checkpoint_file_name : str
+        name the file will have within the checkpoint
+
+    '''
+
+    if type(temporary_directory) == type(None):
+        return
+    checkpoint_file_path = os.path.join(temporary_directory, checkpoint_file_name)
+    try:
+        os.link(file_path, checkpoint_file_path)
+    except OSError:
+        shutil.copyfile(file_path, checkpoint_file_path)
+
+    return
+
+
+def restore_from_checkpoint(stage_directory, checkpoint_file_name, file_path):
+    '''Place a stored stage output at its expected output location
+
+    Parameters
+    ----------
+    stage_directory : str
+        output of get_stage_directory
+    checkpoint_file_name : str
+        name of the file within the checkpoint
+    file_path : str
+        path where the file should be placed
+
+    Returns
+    -------
+    file_path : str
+        the path where the file was placed
+
+    '''
+
+    if os.path.exists(os.path.dirname(file_path)) == False:
+        os.makedirs(os.path.dirname(file_path))
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    checkpoint_file_path = os.path.join(stage_directory, checkpoint_file_name)
+    try:
+        os.link(checkpoint_file_path, file_path)
+    except OSError:
+        shutil.copyfile(checkpoint_file_path, file_path)
+
+    return file_path
+
+
+def commit_checkpoint(temporary_directory, stage_directory, metadata = None):
+    '''Mark a checkpoint as complete and remove outdated checkpoints of the same stage
+
+    The temporary folder is renamed to the final stage folder, so a
+    checkpoint is either complete or absent even if processing is
+    interrupted while the stage outputs are being written.
+
+    Parameters
+    ----------
+    temporary_directory : str or None
+        output of start_checkpoint
+    stage_directory : str or None
+        output of get_stage_directory
+    metadata : dict or None
+        json serializable information to store with the checkpoint
+
+    '''
+
+    if type(temporary_directory) == type(None):
+        return
+    checkpoint_metadata = {'Stage_Directory' : os.path.basename(stage_directory),
+                           'Creation_Time' : time.strftime('%Y-%m-%dT%H:%M:%S')}
+    if type(metadata) != type(None):
+        checkpoint_metadata.update(metadata)
+    with open(os.path.join(temporary_directory, checkpoint_metadata_name), 'w') as f:
+        json.dump(checkpoint_metadata, f, indent = 5)
+
+    if os.path.exists(stage_directory):
+        shutil.rmtree(stage_directory)
+    os.rename(temporary_directory, stage_directory)
+
+    #Remove checkpoints from the same stage whose inputs have changed
+    checkpoint_root, stage_folder = os.path.split(stage_directory)
+    stage_prefix = stage_folder.rsplit('-', 1)[0] + '-'
+    for temp_folder in os.listdir(checkpoint_root):
+        if temp_folder.startswith(stage_prefix) and temp_folder != stage_folder and ('.tmp-' not in temp_folder):
+            shutil.rmtree(os.path.join(checkpoint_root, temp_folder), ignore_errors = True)
+
+    return
+
+
+def session_has_outputs(session_path):
+    '''Check whether a session output folder contains anything besides checkpoints'''
+
+    if os.path.exists(session_path) == False:
+        return False
+    for temp_entry in os.listdir(session_path):
+        if temp_entry != checkpoint_folder_name:
+            return True
+
+    return False
+
+
+def remove_session_outputs(session_path):
+    '''Remove the outputs of a session while keeping its checkpoints
+
+    Parameters
+    ----------
+    session_path : str
+        path to the session's output folder
+
+    '''
+
+    for temp_entry in os.listdir(session_path):
+        if temp_entry == checkpoint_folder_name:
+            continue
+        temp_path = os.path.join(session_path, temp_entry)
+        if os.path.isdir(temp_path) and not os.path.islink(temp_path):
+            shutil.rmtree(temp_path)
+        else:
+            os.remove(temp_path)
+
+    return
+
+
+def get_completion_marker_path(session_path):
+
+    return os.path.join(session_path, completion_marker_name)
+
+
+def session_is_complete(session_path):
+    '''Check whether a session output folder has a completion marker'''
+
+    return os.path.exists(get_completion_marker_path(session_path))
+
+
+def session_is_incomplete(session_path, ledger_record):
+    '''Check whether the outputs of a session were left by a run that failed or was interrupted
+
+    Outputs without a completion marker are incomplete. Sessions without
+    any run ledger record were processed before completion markers were
+    introduced, and are treated as complete.
+
+    Parameters
+    ----------
+    session_path : str
+        path to the session's output folder
+    ledger_record : dict or None
+        last run ledger record of the session's calc_qmri_stats job
+        (see run_ledger.RunLedger.load_latest)
+
+    '''
+
+    return type(ledger_record) != type(None) and session_is_complete(session_path) == False
+
+
+def write_completion_marker(session_path, info = None):
+    '''Mark the outputs of a session as complete
+
+    Parameters
+    ----------
+    session_path : str
+        path to the session's output folder
+    info : dict or None
+        json serializable information to store in the marker
+
+    '''
+
+    marker_contents = {'Completion_Time' : time.strftime('%Y-%m-%dT%H:%M:%S')}
+    if type(info) != type(None):
+        marker_contents.update(info)
+    marker_path = get_completion_marker_path(session_path)
+    temporary_path = '{}.tmp-{}'.format(marker_path, os.getpid())
+    with open(temporary_path, 'w') as f:
+        json.dump(marker_contents, f, indent = 5)
+    os.replace(temporary_path, marker_path)
+
+    return
+
+
+def remove_completion_marker(session_path):
+    '''Remove the completion marker of a session (i.e. before its outputs are remade)'''
+
+    marker_path = get_completion_marker_path(session_path)
+    if os.path.exists(marker_path):
+        os.remove(marker_path)
+
+    return
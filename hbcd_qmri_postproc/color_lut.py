@@ -0,0 +1,171 @@
+#!/usr/local/bin/python3
+import os
+import numpy as np
+
+#The copy of the FreeSurfer Color Look Up Table that ships with the tool
+default_color_lut_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'FreeSurferColorLUT.txt')
+
+#Parsed look up tables, keyed by path, along with the mtime of the file they were parsed from
+_color_lut_cache = {}
+
+
+class ColorLUT:
+    '''FreeSurfer Color Look Up Table with constant time lookups in both directions
+
+    Parameters
+    ----------
+    region_numbers : list
+        the label number of each entry in the table
+    region_names : list
+        the label name of each entry in the table
+    path : str or None
+        the file the table was loaded from
+
+    Attributes
+    ----------
+    region_numbers : numpy.ndarray
+        label numbers, in the order they appear in the file
+    region_names : numpy.ndarray
+        label names, in the order they appear in the file
+    name_to_number : dict
+        dictionary mapping each name to its label number
+    number_to_index : numpy.ndarray
+        dense array mapping each label number to its position in
+        region_numbers/region_names (or -1 if not in the table)
+
+    When a number or name appears more than once in the file, the
+    first entry is used.
+
+    '''
+
+    def __init__(self, region_numbers, region_names, path = None):
+
+        self.path = path
+        self.region_numbers = np.asarray(region_numbers, dtype = np.int64)
+        self.region_names = np.asarray(region_names, dtype = str)
+        self.name_to_number = {}
+        for temp_number, temp_name in zip(self.region_numbers.tolist(), self.region_names.tolist()):
+            if temp_name not in self.name_to_number:
+                self.name_to_number[temp_name] = temp_number
+        if self.region_numbers.shape[0]:
+            max_number = int(np.max(self.region_numbers))
+        else:
+            max_number = -1
+        self.number_to_index = np.full(max_number + 1, -1, dtype = np.int64)
+        for i in range(self.region_numbers.shape[0] - 1, -1, -1):
+            self.number_to_index[self.region_numbers[i]] = i
+
+    def get_name(self, region_number):
+        '''Get the name of a label number, or None if it isn't in the table'''
+
+        if region_number != np.round(region_number) or region_number < 0 or region_number >= self.number_to_index.shape[0]:
+            return None
+        temp_index = self.number_to_index[int(region_number)]
+        if temp_index < 0:
+            return None
+
+        return str(self.region_names[temp_index])
+
+    def get_number(self, region_name):
+        '''Get the label number of a name, or None if it isn't in the table'''
+
+        return self.name_to_number.get(region_name)
+
+
+def parse_color_lut_file(color_lut_path):
+    '''Parse the label numbers and names from a FreeSurfer Color Look Up Table text file
+
+    Parameters
+    ----------
+    color_lut_path : str
+        path to the text file
+
+    Returns
+    -------
+    region_numbers : list
+        label numbers
+    region_names : list
+        label names
+
+    '''
+
+    with open(color_lut_path, 'r') as f:
+        lines = f.readlines()
+    region_numbers = []
+    region_names = []
+    for temp_line in lines[4:-1]:
+        if temp_line[0] == '#' or temp_line[0] == ' ' or temp_line[0] == '\n':
+            continue
+        temp_split = temp_line.split()
+        region_numbers.append(int(temp_split[0]))
+        region_names.append(temp_split[1])
+
+    return region_numbers, region_names
+
+
+def load_color_lut(color_lut_path = None, use_serialized_cache = True):
+    '''Load a FreeSurfer Color Look Up Table, reusing previously parsed copies
+
+    The parsed table is kept in memory for the lifetime of the process.
+    If use_serialized_cache is True, the parsed table is also stored next
+    to the text file (<color_lut_path>.npz) when that location is writable,
+    so that other processes can skip parsing. Both copies are discarded
+    when the modification time of the text file changes.
+
+    Parameters
+    ----------
+    color_lut_path : str or None
+        path to the text file. If None, the copy of the
+        table that ships with the tool is used.
+    use_serialized_cache : bool
+        whether to read/write the serialized copy of the table
+
+    Returns
+    -------
+    color_lut : ColorLUT
+        the parsed look up table
+
+    '''
+
+    if type(color_lut_path) == type(None):
+        color_lut_path = default_color_lut_path
+    color_lut_path = os.path.abspath(color_lut_path)
+    source_mtime = os.stat(color_lut_path).st_mtime_ns
+    if color_lut_path in _color_lut_cache and _color_lut_cache[color_lut_path][0] == source_mtime:
+        return _color_lut_cache[color_lut_path][1]
+
+    serialized_path = color_lut_path + '.npz'
+    color_lut = None
+    if use_serialized_cache and os.path.exists(serialized_path):
+        try:
+            with np.load(serialized_path) as serialized_lut:
+                if int(serialized_lut['source_mtime']) == source_mtime:
+                    color_lut = ColorLUT(serialized_lut['region_numbers'], serialized_lut['region_names'], path = color_lut_path)
+        except (OSError, ValueError, KeyError):
+            color_lut = None
+    if type(color_lut) == type(None):
+        print('   Loading FreeSurfer Color Look Up Table')
+        region_numbers, region_names = parse_color_lut_file(color_lut_path)
+        color_lut = ColorLUT(region_numbers, region_names, path = color_lut_path)
+        if use_serialized_cache:
+            _write_serialized_color_lut(color_lut, serialized_path, source_mtime)
+
+    _color_lut_cache[color_lut_path] = (source_mtime, color_lut)
+
+    return color_lut
+
+
+def _write_serialized_color_lut(color_lut, serialized_path, source_mtime):
+    '''Store a parsed table next to its text file, if the location is writable'''
+
+    temporary_path = '{}.tmp-{}'.format(serialized_path, os.getpid())
+    try:
+        with open(temporary_path, 'wb') as f:
+            np.savez(f, region_numbers = color_lut.region_numbers, region_names = color_lut.region_names,
+                     source_mtime = np.int64(source_mtime))
+        os.replace(temporary_path, serialized_path)
+    except OSError:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+    return
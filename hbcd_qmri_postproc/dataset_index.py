@@ -0,0 +1,191 @@
+#!/usr/local/bin/python3
+import os, json
+
+#Version of the on-disk index format. Indexes with a different version are ignored.
+index_version = 1
+
+#Name of the index file that is stored in the output directory by default
+default_index_name = '.dataset_index.json'
+
+#File name endings of the inputs that are collected for each session, along with
+#the tree (bids, bibsnet, or qmri) the files are found in
+session_input_patterns = {'T1w_references' : ('bids', 'T1w.nii.gz'),
+                          'T2w_references' : ('bids', 'T2w.nii.gz'),
+                          'T1w_segmentations' : ('bibsnet', 'space-T1w_desc-aseg_dseg.nii.gz'),
+                          'T2w_segmentations' : ('bibsnet', 'space-T2w_desc-aseg_dseg.nii.gz'),
+                          'T1w_masks' : ('bibsnet', 'space-T1w_desc-brain_mask.nii.gz'),
+                          'T2w_masks' : ('bibsnet', 'space-T2w_desc-brain_mask.nii.gz'),
+                          'T1maps' : ('qmri', 'T1map.nii.gz'),
+                          'T2maps' : ('qmri', 'T2map.nii.gz'),
+                          'PDmaps' : ('qmri', 'PDmap.nii.gz'),
+                          'qMRI_T1w' : ('qmri', 'T1w.nii.gz'),
+                          'qMRI_T2w' : ('qmri', 'T2w.nii.gz')}
+
+
+class DatasetIndex:
+    '''Index of the folders in the BIDS, BIBSNET, and qMRI trees
+
+    Folders are listed with a single os.scandir call and the listing is
+    remembered along with the folder's modification time. If the index
+    is loaded from disk, a folder is only listed again when its
+    modification time has changed (i.e. when files were added, removed,
+    or renamed), so refreshing the index for an unchanged dataset only
+    requires one stat call per folder.
+
+    Parameters
+    ----------
+    bids_directory : str
+        Path to the study-level BIDS directory
+    bibsnet_directory : str
+        Path to the study-level BIBSNET directory
+    qmri_directory : str
+        Path to the study-level qMRI directory
+    index_path : str or None
+        Path to the file where the index is stored. If None,
+        the index is only kept in memory.
+
+    '''
+
+    def __init__(self, bids_directory, bibsnet_directory, qmri_directory, index_path = None):
+
+        #Paths are kept as provided (ending in a file seperator), so that
+        #the paths of the inputs start with the provided directories
+        self.roots = {'bids' : os.path.join(bids_directory, ''),
+                      'bibsnet' : os.path.join(bibsnet_directory, ''),
+                      'qmri' : os.path.join(qmri_directory, '')}
+        self.index_path = index_path
+        self.directories = {}
+        self.sessions = {}
+        self.num_listed = 0
+        if type(index_path) != type(None) and os.path.exists(index_path):
+            try:
+                with open(index_path, 'r') as f:
+                    saved_index = json.load(f)
+                if saved_index.get('version') == index_version and saved_index.get('roots') == self.roots:
+                    self.directories = saved_index['directories']
+                    self.sessions = saved_index['sessions']
+            except (OSError, ValueError, KeyError):
+                self.directories = {}
+                self.sessions = {}
+
+    def list_directory(self, directory):
+        '''List the entries of a folder, reusing the stored listing if the folder is unchanged
+
+        Parameters
+        ----------
+        directory : str
+            path to the folder
+
+        Returns
+        -------
+        entries : dict or None
+            dictionary whose keys are the names of the (non-hidden) entries
+            and whose values are True for folders, or None if the folder
+            does not exist
+
+        '''
+
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            self.directories.pop(directory, None)
+            return None
+        if directory in self.directories and self.directories[directory]['mtime_ns'] == mtime_ns:
+            return self.directories[directory]['entries']
+
+        entries = {}
+        try:
+            with os.scandir(directory) as it:
+                for temp_entry in it:
+                    if temp_entry.name.startswith('.'):
+                        continue
+                    entries[temp_entry.name] = temp_entry.is_dir()
+        except NotADirectoryError:
+            return None
+        self.directories[directory] = {'mtime_ns' : mtime_ns, 'entries' : entries}
+        self.num_listed += 1
+
+        return entries
+
+    def get_subjects(self):
+        '''Get the sorted names of the subject folders (sub-*) in the BIDS directory'''
+
+        entries = self.list_directory(self.roots['bids'])
+        if type(entries) == type(None):
+            return []
+
+        return sorted([temp_name for temp_name in entries.keys() if temp_name.startswith('sub-') and entries[temp_name]])
+
+    def get_sessions(self, subject_name):
+        '''Get the sorted names of a subject's session folders (ses*) in the BIDS directory'''
+
+        entries = self.list_directory(os.path.join(self.roots['bids'], subject_name))
+        if type(entries) == type(None):
+            return []
+
+        return sorted([temp_name for temp_name in entries.keys() if temp_name.startswith('ses') and entries[temp_name]])
+
+    def session_exists(self, tree, subject_name, session_name):
+        '''Check whether a session folder exists within one of the trees (bids, bibsnet, or qmri)'''
+
+        return type(self.list_directory(os.path.join(self.roots[tree], subject_name, session_name))) != type(None)
+
+    def get_session_inputs(self, subject_name, session_name):
+        '''Find the inputs of a session
+
+        Only the session's own anat folder is searched in
+        each tree.
+
+        Parameters
+        ----------
+        subject_name : str
+            Name of the subject (i.e. sub-01)
+        session_name : str
+            Name of the session (i.e. ses-01)
+
+        Returns
+        -------
+        session_inputs : dict
+            dictionary with a sorted list of paths for every
+            key in session_input_patterns
+
+        '''
+
+        anat_entries = {}
+        for temp_tree in self.roots.keys():
+            temp_anat_dir = os.path.join(self.roots[temp_tree], subject_name, session_name, 'anat')
+            temp_entries = self.list_directory(temp_anat_dir)
+            if type(temp_entries) == type(None):
+                temp_entries = {}
+            anat_entries[temp_tree] = (temp_anat_dir, sorted(temp_entries.keys()))
+
+        session_inputs = {}
+        for temp_key in session_input_patterns.keys():
+            temp_tree, temp_ending = session_input_patterns[temp_key]
+            temp_anat_dir, temp_names = anat_entries[temp_tree]
+            session_inputs[temp_key] = [os.path.join(temp_anat_dir, temp_name) for temp_name in temp_names if temp_name.endswith(temp_ending)]
+        self.sessions[os.path.join(subject_name, session_name)] = session_inputs
+
+        return session_inputs
+
+    def save(self):
+        '''Store the index (and the inputs of every session that was looked up) on disk'''
+
+        if type(self.index_path) == type(None):
+            return
+        saved_index = {'version' : index_version,
+                       'roots' : self.roots,
+                       'directories' : self.directories,
+                       'sessions' : self.sessions}
+        temporary_path = '{}.tmp-{}'.format(self.index_path, os.getpid())
+        try:
+            if os.path.exists(os.path.dirname(self.index_path)) == False:
+                os.makedirs(os.path.dirname(self.index_path))
+            with open(temporary_path, 'w') as f:
+                json.dump(saved_index, f)
+            os.replace(temporary_path, self.index_path)
+        except OSError:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+        return
@@ -0,0 +1,427 @@
+#!/usr/local/bin/python3
+import os, json
+import numpy as np
+import quantile_sketch
+import checkpoints
+import run_ledger
+
+#Folder (within the output directory) where the group level tables are saved
+group_directory_name = 'group'
+
+#Name of the file that records which session outputs are already in the tables
+manifest_name = '.group_manifest.json'
+
+#Version of the manifest format. Manifests with a different version are ignored.
+manifest_version = 1
+
+#Formats the group level tables can be saved in, along with their file extension
+table_formats = {'parquet' : '.parquet', 'feather' : '.feather'}
+
+#Fields from the scalarstats json files that are added as columns by default
+default_metadata_fields = ['Voxel_Correlation_Within_Mask', 'Registration_Profile',
+                           'Manufacturer', 'ManufacturersModelName', 'AcquisitionDateTime']
+
+#Columns that identify the session each row came from
+session_columns = ['participant_id', 'session_id', 'Anatomical_Reference_Modality']
+
+
+def check_table_format(table_format):
+    '''Check that a table format is supported and that pyarrow (which writes the tables) is installed'''
+
+    if table_format not in table_formats.keys():
+        raise ValueError('Error: Group table format must be one of {}, but {} was provided'.format(list(table_formats.keys()), table_format))
+    try:
+        import pyarrow
+    except ImportError:
+        raise ValueError('Error: The pyarrow package is required to make {} group tables. It can be installed with "pip install pyarrow".'.format(table_format))
+
+    return
+
+
+def find_session_directories(output_directory, report_incomplete = True):
+    '''Find the output folder of every processed session
+
+    Sessions are found at <output_directory>/sub-*/ses*/anat, or at
+    <output_directory>/sub-*/anat for subjects without session folders
+    (which are given an empty session name). Sessions whose outputs were
+    left incomplete by a run that failed or was interrupted (see
+    checkpoints.session_is_incomplete) are skipped, and are
+    listed if report_incomplete is True.
+
+    Returns
+    -------
+    session_directories : list
+        list of (subject, session, anat folder) tuples
+
+    '''
+
+    ledger_records = run_ledger.RunLedger(os.path.join(output_directory, run_ledger.default_ledger_name)).load_latest()
+    session_directories = []
+    for temp_subject in sorted(os.listdir(output_directory)):
+        temp_subject_dir = os.path.join(output_directory, temp_subject)
+        if temp_subject.startswith('sub-') == False or os.path.isdir(temp_subject_dir) == False:
+            continue
+        for temp_session in [''] + sorted(os.listdir(temp_subject_dir)):
+            temp_anat_dir = os.path.join(temp_subject_dir, temp_session, 'anat')
+            if temp_session != '' and temp_session.startswith('ses') == False:
+                continue
+            if os.path.isdir(temp_anat_dir) == False:
+                continue
+            temp_ledger_record = ledger_records.get((temp_subject, temp_session, 'calc_qmri_stats'))
+            if checkpoints.session_is_incomplete(os.path.join(temp_subject_dir, temp_session), temp_ledger_record):
+                if report_incomplete:
+                    print('   Skipping incomplete outputs (left by a run that failed or was interrupted): {}, {}'.format(temp_subject, temp_session))
+                continue
+            session_directories.append((temp_subject, temp_session, temp_anat_dir))
+
+    return session_directories
+
+
+def find_scalarstats_files(output_directory):
+    '''Find the scalarstats tsv files of every processed session
+
+    Parameters
+    ----------
+    output_directory : str
+        Path to the study-level directory where output was saved
+
+    Returns
+    -------
+    scalarstats_files : dict
+        dictionary whose keys are the grouping names (i.e. AsegROIs, or the
+        name of a --region_groupings_json file) and whose values are dictionaries
+        mapping (subject, session) to the path of the session's tsv file
+
+    '''
+
+    scalarstats_files = {}
+    for temp_subject, temp_session, temp_anat_dir in find_session_directories(output_directory):
+        temp_prefix = '{}_{}_desc-'.format(temp_subject, temp_session)
+        for temp_file in sorted(os.listdir(temp_anat_dir)):
+            if temp_file.startswith(temp_prefix) and temp_file.endswith('_scalarstats.tsv'):
+                temp_grouping = temp_file[len(temp_prefix):-len('_scalarstats.tsv')]
+                scalarstats_files.setdefault(temp_grouping, {})[(temp_subject, temp_session)] = os.path.join(temp_anat_dir, temp_file)
+
+    return scalarstats_files
+
+
+def get_file_signature(tsv_path):
+    '''Get the modification times and sizes of a scalarstats tsv file and its json sidecar'''
+
+    signature = []
+    for temp_path in [tsv_path, tsv_path.replace('.tsv', '.json')]:
+        try:
+            temp_stat = os.stat(temp_path)
+            signature += [temp_stat.st_mtime_ns, temp_stat.st_size]
+        except OSError:
+            signature += [None, None]
+
+    return signature
+
+
+def load_session_table(tsv_path, subject_name, session_name, metadata_fields):
+    '''Load one session's scalarstats tsv and add the session and metadata columns'''
+
+    import pandas as pd
+
+    session_table = pd.read_csv(tsv_path, sep = '\t')
+    json_path = tsv_path.replace('.tsv', '.json')
+    metadata = {}
+    if os.path.exists(json_path):
+        with open(json_path, 'r') as f:
+            metadata = json.load(f)
+
+    session_values = {'participant_id' : subject_name,
+                      'session_id' : session_name,
+                      'Anatomical_Reference_Modality' : metadata.get('Anatomical_Reference_Modality')}
+    for temp_field in metadata_fields:
+        temp_value = metadata.get(temp_field)
+        #Lists/dictionaries are stored as json strings so every column has one type
+        if type(temp_value) in [list, dict]:
+            temp_value = json.dumps(temp_value)
+        session_values[temp_field] = temp_value
+    for i, temp_column in enumerate(session_values.keys()):
+        session_table.insert(i, temp_column, session_values[temp_column])
+
+    return session_table
+
+
+def read_table(table_path, table_format):
+    '''Read a group level table'''
+
+    import pandas as pd
+
+    if table_format == 'parquet':
+        return pd.read_parquet(table_path)
+    else:
+        return pd.read_feather(table_path)
+
+
+def write_table(table, table_path, table_format):
+    '''Write a group level table, replacing any existing table in one step'''
+
+    temporary_path = '{}.tmp-{}'.format(table_path, os.getpid())
+    table = table.reset_index(drop = True)
+    if table_format == 'parquet':
+        table.to_parquet(temporary_path, index = False)
+    else:
+        table.to_feather(temporary_path)
+    os.replace(temporary_path, table_path)
+
+    return
+
+
+def aggregate_scalarstats(output_directory, table_format = 'parquet',
+                          metadata_fields = default_metadata_fields,
+                          dry_run = False):
+    '''Combine the scalarstats of every processed session into one table per grouping
+
+    One table is made for the aseg regions (desc-AsegROIs_scalarstats) and
+    for each custom grouping of regions, with one row per region and session.
+    The tables are saved to <output_directory>/group/. A manifest of the
+    modification times/sizes of the session files that are in the tables is
+    kept along with them, so that later calls only read the tsv/json files of
+    sessions that were added or changed (and drop sessions that were removed).
+
+    Parameters
+    ----------
+    output_directory : str
+        Path to the study-level directory where output was saved
+    table_format : str
+        'parquet' or 'feather'
+    metadata_fields : list
+        fields of the scalarstats json files to add as columns
+    dry_run : bool
+        if True, the number of sessions that would be added, updated, or
+        removed is reported but nothing is written
+
+    Returns
+    -------
+    summary : dict
+        dictionary with the number of added/updated, removed, and unchanged
+        sessions (and the path of the table) for each grouping
+
+    '''
+
+    import pandas as pd
+
+    check_table_format(table_format)
+    group_directory = os.path.join(output_directory, group_directory_name)
+    manifest_path = os.path.join(group_directory, manifest_name)
+    manifest = {'version' : manifest_version, 'format' : table_format, 'metadata_fields' : list(metadata_fields), 'tables' : {}}
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r') as f:
+                saved_manifest = json.load(f)
+            #A change of format or columns requires the tables to be rebuilt
+            if (saved_manifest.get('version') == manifest_version and saved_manifest.get('format') == table_format
+                and saved_manifest.get('metadata_fields') == list(metadata_fields)):
+                manifest['tables'] = saved_manifest['tables']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    summary = {}
+    scalarstats_files = find_scalarstats_files(output_directory)
+    for temp_grouping in sorted(set(scalarstats_files.keys()) | set(manifest['tables'].keys())):
+        table_path = os.path.join(group_directory, 'desc-{}_scalarstats{}'.format(temp_grouping, table_formats[table_format]))
+        session_files = scalarstats_files.get(temp_grouping, {})
+        previous_signatures = manifest['tables'].get(temp_grouping, {})
+        if os.path.exists(table_path) == False:
+            previous_signatures = {}
+
+        current_signatures = {}
+        changed_sessions = []
+        for (temp_subject, temp_session), temp_path in session_files.items():
+            temp_key = '{}/{}'.format(temp_subject, temp_session)
+            current_signatures[temp_key] = get_file_signature(temp_path)
+            if previous_signatures.get(temp_key) != current_signatures[temp_key]:
+                changed_sessions.append((temp_subject, temp_session))
+        removed_sessions = [temp_key for temp_key in previous_signatures.keys() if temp_key not in current_signatures]
+        summary[temp_grouping] = {'table' : table_path,
+                                  'updated' : len(changed_sessions),
+                                  'removed' : len(removed_sessions),
+                                  'unchanged' : len(current_signatures) - len(changed_sessions)}
+        if dry_run or (len(changed_sessions) + len(removed_sessions) == 0):
+            continue
+
+        #Keep the rows of unchanged sessions, and only read the files of changed sessions
+        tables = []
+        if len(previous_signatures):
+            existing_table = read_table(table_path, table_format)
+            session_keys = existing_table['participant_id'] + '/' + existing_table['session_id']
+            stale_keys = set(removed_sessions) | set(['{}/{}'.format(temp_subject, temp_session) for temp_subject, temp_session in changed_sessions])
+            tables.append(existing_table[session_keys.isin(stale_keys) == False])
+        for temp_subject, temp_session in changed_sessions:
+            tables.append(load_session_table(session_files[(temp_subject, temp_session)], temp_subject, temp_session, metadata_fields))
+
+        if os.path.exists(group_directory) == False:
+            os.makedirs(group_directory)
+        if len(current_signatures) == 0:
+            if os.path.exists(table_path):
+                os.remove(table_path)
+            manifest['tables'].pop(temp_grouping, None)
+        else:
+            group_table = pd.concat(tables, ignore_index = True)
+            group_table = group_table.sort_values(['participant_id', 'session_id'], kind = 'stable')
+            write_table(group_table, table_path, table_format)
+            manifest['tables'][temp_grouping] = current_signatures
+
+        #Save the manifest after every table so an interrupted run loses little work
+        temporary_path = '{}.tmp-{}'.format(manifest_path, os.getpid())
+        with open(temporary_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temporary_path, manifest_path)
+
+    return summary
+
+
+def find_quantile_sketch_files(output_directory):
+    '''Find the quantile sketch (desc-AsegROIs_quantiles.npz) files of every processed session
+
+    Returns
+    -------
+    sketch_files : dict
+        dictionary mapping (subject, session) to the path of the session's sketch file
+
+    '''
+
+    sketch_files = {}
+    #Incomplete sessions were already listed when the scalarstats tables were made
+    for temp_subject, temp_session, temp_anat_dir in find_session_directories(output_directory, report_incomplete = False):
+        temp_path = os.path.join(temp_anat_dir, '{}_{}_desc-AsegROIs_quantiles.npz'.format(temp_subject, temp_session))
+        if os.path.exists(temp_path):
+            sketch_files[(temp_subject, temp_session)] = temp_path
+
+    return sketch_files
+
+
+def derive_session_stats(sketches, stat_names, compiled_groupings = None):
+    '''Derive statistics for the aseg regions and any groupings from one session's quantile sketches
+
+    Parameters
+    ----------
+    sketches : dict
+        output of quantile_sketch.load_sketches
+    stat_names : list
+        statistics to derive (see quantile_sketch.check_stat_names)
+    compiled_groupings : dict or None
+        output of roi_groupings.compile_roi_groupings
+
+    Returns
+    -------
+    derived_tables : dict
+        dictionary whose keys are AsegROIs and the name of each grouping
+        file, and whose values are pandas DataFrames with one row per
+        region (Region_Name, Voxel_Count, <map>_<statistic>, ...)
+
+    '''
+
+    import pandas as pd
+
+    map_names = sketches['maps'].tolist()
+    region_sets = {'AsegROIs' : {'Region_Name' : sketches['region_names'].tolist(),
+                                 'Voxel_Count' : sketches['voxel_counts'],
+                                 'sketches' : {temp_map : (sketches[temp_map + '_moments'], sketches[temp_map + '_quantiles']) for temp_map in map_names}}}
+
+    #Combine the sketches of the labels that make up each group
+    if type(compiled_groupings) != type(None):
+        label_to_groups = compiled_groupings['label_to_groups']
+        labels = sketches['labels']
+        in_table = (labels >= 0) & (labels < label_to_groups.shape[0])
+        membership = np.zeros((labels.shape[0], label_to_groups.shape[1]), dtype = bool)
+        membership[in_table] = label_to_groups[labels[in_table]]
+        for temp_grouping_file in compiled_groupings['grouping_files']:
+            start, stop = temp_grouping_file['columns']
+            temp_region_set = {'Region_Name' : compiled_groupings['group_names'][start:stop], 'Voxel_Count' : [],
+                               'sketches' : {temp_map : ([], []) for temp_map in map_names}}
+            for i in range(start, stop):
+                for temp_map in map_names:
+                    temp_count, temp_moments, temp_quantiles = quantile_sketch.merge_sketches(sketches['voxel_counts'][membership[:, i]],
+                                                                                              sketches[temp_map + '_moments'][membership[:, i]],
+                                                                                              sketches[temp_map + '_quantiles'][membership[:, i]])
+                    temp_region_set['sketches'][temp_map][0].append(temp_moments)
+                    temp_region_set['sketches'][temp_map][1].append(temp_quantiles)
+                temp_region_set['Voxel_Count'].append(temp_count)
+            region_sets[temp_grouping_file['name']] = temp_region_set
+
+    derived_tables = {}
+    for temp_name, temp_region_set in region_sets.items():
+        temp_columns = {'Region_Name' : temp_region_set['Region_Name'],
+                        'Voxel_Count' : np.asarray(temp_region_set['Voxel_Count'], dtype = np.int64)}
+        for temp_map in map_names:
+            temp_moments, temp_quantiles = temp_region_set['sketches'][temp_map]
+            temp_moments = np.asarray(temp_moments, dtype = np.float64).reshape(-1, 4)
+            temp_quantiles = np.asarray(temp_quantiles, dtype = np.float64).reshape(-1, quantile_sketch.quantile_levels.shape[0])
+            temp_stats = quantile_sketch.calc_derived_stats(temp_columns['Voxel_Count'], temp_moments, temp_quantiles, stat_names)
+            for temp_stat in stat_names:
+                temp_columns[temp_map + '_' + temp_stat] = temp_stats[temp_stat]
+        derived_tables[temp_name] = pd.DataFrame(temp_columns)
+
+    return derived_tables
+
+
+def derive_group_stats(output_directory, stat_names, table_format = 'parquet',
+                       compiled_groupings = None, dry_run = False):
+    '''Derive statistics for every processed session from the quantile sketches saved during processing
+
+    Statistics that were not calculated during processing (i.e. IQR, other
+    percentiles, trimmed means, or the mode) are derived from each session's
+    desc-AsegROIs_quantiles.npz file, without loading any images. One table is
+    made for the aseg regions and for each grouping, with one row per region
+    and session, and saved to <output_directory>/group/desc-<grouping>_derivedstats.
+    Groupings don't need to be the ones used during processing. Statistics of
+    groups with more than one label are derived from the combined sketches of
+    their labels, so quantile based statistics of groups are close to, but not
+    always exactly equal to, those calculated from the voxels.
+
+    Parameters
+    ----------
+    output_directory : str
+        Path to the study-level directory where output was saved
+    stat_names : list
+        statistics to derive (see quantile_sketch.check_stat_names)
+    table_format : str
+        'parquet' or 'feather'
+    compiled_groupings : dict or None
+        output of roi_groupings.compile_roi_groupings
+    dry_run : bool
+        if True, the number of sessions is reported but nothing is written
+
+    Returns
+    -------
+    summary : dict
+        dictionary with the number of sessions (and the path of
+        the table) for each grouping
+
+    '''
+
+    import pandas as pd
+
+    check_table_format(table_format)
+    quantile_sketch.check_stat_names(stat_names)
+    group_directory = os.path.join(output_directory, group_directory_name)
+    sketch_files = find_quantile_sketch_files(output_directory)
+    grouping_names = ['AsegROIs']
+    if type(compiled_groupings) != type(None):
+        grouping_names += [temp_grouping_file['name'] for temp_grouping_file in compiled_groupings['grouping_files']]
+    summary = {}
+    for temp_grouping in grouping_names:
+        summary[temp_grouping] = {'table' : os.path.join(group_directory, 'desc-{}_derivedstats{}'.format(temp_grouping, table_formats[table_format])),
+                                  'sessions' : len(sketch_files)}
+    if dry_run or len(sketch_files) == 0:
+        return summary
+
+    tables = {temp_grouping : [] for temp_grouping in grouping_names}
+    for (temp_subject, temp_session), temp_path in sketch_files.items():
+        derived_tables = derive_session_stats(quantile_sketch.load_sketches(temp_path), stat_names, compiled_groupings = compiled_groupings)
+        for temp_grouping, temp_table in derived_tables.items():
+            temp_table.insert(0, 'participant_id', temp_subject)
+            temp_table.insert(1, 'session_id', temp_session)
+            tables[temp_grouping].append(temp_table)
+
+    if os.path.exists(group_directory) == False:
+        os.makedirs(group_directory)
+    for temp_grouping in grouping_names:
+        write_table(pd.concat(tables[temp_grouping], ignore_index = True), summary[temp_grouping]['table'], table_format)
+
+    return summary
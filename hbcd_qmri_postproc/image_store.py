@@ -0,0 +1,176 @@
+#!/usr/local/bin/python3
+import numpy as np
+
+
+def read_image(image_path, scratch_cache = None):
+    '''Read an image from disk
+
+    This is the single function used to read images during session
+    processing, so that every consumer of an image shares the same
+    copy in memory (see SessionImageStore).
+
+    Parameters
+    ----------
+    image_path : str
+        path to a nifti image
+    scratch_cache : scratch_cache.ScratchCache or None
+        if provided, the image is read from its decompressed
+        copy in the scratch cache
+
+    Returns
+    -------
+    image : ants.ANTsImage
+        the loaded image
+
+    '''
+
+    import ants
+
+    if type(scratch_cache) != type(None):
+        with scratch_cache.open_local_copy(image_path) as local_path:
+            return ants.image_read(local_path)
+
+    return ants.image_read(image_path)
+
+
+def image_from_array(array, affine):
+    '''Make an image from an array and its voxel to world affine
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+        the image values
+    affine : numpy.ndarray
+        4x4 affine that maps voxel indices to (RAS) world coordinates,
+        as used by nifti images (i.e. nibabel's img.affine)
+
+    Returns
+    -------
+    image : ants.ANTsImage
+        image with the origin, spacing, and direction (in ITK's
+        LPS convention) described by the affine
+
+    '''
+
+    import ants
+
+    affine = np.asarray(affine, dtype = np.float64)
+    spacing = np.linalg.norm(affine[:3,:3], axis = 0)
+    ras_to_lps = np.array([-1.0, -1.0, 1.0])
+    direction = (affine[:3,:3]/spacing)*ras_to_lps[:,None]
+    origin = affine[:3,3]*ras_to_lps
+
+    return ants.from_numpy(np.asarray(array, dtype = np.float32), origin = origin.tolist(),
+                           spacing = spacing.tolist(), direction = direction)
+
+
+def to_image(image):
+    '''Get an ANTs image from an ANTs image, a path to an image, or an (array, affine) pair'''
+
+    if type(image) == str:
+        return read_image(image)
+    if type(image) in [tuple, list]:
+        return image_from_array(image[0], image[1])
+
+    return image
+
+
+class SessionImageStore:
+    '''Load-once store for the images used while processing a session
+
+    Each image is registered along with the names of the processing
+    stages that need it. The image is read from disk the first time it
+    is requested and then served from memory to every later consumer.
+    When the last stage that needs an image is finished, the store drops
+    its reference to the image so that the memory can be reclaimed.
+
+    Parameters
+    ----------
+    reader : callable or None
+        function that takes a path and returns an image. Defaults
+        to read_image.
+    scratch_cache : scratch_cache.ScratchCache or None
+        if provided (and no reader is given), images are read from
+        their decompressed copies in the scratch cache
+
+    '''
+
+    def __init__(self, reader = None, scratch_cache = None):
+
+        if type(reader) == type(None):
+            reader = lambda image_path : read_image(image_path, scratch_cache = scratch_cache)
+        self.reader = reader
+        self.paths = {}
+        self.images = {}
+        self.remaining_stages = {}
+
+    def add(self, key, path = None, image = None, stages = None):
+        '''Register an image with the store
+
+        Parameters
+        ----------
+        key : str
+            name used to request the image
+        path : str or None
+            path the image will be read from when first requested
+        image : object or None
+            an image that is already in memory
+        stages : list or None
+            names of the stages that need the image. If None,
+            the image is kept until it is released.
+
+        '''
+
+        if type(path) == type(None) and type(image) == type(None):
+            raise ValueError('Error: Either a path or an image must be provided for {}'.format(key))
+        self.paths[key] = path
+        if type(image) != type(None):
+            self.images[key] = image
+        elif key in self.images:
+            del self.images[key]
+        if type(stages) == type(None):
+            self.remaining_stages[key] = None
+        else:
+            self.remaining_stages[key] = set(stages)
+
+        return
+
+    def get(self, key):
+        '''Get an image, reading it from disk only on first request'''
+
+        if key not in self.images:
+            if key not in self.paths or type(self.paths[key]) == type(None):
+                raise ValueError('Error: No image named {} is available in the session image store'.format(key))
+            self.images[key] = self.reader(self.paths[key])
+
+        return self.images[key]
+
+    def finish_stage(self, stage):
+        '''Drop every image that is not needed by any remaining stage
+
+        Parameters
+        ----------
+        stage : str
+            name of the stage that was completed
+
+        '''
+
+        for temp_key in list(self.remaining_stages.keys()):
+            temp_stages = self.remaining_stages[temp_key]
+            if type(temp_stages) == type(None):
+                continue
+            temp_stages.discard(stage)
+            if len(temp_stages) == 0:
+                self.release(temp_key)
+
+        return
+
+    def release(self, key):
+        '''Remove an image from the store'''
+
+        if key in self.images:
+            del self.images[key]
+        self.paths.pop(key, None)
+        self.remaining_stages.pop(key, None)
+
+        return
@@ -0,0 +1,113 @@
+#!/usr/local/bin/python3
+import numpy as np
+
+#Radius (in voxels) of the dilation applied to the brain mask before registration
+registration_mask_dilation_radius = 35
+
+
+def keep_largest_component(mask_arr):
+    '''Remove everything but the largest connected component of a mask
+
+    The size of every component is found with a single
+    histogram (bincount) of the component labels.
+
+    Parameters
+    ----------
+    mask_arr : numpy.ndarray
+        mask array. Values are rounded before finding
+        components and nonzero values are foreground.
+
+    Returns
+    -------
+    new_mask_arr : numpy.ndarray
+        array with ones in the largest component and zeros
+        elsewhere. If there are multiple components with the
+        largest size, the first one is kept.
+
+    '''
+
+    from scipy import ndimage
+
+    labels, nb = ndimage.label(np.round(mask_arr))
+    label_sizes = np.bincount(labels.ravel(), minlength = nb + 1)
+    label_sizes[0] = 0
+    largest_label = np.argmax(label_sizes)
+    new_mask_arr = np.zeros(mask_arr.shape, dtype = np.float32)
+    new_mask_arr[labels == largest_label] = 1
+
+    return new_mask_arr
+
+
+def dilate_mask(mask_arr, radius):
+    '''Dilate a mask with a ball shaped structuring element
+
+    Instead of sliding a structuring element over the whole image,
+    the Euclidean distance from every voxel to the mask is calculated
+    (which is linear in the number of voxels) and thresholded. Only
+    the bounding box of the mask, padded by the radius, is processed
+    since no voxel outside of it can be reached by the dilation.
+    The result matches ANTs' binary dilation with a ball of the same
+    radius (in voxels).
+
+    Parameters
+    ----------
+    mask_arr : numpy.ndarray
+        mask array where values > 0.5 are foreground
+    radius : int
+        radius of the ball in voxels
+
+    Returns
+    -------
+    dilated_mask_arr : numpy.ndarray
+        boolean array with the dilated mask
+
+    '''
+
+    from scipy import ndimage
+
+    foreground = mask_arr > 0.5
+    dilated_mask_arr = np.zeros(mask_arr.shape, dtype = bool)
+    foreground_inds = np.nonzero(foreground)
+    if foreground_inds[0].shape[0] == 0:
+        return dilated_mask_arr
+
+    crop = []
+    for i in range(mask_arr.ndim):
+        temp_min = max(int(np.min(foreground_inds[i])) - radius - 1, 0)
+        temp_max = min(int(np.max(foreground_inds[i])) + radius + 2, mask_arr.shape[i])
+        crop.append(slice(temp_min, temp_max))
+    crop = tuple(crop)
+
+    #Squared distances between voxel centers are integers, so this threshold
+    #includes every voxel within radius + 0.5 of the mask (i.e. ITK's ball)
+    distances = ndimage.distance_transform_edt(foreground[crop] == False)
+    dilated_mask_arr[crop] = distances <= (radius + 0.5)
+
+    return dilated_mask_arr
+
+
+def prepare_registration_mask(mask_image, dilation_radius = registration_mask_dilation_radius):
+    '''Make the mask used to constrain the registration from a brain mask
+
+    Extra clusters are removed from the mask, and the largest
+    cluster is then dilated so that the registration can use
+    the contrast at the edge of the brain.
+
+    Parameters
+    ----------
+    mask_image : ants.ANTsImage
+        brain mask
+    dilation_radius : int
+        radius (in voxels) of the dilation
+
+    Returns
+    -------
+    registration_mask : ants.ANTsImage
+        the dilated mask
+
+    '''
+
+    adjusted_mask_arr = keep_largest_component(mask_image.numpy())
+    dilated_mask_arr = dilate_mask(adjusted_mask_arr, dilation_radius)
+
+    return mask_image.new_image_like(dilated_mask_arr.astype(np.float32))
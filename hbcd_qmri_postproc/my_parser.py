@@ -7,7 +7,7 @@ def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("bids_dir", help="The path to the BIDS directory for your study (this is the same for all subjects)", type=str)
     parser.add_argument("output_dir", help="The path to the folder where outputs will be stored (this is the same for all subjects)", type=str)
-    parser.add_argument("analysis_level", help="Should always be participant", type=str)
+    parser.add_argument("analysis_level", help="Either participant (to process sessions) or group (to combine the scalarstats files of all processed sessions into one table per grouping, see --group_format)", type=str)
     parser.add_argument("qmri_deriv_dir", help="The path to the folder where the qMRI Relaxometry Maps are stored (this is the same for all subjects)", type=str)
     parser.add_argument("bibsnet_deriv_dir", help="The path to the folder where the BIBSNET/CABINET segmentations are stored (this is the same for all subjects)", type=str)
 
@@ -15,10 +15,40 @@ def build_parser():
     parser.add_argument('--participant_label', '--participant-label', help="The name/label of the subject to be processed (i.e. sub-01 or 01)", type=str)
     parser.add_argument('--session_id', '--session-id', help="OPTIONAL: the name of a specific session to be processed (i.e. ses-01)", type=str)
     parser.add_argument('--overwrite_existing', help='OPTIONAL: if flag is activated, the tool will delete the session folder where outputs are to be stored before processing if said folder already exists.', action='store_true')
-    parser.add_argument('--skip_existing', help='OPTIONAL: if flag is activated, the tool will skip processing for a session if the session folder where outputs are to be stored already exists.', action='store_true')
+    parser.add_argument('--skip_existing', help='OPTIONAL: if flag is activated, the tool will skip processing for a session if the session folder where outputs are to be stored already exists. Session folders left incomplete by a run that failed or was interrupted (outputs without a .session_complete.json marker) are processed again (keeping checkpoints).', action='store_true')
+    parser.add_argument('--retry_failed', '--retry-failed', help='OPTIONAL: if flag is activated, only the sessions whose last run (according to the .run_ledger.jsonl file in the output directory) failed or was interrupted are processed. Their existing outputs are removed first (keeping checkpoints unless --no_checkpoints is used).', action='store_true')
+    parser.add_argument('--stats_only', '--stats-only', help='OPTIONAL: if flag is activated, no registration or resampling is performed. Instead, the scalarstats tsv/json files of sessions that were already processed are regenerated from the existing registered segmentation (space-<sequence>_desc-aseg_dseg) and the native qMRI maps. This is useful for adding new --region_groupings_json files to a processed cohort. Sessions without existing outputs are skipped, and --skip_existing/--overwrite_existing are ignored.', action='store_true')
+    parser.add_argument('--adaptive_registration', '--adaptive-registration', help='OPTIONAL: if flag is activated, the alignment given by the image headers (the qMRI and anatomical images usually come from the same scan session) is scored first, then a quick low resolution rigid registration, using the voxel correlation within the brain mask. The full registration (set by --ants_reg_type/--reg_profile) is only run if neither reaches --adaptive_reg_threshold. The steps taken and their scores are stored in the desc-AsegROIs_scalarstats.json file.', action='store_true')
+    parser.add_argument('--adaptive_reg_threshold', '--adaptive-reg-threshold', help='OPTIONAL: with --adaptive_registration, the voxel correlation within the brain mask that the header alignment or quick rigid registration needs to reach to be used (default 0.85). The Voxel_Correlation_Within_Mask values of previously processed sessions can be used to choose it.', type=float, default=0.85)
+    parser.add_argument('--no_checkpoints', '--no-checkpoints', help='OPTIONAL: if flag is activated, the registration, registered maps, and registered segmentation will not be stored as checkpoints (in a .checkpoints folder within the session output folder) or reused from previous runs. When this flag is combined with --overwrite_existing, the entire session folder (including checkpoints) is deleted.', action='store_true')
+    parser.add_argument('--defer_qc', '--defer-qc', help='OPTIONAL: if flag is activated, the desc-RegistrationQCAid.png figure is not made while processing a session (the desc-RegistrationQCAid.json file is still written). The figures can then be made for many sessions at once with --qc_only.', action='store_true')
+    parser.add_argument('--qc_only', '--qc-only', help='OPTIONAL: if flag is activated, no processing is performed. Instead, the desc-RegistrationQCAid.png figure is made for every session that was already processed but does not yet have one (i.e. sessions processed with --defer_qc). Existing figures are only remade if --overwrite_existing is also used. This can be combined with --n_jobs to make figures for many sessions in parallel.', action='store_true')
+    parser.add_argument('--qc_dpi', '--qc-dpi', help='OPTIONAL: the resolution (dots per inch) of the desc-RegistrationQCAid.png figure (default 400).', type=int, default=400)
+    parser.add_argument('--dry_run', '--dry-run', help='OPTIONAL: if flag is activated, nothing is processed or deleted. Instead, the sessions that would be processed (or skipped, and why) are listed. The preflight checks (see --preflight) are also run, which only read image headers, so it completes quickly even for large datasets.', action='store_true')
+    parser.add_argument('--preflight', help='OPTIONAL: before any session is processed, the inputs of every session are checked (reading only image headers and json sidecars) for problems that would make processing fail, such as a missing brain mask or map json sidecar, several anatomical references, unreadable or non-3D images, or qMRI maps whose shape differs from the qMRI image used for registration. Problems with the --region_groupings_json files or the color look up table are also reported. Every problem is printed and saved to preflight_report.json in the output directory. With skip (default), the sessions with problems are skipped (and reported as failed at the end of the run) while the others are processed. With strict, no session is processed if any problem is found. Use off to disable the checks.', type=str, choices=['skip', 'strict', 'off'], default='skip')
+    parser.add_argument('--preflight_labels', '--preflight-labels', help='OPTIONAL: if flag is activated, the preflight checks also read the voxels of each segmentation to check that all of its labels are in the FreeSurfer Color LUT.', action='store_true')
+    parser.add_argument('--work_queue', '--work-queue', help='OPTIONAL: process sessions through a work queue kept in the provided folder (default <output_dir>/.work_queue if the flag is used without a value), which must be on a filesystem shared by all workers. Any number of copies of the tool (i.e. the tasks of a SLURM array job on different nodes) can then be started with the same arguments: each session is claimed by exactly one worker, sessions of workers that die are reclaimed once their lease expires, and finished sessions are recorded so they are skipped by all later workers. Incomplete outputs (without a .session_complete.json marker), or existing outputs with --overwrite_existing, are replaced (keeping checkpoints) by the worker that claims the session. --overwrite_existing has no effect on sessions already recorded as finished in the queue; to reprocess those, use a new queue folder.', type=str, nargs='?', const='')
+    parser.add_argument('--lease_seconds', '--lease-seconds', help='OPTIONAL: with --work_queue, the number of seconds after which a claim that has not been renewed is considered to belong to a dead worker and can be reclaimed (default 600). Claims are renewed every lease_seconds/10 seconds while a session is processed.', type=float, default=600)
+    parser.add_argument('--dataset_index', '--dataset-index', help='OPTIONAL: the path to the file where the index of the input folders is cached (default <output_dir>/.dataset_index.json). Folders whose modification time has not changed since the index was saved are not listed again, which reduces the load on network filesystems for large datasets.', type=str)
+    parser.add_argument('--low_memory', '--low-memory', help='OPTIONAL: if flag is activated, the qMRI maps and registered segmentation are not copied into separate arrays for the ROI statistics. Instead only the bounding box of the segmentation labels is copied (as float32), which lowers the peak memory of each session (especially for high resolution images). The statistics are identical to those of the default mode. The peak memory of each session is printed and saved to desc-StageTimings.json, which can be used to choose --mem_per_job_gb.', action='store_true')
+    parser.add_argument('--scratch_dir', '--scratch-dir', help='OPTIONAL: a folder (ideally on node-local disk, i.e. $TMPDIR) where decompressed copies of the input images are cached. Inputs are then only read from the shared filesystem and decompressed once, and are reused by later sessions, reruns (i.e. --stats_only or --qc_only), and other workers on the same node that use the same folder. Copies are keyed by their contents, so changed inputs are never served from the cache.', type=str)
+    parser.add_argument('--scratch_max_gb', '--scratch-max-gb', help='OPTIONAL: the size limit (in GB) of the --scratch_dir cache. When the cache grows above the limit, the least recently used copies are removed (default 50).', type=float, default=50)
+    parser.add_argument('--write_threads', '--write-threads', help='OPTIONAL: the number of background threads (per session) that write the outputs (compressed nifti, tsv, json, png, and checkpoint files) while processing of the session continues (default 1). Use 0 to write each output before moving on. A session is only reported as done once all of its outputs have been written.', type=int, default=1)
+    parser.add_argument('--profile', help='OPTIONAL: in addition to the wall time, CPU time, and peak memory of each processing stage (which are always saved to desc-StageTimings.json), capture a cProfile profile (cprofile, saved as .prof files in a profiling folder within the session output folder) or the python memory allocations (tracemalloc, saved in desc-StageTimings.json) for each stage. Using --profile without a value selects cprofile. Profiling slows processing down.', type=str, nargs='?', const='cprofile', choices=['cprofile', 'tracemalloc'])
+    parser.add_argument('--stage_timings_in_json', '--stage-timings-in-json', help='OPTIONAL: if flag is activated, the wall time, CPU time, and peak memory of each processing stage are also stored (as Stage_Timings) in the desc-AsegROIs_scalarstats.json file.', action='store_true')
+    parser.add_argument('--group_format', '--group-format', help='OPTIONAL: the file format of the tables made at the group analysis level, parquet (default) or feather. Both require the pyarrow package.', type=str, choices=['parquet', 'feather'], default='parquet')
+    parser.add_argument('--group_metadata_fields', '--group-metadata-fields', nargs='+', help='OPTIONAL: the fields of the scalarstats json files that are added as columns to the group level tables (default: Voxel_Correlation_Within_Mask Registration_Profile Manufacturer ManufacturersModelName AcquisitionDateTime).', type=str, default=['Voxel_Correlation_Within_Mask', 'Registration_Profile', 'Manufacturer', 'ManufacturersModelName', 'AcquisitionDateTime'])
+    parser.add_argument('--derive_stats', '--derive-stats', nargs='+', help='OPTIONAL: at the group analysis level, derive the listed statistics for every processed session from the desc-AsegROIs_quantiles.npz files saved during processing, without loading any images. Options are Mean, Std, Median, Min, Max, IQR, Mode, Skewness, Kurtosis, <p>-percentile (i.e. 25-percentile), and TrimmedMean-<p> (i.e. TrimmedMean-10). Tables are made for the aseg regions and for each --region_groupings_json file (which do not need to be the ones used during processing), and saved as desc-<grouping>_derivedstats files in <output_dir>/group/.', type=str)
     parser.add_argument('--region_groupings_json', nargs='+', help='OPTIONAL: the path to a json file containing region groupings for which to calculate statistics. Multiple files can be provided, resulting in multiple output csv files.', type=str)
+    parser.add_argument('--color_lut_path', '--color-lut-path', help='OPTIONAL: the path to a FreeSurfer Color Look Up Table (with the same formatting as FreeSurferColorLUT.txt) used to name segmentation labels and to resolve region names in --region_groupings_json. By default the FreeSurferColorLUT.txt file that ships with the tool is used.', type=str)
     parser.add_argument('--sequence_name_source', help='OPTIONAL: the the key for the key/value pair to try and grab sequence name from. For example if the qMRI file is named sub-1_acq-QALAS.nii.gz, this should be "acq". If the sequence is found, it will be represented as "quant" in the output files.', type=str, default = 'acq')
     parser.add_argument('--ants_reg_metric', '--ants-reg-metric', help="The registration metric used in ANTS, options are mattes (default), GC, meansquares", type=str, choices=['mattes', 'GC', 'meansquares'], default='mattes')
     parser.add_argument('--ants_reg_type', '--ants-reg-type', help="The registration type used in ANTS, options are Rigid (default), Similarity, Affine", type=str, choices=['Rigid', 'Similarity', 'Affine'], default='Rigid')
+    parser.add_argument('--reg_profile', '--reg-profile', help="OPTIONAL: speed/accuracy preset for the registration, options are fast, standard (default), accurate. The standard profile uses the ANTs default multi-resolution settings on the full images. The fast and accurate profiles crop both images to the bounding box of the dilated brain mask, and use fewer/more iterations, pyramid levels, and metric samples respectively. The profile and registration runtime are stored in the desc-AsegROIs_scalarstats.json file.", type=str, choices=['fast', 'standard', 'accurate'], default='standard')
+    parser.add_argument('--n_jobs', '--n-jobs', help='OPTIONAL: the number of sessions to process in parallel (default 1). Each session is processed in its own worker process.', type=int, default=1)
+    parser.add_argument('--threads_per_job', '--threads-per-job', help='OPTIONAL: the number of ITK/ANTs threads each session is allowed to use. By default the available CPUs are split evenly across the --n_jobs workers.', type=int)
+    parser.add_argument('--mem_per_job_gb', '--mem-per-job-gb', help='OPTIONAL: the estimated peak memory (in GB) needed to process one session (default 4). When --n_jobs is greater than 1, new sessions are only started when this much memory is available on the node.', type=float, default=4.0)
+    parser.add_argument('--compression_level', '--compression-level', help='OPTIONAL: the gzip compression level (1-9) used for the nifti outputs (default 6). Lower levels are faster but produce larger files.', type=int, choices=range(1, 10), metavar='{1-9}', default=6)
+    parser.add_argument('--compression_threads', '--compression-threads', help='OPTIONAL: the number of threads used to compress each nifti output (default 1). If greater than 1, outputs are written as multi-member (block) gzip files, which are readable by any standard gzip/nifti reader.', type=int, default=1)
 
     return parser
\ No newline at end of file
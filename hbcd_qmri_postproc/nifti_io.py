@@ -0,0 +1,158 @@
+#!/usr/local/bin/python3
+import os, gzip
+import numpy as np
+
+#Default gzip compression level for nifti outputs. Level 6 is the zlib
+#default and is considerably faster than level 9 for nearly the same size.
+default_compression_level = 6
+
+#Size of the uncompressed chunks that are streamed to the compressor
+chunk_size = 4*1024*1024
+
+
+def get_nifti_header(image):
+    '''Build a NIfTI-1 header describing an ANTs image
+
+    The header mirrors the one written by ITK: the voxel to world
+    transform is stored in both the qform and sform (with code 1,
+    scanner) and spatial units are mm.
+
+    Parameters
+    ----------
+    image : ants.ANTsImage
+        scalar image to describe
+
+    Returns
+    -------
+    header : nibabel.Nifti1Header
+        header for the image
+
+    '''
+
+    import nibabel as nib
+
+    if image.components != 1:
+        raise ValueError('Error: Only scalar images can be written as compressed nifti files, but image has {} components'.format(image.components))
+
+    #ANTs/ITK use LPS world coordinates while NIfTI uses RAS
+    dimension = image.dimension
+    lps_affine = np.eye(4)
+    lps_affine[:dimension, :dimension] = np.asarray(image.direction) * np.asarray(image.spacing)[np.newaxis, :]
+    lps_affine[:dimension, 3] = image.origin
+    affine = np.diag([-1, -1, 1, 1]) @ lps_affine
+
+    header = nib.Nifti1Header()
+    header.set_data_shape(image.shape)
+    header.set_data_dtype(image.view().dtype)
+    header.set_zooms(image.spacing)
+    header.set_qform(affine, code = 1)
+    header.set_sform(affine, code = 1)
+    header.set_xyzt_units('mm')
+    header['pixdim'][dimension + 1:] = 0
+    header['regular'] = b'r'
+    header['vox_offset'] = 352
+
+    return header
+
+
+def iter_nifti_bytes(image):
+    '''Iterate over the bytes of a single file NIfTI-1 representation of an image
+
+    The header is yielded first, followed by the voxel data in
+    chunks that are views on the image's memory, so the file
+    contents are never assembled in memory.
+
+    Parameters
+    ----------
+    image : ants.ANTsImage
+        scalar image to serialize
+
+    '''
+
+    header = get_nifti_header(image)
+    yield header.binaryblock + b'\x00\x00\x00\x00'
+
+    #NIfTI stores the first axis fastest (Fortran order), which is the
+    #order of the voxels in the view of the ANTs image, so no copy is made
+    data = np.asfortranarray(image.view())
+    data_bytes = memoryview(data.ravel(order = 'F').view(np.uint8))
+    for start in range(0, data_bytes.shape[0], chunk_size):
+        yield data_bytes[start:start + chunk_size]
+
+
+def _compress_block(block, compression_level):
+    '''Compress a block of bytes as a complete gzip member'''
+
+    return gzip.compress(block, compresslevel = compression_level, mtime = 0)
+
+
+def write_compressed_nifti(image, output_path, compression_level = default_compression_level, compression_threads = 1):
+    '''Write an ANTs image directly to a gzipped nifti file in one streaming pass
+
+    With compression_threads > 1, the file is split into blocks that are
+    compressed in parallel, each as its own gzip member. A file made of
+    concatenated gzip members is a valid gzip file (RFC 1952) and can be
+    read by gzip, zlib, nibabel, and ITK/ANTs. The output is written to a
+    temporary file that is renamed once complete, so a partially written
+    file is never left at output_path.
+
+    Parameters
+    ----------
+    image : ants.ANTsImage
+        scalar image to write
+    output_path : str
+        path to the output file (should end with .nii.gz)
+    compression_level : int
+        gzip compression level (1-9)
+    compression_threads : int
+        number of threads used for compression
+
+    Returns
+    -------
+    output_path : str
+        path to the output file
+
+    '''
+
+    if compression_level < 1 or compression_level > 9:
+        raise ValueError('Error: Compression level must be between 1 and 9, but {} was provided'.format(compression_level))
+    if os.path.exists(os.path.dirname(output_path)) == False:
+        os.makedirs(os.path.dirname(output_path))
+    temporary_path = '{}.tmp-{}'.format(output_path, os.getpid())
+    try:
+        with open(temporary_path, 'wb') as f:
+            if compression_threads > 1:
+                _write_block_gzip(f, iter_nifti_bytes(image), compression_level, compression_threads)
+            else:
+                with gzip.GzipFile(filename = '', mode = 'wb', fileobj = f, compresslevel = compression_level, mtime = 0) as f_out:
+                    for temp_bytes in iter_nifti_bytes(image):
+                        f_out.write(temp_bytes)
+        #Remove any existing output first since it may be hard linked to a checkpoint
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        os.replace(temporary_path, output_path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+    return output_path
+
+
+def _write_block_gzip(file_obj, byte_chunks, compression_level, compression_threads):
+    '''Compress chunks of bytes in parallel and write them in order as gzip members'''
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    #zlib releases the GIL while compressing, so threads run in parallel.
+    #Only a bounded number of blocks are in flight at any time.
+    max_pending = 2*compression_threads
+    pending = []
+    with ThreadPoolExecutor(max_workers = compression_threads) as executor:
+        for temp_chunk in byte_chunks:
+            pending.append(executor.submit(_compress_block, temp_chunk, compression_level))
+            if len(pending) >= max_pending:
+                file_obj.write(pending.pop(0).result())
+        for temp_future in pending:
+            file_obj.write(temp_future.result())
+
+    return
@@ -0,0 +1,92 @@
+#!/usr/local/bin/python3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+#Largest number of writes that can be waiting or running at once. Each
+#pending write keeps its data (i.e. an image) in memory until it is done.
+default_max_pending = 4
+
+
+class BackgroundWriter:
+    '''Run the writes of a session's outputs in background threads
+
+    Writes are submitted as a function along with its arguments, and
+    processing continues while the function runs. gzip compression and
+    file I/O release the GIL, so they overlap with the next processing
+    step. At most max_pending writes can be queued or running at once;
+    submitting another write blocks until one of them finishes, which
+    bounds the memory held by pending writes. Errors raised by a write
+    are raised again by the next call to submit or flush.
+
+    Parameters
+    ----------
+    num_threads : int
+        number of background threads. If 0, every write
+        runs immediately in the calling thread.
+    max_pending : int
+        largest number of writes that can be queued or running at once
+
+    '''
+
+    def __init__(self, num_threads = 1, max_pending = default_max_pending):
+
+        self.num_threads = num_threads
+        if num_threads > 0:
+            self.executor = ThreadPoolExecutor(max_workers = num_threads, thread_name_prefix = 'output_writer')
+        else:
+            self.executor = None
+        self.slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self.futures = []
+
+    def _raise_errors(self):
+        '''Raise the error of the first failed write (if any), and forget finished writes'''
+
+        remaining_futures = []
+        for temp_future in self.futures:
+            if temp_future.done():
+                temp_future.result()
+            else:
+                remaining_futures.append(temp_future)
+        self.futures = remaining_futures
+
+        return
+
+    def submit(self, write_function, *args, **kwargs):
+        '''Run write_function(*args, **kwargs) in the background'''
+
+        if type(self.executor) == type(None):
+            write_function(*args, **kwargs)
+            return
+
+        self._raise_errors()
+        self.slots.acquire()
+        try:
+            temp_future = self.executor.submit(write_function, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        temp_future.add_done_callback(lambda future : self.slots.release())
+        self.futures.append(temp_future)
+
+        return
+
+    def flush(self):
+        '''Wait until every submitted write has finished'''
+
+        for temp_future in self.futures:
+            temp_future.exception()
+        self._raise_errors()
+
+        return
+
+    def close(self):
+        '''Wait for every submitted write and stop the background threads'''
+
+        try:
+            self.flush()
+        finally:
+            if type(self.executor) != type(None):
+                self.executor.shutdown(wait = True)
+                self.executor = None
+
+        return
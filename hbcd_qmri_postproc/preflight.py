@@ -0,0 +1,193 @@
+#!/usr/local/bin/python3
+import os, json, time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+#Name of the report (within the output directory) listing every problem found
+report_name = 'preflight_report.json'
+
+#Number of sessions checked at once. Checks mostly wait on the
+#filesystem (i.e. a network filesystem), so threads are enough.
+preflight_threads = 8
+
+
+def check_image_header(image_path):
+    '''Read the header of a nifti image (without loading its voxels)
+
+    Returns
+    -------
+    shape : tuple or None
+        the spatial shape of the image, or None if the header could not be read
+    problem : str or None
+        description of the problem with the image
+
+    '''
+
+    import nibabel as nib
+
+    try:
+        shape = tuple(nib.load(image_path).shape)
+    except Exception as error:
+        return None, 'unable to read nifti header of {} ({})'.format(image_path, error)
+    while len(shape) > 3 and shape[-1] == 1:
+        shape = shape[:-1]
+    if len(shape) != 3:
+        return None, 'expected a 3D image but {} has shape {}'.format(image_path, shape)
+
+    return shape, None
+
+
+def check_json_file(json_path):
+    '''Check that a json sidecar exists and can be parsed. Returns a description of the problem, or None.'''
+
+    try:
+        with open(json_path, 'r') as f:
+            json.load(f)
+    except (OSError, ValueError) as error:
+        return 'unable to load json sidecar {} ({})'.format(json_path, error)
+
+    return None
+
+
+def check_session_inputs(session_inputs, freesurfer_color_lut = None, check_labels = False):
+    '''Find the problems that would make calc_qmri_stats fail for a session
+
+    The inputs are chosen the same way as in calc_qmri_stats. Only image
+    headers and json sidecars are read, unless check_labels is True, in
+    which case the voxels of the segmentation are also read to check
+    that every label is in the FreeSurfer Color LUT.
+
+    Parameters
+    ----------
+    session_inputs : dict
+        output of dataset_index.DatasetIndex.get_session_inputs
+    freesurfer_color_lut : color_lut.ColorLUT or None
+        look up table the segmentation labels are checked against
+    check_labels : bool
+        if True, also check the labels of the segmentation
+
+    Returns
+    -------
+    problems : list
+        description of every problem found (empty if none)
+
+    '''
+
+    problems = []
+
+    #Anatomical reference, segmentation and mask
+    segmentation_path = None
+    for temp_modality in ['T2w', 'T1w']:
+        if len(session_inputs[temp_modality + '_segmentations']) == 0:
+            continue
+        segmentation_path = session_inputs[temp_modality + '_segmentations'][0]
+        mask_path = segmentation_path.replace('desc-aseg_dseg.nii.gz', 'desc-brain_mask.nii.gz')
+        if mask_path not in session_inputs[temp_modality + '_masks']:
+            problems.append('{} segmentation found without a corresponding mask (expected {})'.format(temp_modality, mask_path))
+            mask_path = None
+        references = session_inputs[temp_modality + '_references']
+        if len(references) != 1:
+            problems.append('expected exactly 1 {} anatomical reference but found {}: {}'.format(temp_modality, len(references), references))
+            reference_path = None
+        else:
+            reference_path = references[0]
+        break
+    if type(segmentation_path) == type(None):
+        problems.append('no T1w or T2w segmentation found')
+
+    #qMRI synthetic weighted images and maps
+    if len(session_inputs['qMRI_T1w'])*len(session_inputs['qMRI_T2w']) != 1:
+        problems.append('expected exactly one qMRI T1w and T2w image but found {}'.format(session_inputs['qMRI_T1w'] + session_inputs['qMRI_T2w']))
+        qmri_for_reg_path = None
+    elif type(segmentation_path) != type(None):
+        qmri_for_reg_path = session_inputs['qMRI_' + temp_modality][0]
+    else:
+        qmri_for_reg_path = None
+    map_paths = [session_inputs[temp_key][0] for temp_key in ['T1maps', 'T2maps', 'PDmaps'] if len(session_inputs[temp_key])]
+    if len(map_paths) == 0:
+        problems.append('no T1map, T2map, or PDmap found')
+    else:
+        #The metadata of the outputs comes from the first map's sidecar
+        temp_problem = check_json_file(map_paths[0].replace('.nii.gz', '.json'))
+        if type(temp_problem) != type(None):
+            problems.append(temp_problem)
+
+    #Headers of every image that will be loaded
+    if type(segmentation_path) != type(None):
+        for temp_path in [reference_path, mask_path, segmentation_path]:
+            if type(temp_path) != type(None):
+                temp_problem = check_image_header(temp_path)[1]
+                if type(temp_problem) != type(None):
+                    problems.append(temp_problem)
+        if type(reference_path) != type(None):
+            temp_problem = check_json_file(reference_path.replace('.nii' + reference_path.split('.nii')[-1], '.json'))
+            if type(temp_problem) != type(None):
+                problems.append(temp_problem)
+    if type(qmri_for_reg_path) != type(None):
+        qmri_shape, temp_problem = check_image_header(qmri_for_reg_path)
+        if type(temp_problem) != type(None):
+            problems.append(temp_problem)
+    else:
+        qmri_shape = None
+    for temp_path in map_paths:
+        temp_shape, temp_problem = check_image_header(temp_path)
+        if type(temp_problem) != type(None):
+            problems.append(temp_problem)
+        #The segmentation is resampled onto the grid of the qMRI image used for registration
+        elif type(qmri_shape) != type(None) and temp_shape != qmri_shape:
+            problems.append('{} has shape {} but the qMRI image used for registration ({}) has shape {}'.format(temp_path, temp_shape, qmri_for_reg_path, qmri_shape))
+
+    #Labels of the segmentation (reads the voxels)
+    if check_labels and type(freesurfer_color_lut) != type(None) and type(segmentation_path) != type(None) and len(problems) == 0:
+        import nibabel as nib
+        labels = np.unique(np.asanyarray(nib.load(segmentation_path).dataobj))
+        missing_labels = [temp_label for temp_label in labels.tolist() if temp_label != 0 and type(freesurfer_color_lut.get_name(temp_label)) == type(None)]
+        if len(missing_labels):
+            problems.append('segmentation {} has labels that are not in the FreeSurfer Color LUT: {}'.format(segmentation_path, missing_labels))
+
+    return problems
+
+
+def check_sessions(session_jobs, freesurfer_color_lut = None, check_labels = False):
+    '''Check the inputs of many calc_qmri_stats session jobs (see check_session_inputs)
+
+    Returns
+    -------
+    session_problems : list
+        one dictionary ('participant', 'session', 'problems') for
+        every session with at least one problem
+
+    '''
+
+    def check_job(session_job):
+        return check_session_inputs(session_job['calc_kwargs']['session_inputs'], freesurfer_color_lut = freesurfer_color_lut,
+                                    check_labels = check_labels)
+
+    with ThreadPoolExecutor(max_workers = preflight_threads) as executor:
+        all_problems = list(executor.map(check_job, session_jobs))
+    session_problems = []
+    for temp_job, temp_problems in zip(session_jobs, all_problems):
+        if len(temp_problems):
+            session_problems.append({'participant' : temp_job['participant'],
+                                     'session' : temp_job['session'],
+                                     'problems' : temp_problems})
+
+    return session_problems
+
+
+def save_report(report_path, configuration_problems, session_problems, num_sessions, mode):
+    '''Save every problem found by the preflight checks to a json file'''
+
+    report = {'Time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'Mode' : mode,
+              'Sessions_Checked' : num_sessions,
+              'Sessions_With_Problems' : len(session_problems),
+              'Configuration_Problems' : configuration_problems,
+              'Session_Problems' : session_problems}
+    report_directory = os.path.dirname(report_path)
+    if report_directory != '' and os.path.exists(report_directory) == False:
+        os.makedirs(report_directory, exist_ok = True)
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent = 5)
+
+    return
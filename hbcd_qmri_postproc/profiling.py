@@ -0,0 +1,181 @@
+#!/usr/local/bin/python3
+import os, time, json
+
+#Profiling modes that can be used in addition to the stage timings
+profile_modes = ['cprofile', 'tracemalloc']
+
+
+def read_peak_rss_mb():
+    '''Get the peak resident set size of the process in MB
+
+    The value is read from /proc/self/status (VmHWM) so that it
+    reflects the peak since the last call to reset_peak_rss. If
+    that is unavailable, the peak over the lifetime of the process
+    reported by getrusage is used.
+
+    '''
+
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for temp_line in f:
+                if temp_line.startswith('VmHWM:'):
+                    return int(temp_line.split()[1])/1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    except (ImportError, OSError):
+        return None
+
+
+def reset_peak_rss():
+    '''Reset the peak resident set size of the process
+
+    Returns
+    -------
+    was_reset : bool
+        True if the peak was reset. This requires Linux, and
+        write access to /proc/self/clear_refs.
+
+    '''
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class StageProfiler:
+    '''Measure the resources used by each stage of processing a session
+
+    Stages are run one after another. Starting a stage ends the previous
+    one, and a stage that is started more than once (i.e. once per map)
+    accumulates its times over all of its calls. For each stage the wall
+    time, CPU time (of all threads in the process), and peak resident
+    set size are recorded.
+
+    Parameters
+    ----------
+    profile_mode : str or None
+        if 'cprofile', a cProfile profile is captured for each stage (combining
+        all of the stage's calls). If
+        'tracemalloc', the peak traced python memory and the lines that
+        allocated the most memory are recorded for each stage.
+    profile_directory : str or None
+        folder where the cProfile output (one .prof file
+        per stage) is saved
+    file_prefix : str
+        prefix for the names of the cProfile output files
+
+    '''
+
+    def __init__(self, profile_mode = None, profile_directory = None, file_prefix = ''):
+
+        if type(profile_mode) != type(None) and profile_mode not in profile_modes:
+            raise ValueError('Error: Profile mode must be one of {}, but {} was provided'.format(profile_modes, profile_mode))
+        self.profile_mode = profile_mode
+        self.profile_directory = profile_directory
+        self.file_prefix = file_prefix
+        self.stages = {}
+        self.current_stage = None
+        self.peak_rss_is_per_stage = True
+        self.start_time = time.perf_counter()
+        self._stage_start = None
+        self._profilers = {}
+
+    def start_stage(self, stage_name):
+        '''End the current stage (if any) and start a new one'''
+
+        self.stop()
+        if stage_name not in self.stages:
+            self.stages[stage_name] = {'Wall_Time_Seconds' : 0.0,
+                                       'CPU_Time_Seconds' : 0.0,
+                                       'Peak_RSS_MB' : None,
+                                       'Calls' : 0}
+        if reset_peak_rss() == False:
+            self.peak_rss_is_per_stage = False
+        self.current_stage = stage_name
+        if self.profile_mode == 'cprofile':
+            import cProfile
+            if stage_name not in self._profilers:
+                self._profilers[stage_name] = cProfile.Profile()
+            self._profilers[stage_name].enable()
+        elif self.profile_mode == 'tracemalloc':
+            import tracemalloc
+            tracemalloc.start()
+        self._stage_start = (time.perf_counter(), time.process_time())
+
+        return
+
+    def stop(self):
+        '''End the current stage'''
+
+        if type(self.current_stage) == type(None):
+            return
+        wall_time = time.perf_counter() - self._stage_start[0]
+        cpu_time = time.process_time() - self._stage_start[1]
+        stage = self.stages[self.current_stage]
+        stage['Wall_Time_Seconds'] += wall_time
+        stage['CPU_Time_Seconds'] += cpu_time
+        stage['Calls'] += 1
+        peak_rss = read_peak_rss_mb()
+        if type(peak_rss) != type(None):
+            if type(stage['Peak_RSS_MB']) == type(None) or peak_rss > stage['Peak_RSS_MB']:
+                stage['Peak_RSS_MB'] = peak_rss
+
+        if self.profile_mode == 'cprofile':
+            self._profilers[self.current_stage].disable()
+            if type(self.profile_directory) != type(None):
+                if os.path.exists(self.profile_directory) == False:
+                    os.makedirs(self.profile_directory)
+                profile_path = os.path.join(self.profile_directory, '{}stage-{}.prof'.format(self.file_prefix, self.current_stage))
+                self._profilers[self.current_stage].dump_stats(profile_path)
+                stage['cProfile_File'] = os.path.basename(profile_path)
+        elif self.profile_mode == 'tracemalloc':
+            import tracemalloc
+            traced_peak = tracemalloc.get_traced_memory()[1]/(1024*1024)
+            top_allocations = []
+            for temp_stat in tracemalloc.take_snapshot().statistics('lineno')[:10]:
+                top_allocations.append({'Location' : str(temp_stat.traceback[0]), 'Size_MB' : temp_stat.size/(1024*1024)})
+            tracemalloc.stop()
+            stage['Traced_Python_Peak_MB'] = max(stage.get('Traced_Python_Peak_MB', 0), traced_peak)
+            stage['Top_Python_Allocations'] = top_allocations
+
+        self.current_stage = None
+
+        return
+
+    def get_peak_rss_mb(self):
+        '''Get the largest peak resident set size (MB) of any stage, or None if it was not measured'''
+
+        peak_rss = [temp_stage['Peak_RSS_MB'] for temp_stage in self.stages.values() if type(temp_stage['Peak_RSS_MB']) != type(None)]
+        if len(peak_rss) == 0:
+            return None
+
+        return max(peak_rss)
+
+    def get_summary(self):
+        '''Get the measurements of all stages as a json serializable dictionary'''
+
+        self.stop()
+        summary = {'Stages' : self.stages,
+                   'Total_Wall_Time_Seconds' : time.perf_counter() - self.start_time,
+                   'Peak_RSS_MB' : self.get_peak_rss_mb(),
+                   'Peak_RSS_Is_Per_Stage' : self.peak_rss_is_per_stage,
+                   'Profile_Mode' : self.profile_mode}
+
+        return summary
+
+    def save(self, output_path, extra_fields = None):
+        '''Save the measurements of all stages (and any extra fields) to a json file'''
+
+        summary = self.get_summary()
+        if type(extra_fields) != type(None):
+            summary.update(extra_fields)
+        with open(output_path, 'w') as f:
+            json.dump(summary, f, indent = 5)
+
+        return
@@ -1,57 +1,29 @@
 #!/usr/local/bin/python3
-import os, glob, gzip, warnings
-import nibabel
-import matplotlib.pyplot as plt
+import os, tempfile
 import numpy as np
-import ants
-import pandas as pd
-import nibabel as nib
 import json
-from scipy import ndimage
-import SimpleITK as sitk
+import roi_stats
+import color_lut
+import roi_groupings
+import checkpoints
+import image_store
+import nifti_io
+import mask_prep
+import registration
+import dataset_index
+import profiling
+import scratch_cache
+import output_writer
+import quantile_sketch
 
-def replace_file_with_gzipped_version(file_path):
-    '''Replace a file with a gzipped version of itself
-    
-    Parameters
-    ----------
-    file_path : str
-        Path to the file to be gzipped
-    
-    '''
-    
-    #file_path = path to the file to be gzipped
-    
-    with open(file_path, 'rb') as f_in:
-        with gzip.open(file_path + '.gz', 'wb') as f_out:
-            f_out.writelines(f_in)
-    os.remove(file_path)
-    
-    return file_path + '.gz'
-
-def load_color_lut_df():
-    '''Load a copy of the FreeSurfer Color Look Up Table
-
-    Returns
-    -------
-    df : pandas.DataFrame
-        A pandas dataframe with the FreeSurfer Color Look Up Table
-
-    '''
-    print('   Loading FreeSurfer Color Look Up Table')
-    freesurfer_color_lut = '/hbcd_qmri_postproc/FreeSurferColorLUT.txt'
-    with open(freesurfer_color_lut, 'r') as f:
-        lines = f.readlines()
-    color_lut_dict = {'Region_Number': [], 'Region_Name': []}
-    for temp_line in lines[4:-1]:
-        if temp_line[0] == '#' or temp_line[0] == ' ' or temp_line[0] == '\n':
-            continue
-        color_lut_dict['Region_Number'].append(int(temp_line.split()[0]))
-        color_lut_dict['Region_Name'].append(temp_line.split()[1])
-    df = pd.DataFrame(color_lut_dict, index = color_lut_dict['Region_Number'])
-    
-    return df
+#Heavy dependencies (ants, SimpleITK, pandas, nibabel, matplotlib) are imported
+#within the functions that use them, so that importing this module stays fast
+#and each processing mode only loads the packages it needs.
 
+#Interpolation used to resample the qMRI maps into the space of the anatomical
+#reference, and the segmentation into qMRI space
+map_interpolation_scheme = 'bSpline'
+segmentation_interpolation_scheme = 'nearestNeighbor'
 
 def grab_anatomical_reference_metadata(anatomical_reference_path):
     '''Given a path to a nifti image, grab metadata from the corresponding json sidecar
@@ -84,6 +56,23 @@ def grab_anatomical_reference_metadata(anatomical_reference_path):
             metadata_to_save[temp_field] = None
         
     return metadata_to_save
+
+
+def get_plot_data_proxy(image):
+    '''Get an array-like object for an image path or an ANTs image already in memory
+
+    For paths, nibabel's array proxy is returned so that only the
+    parts of the image that are indexed are converted to arrays. For
+    ANTs images, a view of the image's voxels is returned (without a copy).
+
+    '''
+
+    import nibabel as nib
+
+    if type(image) == str:
+        return nib.load(image).dataobj
+
+    return image.view()
     
     
 def make_outline_overlay_underlay_plot_ribbon(path_to_underlay, path_to_overlay, ap_buffer_size = 3, crop_buffer=20, num_total_images=16, dpi=400,
@@ -92,17 +81,24 @@ def make_outline_overlay_underlay_plot_ribbon(path_to_underlay, path_to_overlay,
     """Function that makes contour plot with nifti mask and underlay.
 
 
-    Takes paths to two nifti files, the overlay nifti file will
+    Takes two nifti files, the overlay nifti file will
     be thresholded, and a contour created out of the resulting mask
     and then will be projected over the underlay.
 
+    Only the region of the underlay that is covered by the panel
+    (or the overlay) is loaded, the panel is assembled in a single
+    preallocated float32 array, and the figure is rendered with the
+    non-interactive Agg backend so that no display is needed.
+
     Parameters
     ----------
-    path_to_underlay : str
-        path to underlay file
-    path_to_overlay : str
+    path_to_underlay : str or ants.ANTsImage
+        path to underlay file, or the underlay image
+        if it is already loaded
+    path_to_overlay : str or ants.ANTsImage
         path to overlay that will be masked and used
-        to create contour
+        to create contour, or the overlay image if it
+        is already loaded
     ap_buffer_size : int
         ap buffer
     crob_buffer : int
@@ -111,6 +107,8 @@ def make_outline_overlay_underlay_plot_ribbon(path_to_underlay, path_to_overlay,
         number of images in the panel, must
         have a sqrt that is an integer so
         panel can be square
+    dpi : int
+        resolution of the figure
     underlay_cmap : str
         the matplotlib colormap to use for the
         underlay
@@ -119,34 +117,20 @@ def make_outline_overlay_underlay_plot_ribbon(path_to_underlay, path_to_overlay,
     output_path : str or None
         optional path for file to be saved
         (do not include extension)
+    close_plot : bool
+        if False, the matplotlib figure is returned
 
     """
 
-    print('   Making overlay/underlay plot')
-
-    underlay_path = path_to_underlay
-    underlay_obj = nib.load(underlay_path)
-    underlay_data = underlay_obj.get_fdata()
-    overlay_img = nib.load(path_to_overlay)
-    overlay_data = overlay_img.get_fdata()
-    
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-    orig_overlay = overlay_data
-    overlay_data = np.zeros(orig_overlay.shape)
-    #overlay_data[orig_overlay == 2] = 1
-    #overlay_data[orig_overlay == 41] = 1
-    #overlay_data[orig_overlay == 3] = 2
-    #overlay_data[orig_overlay == 42] = 2
-    overlay_data[orig_overlay > 0.5] = 1
+    print('   Making overlay/underlay plot')
 
-    masked_vals = underlay_data[overlay_data > 0.5]
-    hist_results = np.histogram(masked_vals, bins = 100)
-    modal_value = hist_results[1][np.argmax(hist_results[0])]
-    vmin = modal_value*.3
-    vmax = modal_value*1.7
+    overlay_data = np.asarray(get_plot_data_proxy(path_to_overlay)) > 0.5
 
-    overlay_ap_max = np.max(overlay_data,axis=(0,1))
-    non_zero_locations = np.where(overlay_ap_max > 0.5)[0]
+    overlay_ap_max = np.any(overlay_data,axis=(0,1))
+    non_zero_locations = np.where(overlay_ap_max)[0]
     min_lim = np.min(non_zero_locations) - ap_buffer_size
     if min_lim < 0:
         min_lim = 0
@@ -155,10 +139,10 @@ def make_outline_overlay_underlay_plot_ribbon(path_to_underlay, path_to_overlay,
         max_lim = overlay_data.shape[2] - 1
     inds_to_capture = np.linspace(min_lim,max_lim,num_total_images,dtype=int)
 
-    overlay_max_0 = np.max(overlay_data,axis=(1,2))
-    overlay_max_1 = np.max(overlay_data,axis=(0,2))
-    overlay_locations_0 = np.where(overlay_max_0 > 0.5)[0]
-    overlay_locations_1 = np.where(overlay_max_1 > 0.5)[0]
+    overlay_max_0 = np.any(overlay_data,axis=(1,2))
+    overlay_max_1 = np.any(overlay_data,axis=(0,2))
+    overlay_locations_0 = np.where(overlay_max_0)[0]
+    overlay_locations_1 = np.where(overlay_max_1)[0]
     min0 = np.min(overlay_locations_0) - crop_buffer
     if min0 < 0:
         min0 = 0
@@ -172,52 +156,484 @@ def make_outline_overlay_underlay_plot_ribbon(path_to_underlay, path_to_overlay,
     if max1 >= overlay_data.shape[1]:
         max1 = overlay_data.shape[1] - 1
 
+    #Only load the part of the underlay that contains the panel and the overlay
+    region = (slice(min0, max(max0, np.max(overlay_locations_0) + 1)),
+              slice(min1, max(max1, np.max(overlay_locations_1) + 1)),
+              slice(min_lim, max_lim + 1))
+    underlay_data = np.asarray(get_plot_data_proxy(path_to_underlay)[region], dtype = np.float32)
+    overlay_data = overlay_data[region]
+    inds_to_capture = inds_to_capture - min_lim
+
+    masked_vals = underlay_data[overlay_data].astype(np.float64)
+    hist_results = np.histogram(masked_vals, bins = 100)
+    modal_value = hist_results[1][np.argmax(hist_results[0])]
+    vmin = modal_value*.3
+    vmax = modal_value*1.7
 
+    #Fill the panel, with the images of each column stacked from top to bottom
     num_imgs_per_dim = int(np.sqrt(num_total_images))
+    size0 = max0 - min0
+    size1 = max1 - min1
+    temp_underlay_full = np.zeros((num_imgs_per_dim*size0, num_imgs_per_dim*size1), dtype = np.float32)
+    temp_overlay_full = np.zeros((num_imgs_per_dim*size0, num_imgs_per_dim*size1), dtype = np.float32)
     counting_index = 0
     for i in range(num_imgs_per_dim):
-
-        temp_underlay_row = underlay_data[min0:max0,min1:max1,inds_to_capture[counting_index]]
-        temp_overlay_row = overlay_data[min0:max0,min1:max1,inds_to_capture[counting_index]]
-        counting_index += 1
-        for j in range(1,num_imgs_per_dim):
-            temp_underlay_row = np.vstack((temp_underlay_row,underlay_data[min0:max0,min1:max1,inds_to_capture[counting_index]]))
-            temp_overlay_row = np.vstack((temp_overlay_row,overlay_data[min0:max0,min1:max1,inds_to_capture[counting_index]]))
-            counting_index +=1
-        if i == 0:
-            temp_underlay_full = temp_underlay_row
-            temp_overlay_full = temp_overlay_row
-        else:
-            temp_underlay_full = np.hstack((temp_underlay_full,temp_underlay_row))
-            temp_overlay_full = np.hstack((temp_overlay_full,temp_overlay_row))
+        for j in range(num_imgs_per_dim):
+            temp_underlay_full[j*size0:(j + 1)*size0, i*size1:(i + 1)*size1] = underlay_data[:size0,:size1,inds_to_capture[counting_index]]
+            temp_overlay_full[j*size0:(j + 1)*size0, i*size1:(i + 1)*size1] = overlay_data[:size0,:size1,inds_to_capture[counting_index]]
+            counting_index += 1
 
     underlay_panel = np.fliplr(np.rot90(temp_underlay_full,1))
     overlay_panel = np.fliplr(np.rot90(temp_overlay_full,1))
 
-    plt.figure(dpi=dpi)
-    im = plt.contour(overlay_panel, linewidths=linewidths, colors='m')
+    fig = Figure(dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    im = ax.contour(overlay_panel, linewidths=linewidths, colors='m')
     
-    #im = plt.imshow(underlay_panel, cmap=underlay_cmap, vmax = vmax, vmin = vmin)
-    im = plt.imshow(underlay_panel, cmap='gist_gray', vmax = vmax, vmin = vmin)
-    plt.xticks([])
-    plt.yticks([])
-    plt.axis('off')
+    #im = ax.imshow(underlay_panel, cmap=underlay_cmap, vmax = vmax, vmin = vmin)
+    im = ax.imshow(underlay_panel, cmap='gist_gray', vmax = vmax, vmin = vmin)
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.axis('off')
 
     if type(output_path) != type(None):
-        plt.savefig(output_path, dpi=dpi, bbox_inches='tight', pad_inches = 0)
+        fig.savefig(output_path, dpi=dpi, bbox_inches='tight', pad_inches = 0)
 
     if close_plot == True:
-        plt.close()
+        return
+
+    return fig
+
+
+def write_text_file(output_path, text):
+    '''Write a string to a file'''
+
+    with open(output_path, 'w') as f:
+        f.write(text)
+
+    return
+
+def save_figure(fig, output_path, dpi = 300):
+    '''Save a matplotlib figure made by make_outline_overlay_underlay_plot_ribbon'''
+
+    fig.savefig(output_path, dpi=dpi, bbox_inches='tight', pad_inches = 0)
 
     return
 
+def write_transform(transform_path, output_path):
+    '''Save an ANTs transform file in the (text) format written by SimpleITK'''
+
+    import SimpleITK as sitk
+
+    transform = sitk.ReadTransform(transform_path)
+    sitk.WriteTransform(transform, output_path)
+
+    return
+
+def save_registered_image(image, output_path, stage_checkpoint, checkpoint_file_name,
+                          compression_level = nifti_io.default_compression_level, compression_threads = 1):
+    '''Write a registered image and store a copy of it as the checkpoint of its stage'''
+
+    nifti_io.write_compressed_nifti(image, output_path, compression_level = compression_level,
+                                    compression_threads = compression_threads)
+    temporary_checkpoint = checkpoints.start_checkpoint(stage_checkpoint)
+    checkpoints.save_to_checkpoint(output_path, temporary_checkpoint, checkpoint_file_name)
+    checkpoints.commit_checkpoint(temporary_checkpoint, stage_checkpoint)
+
+    return
+
+def save_registration_checkpoint(reg, registration_checkpoint, metadata,
+                                 compression_level = nifti_io.default_compression_level, compression_threads = 1):
+    '''Store the transform and warped moving image of a registration as a checkpoint'''
+
+    temporary_checkpoint = checkpoints.start_checkpoint(registration_checkpoint)
+    if type(temporary_checkpoint) != type(None):
+        checkpoints.save_to_checkpoint(reg['fwdtransforms'][0], temporary_checkpoint, 'fwdtransform.mat')
+        nifti_io.write_compressed_nifti(reg['warpedmovout'], os.path.join(temporary_checkpoint, 'warpedmovout.nii.gz'),
+                                        compression_level = compression_level, compression_threads = compression_threads)
+        checkpoints.commit_checkpoint(temporary_checkpoint, registration_checkpoint, metadata = metadata)
+
+    return
+
+def calc_roi_stats_tables(maps_array_dict, segmentation_arr, custom_roi_groupings = None,
+                          color_lut_path = None, label_index = None, sorted_values = None):
+    '''Calculate ROI statistics for the aseg regions and any custom groupings
+
+    Parameters
+    ----------
+    maps_array_dict : dict
+        dictionary whose keys are map names (i.e. T1, T2, PD) and whose
+        values are arrays with the map values in qMRI space
+    segmentation_arr : numpy.ndarray
+        segmentation that has been registered to qMRI space
+    custom_roi_groupings : list, dict, or None
+        Paths to json files with custom groupings of regions, or
+        the output of roi_groupings.compile_roi_groupings
+    color_lut_path : str or None
+        Path to the FreeSurfer Color Look Up Table. If None, the
+        copy of the table that ships with the tool is used.
+    label_index : dict or None
+        output of roi_stats.build_label_index for the segmentation,
+        if it was already made
+    sorted_values : dict or None
+        output of roi_stats.sort_maps_by_label for the maps,
+        if it was already made
+
+    Returns
+    -------
+    roi_tables : dict
+        dictionary whose keys are AsegROIs and the name of each custom
+        grouping file, and whose values are pandas DataFrames with one
+        row per region (Region_Name, <map>_<measure>, ...)
+
+    '''
+
+    import pandas as pd
+
+    #Load the freesurfer color lut
+    freesurfer_color_lut = color_lut.load_color_lut(color_lut_path)
+    
+    #Initialize a dictionary to store all the ROI values/names
+    measure_types = roi_stats.measure_types
+    roi_params_dict = {'Region_Name' : []}
+    for temp_image_type in maps_array_dict.keys():
+        for temp_measure in measure_types:
+            roi_params_dict[temp_image_type + '_' + temp_measure] = []
+    
+    #Group the voxels by segmentation value once, then calculate#############################
+    #statistics for every region/map from the grouped voxels#################################
+    print('   Calculating Standard ROI Relaxometry Values')
+    if type(label_index) == type(None):
+        label_index = roi_stats.build_label_index(segmentation_arr)
+    if type(sorted_values) == type(None):
+        sorted_values = roi_stats.sort_maps_by_label(maps_array_dict, label_index)
+    region_labels = []
+    for seg_val in label_index['labels']:
+        temp_region_name = freesurfer_color_lut.get_name(seg_val)
+        if type(temp_region_name) == type(None):
+            raise ValueError('Error: Segmentation had value [{}] but there was no region with this value found in FreeSurfer Color LUT'.format(seg_val))
+        else:
+            roi_params_dict['Region_Name'].append(temp_region_name)
+            region_labels.append([seg_val])
+    roi_params_dict.update(roi_stats.calc_roi_stats_for_maps(sorted_values, label_index, region_labels))
+    roi_tables = {'AsegROIs' : pd.DataFrame(roi_params_dict)}
+
+    ##########################################################################################
+    ##########################################################################################
+    #Also create a table for any custom groupings of regions
+    if type(custom_roi_groupings) != type(None):
+        if type(custom_roi_groupings) != dict:
+            custom_roi_groupings = roi_groupings.compile_roi_groupings(custom_roi_groupings, freesurfer_color_lut)
+        group_labels = roi_groupings.get_group_labels(custom_roi_groupings, label_index)
+        for temp_grouping_file in custom_roi_groupings['grouping_files']:
+            print('   Calculating Custom ROI Relaxometry Values for {}'.format(temp_grouping_file['path']))
+            custom_roi_params_dict = {'Region_Name' : []}
+            for temp_image_type in maps_array_dict.keys():
+                for temp_measure in measure_types:
+                    custom_roi_params_dict[temp_image_type + '_' + temp_measure] = []
+
+            start, stop = temp_grouping_file['columns']
+            custom_roi_params_dict['Region_Name'] = custom_roi_groupings['group_names'][start:stop]
+            custom_roi_params_dict.update(roi_stats.calc_roi_stats_for_maps(sorted_values, label_index, group_labels[start:stop]))
+            roi_tables[temp_grouping_file['name']] = pd.DataFrame(custom_roi_params_dict)
+
+    return roi_tables
+
+
+def save_roi_stats(maps_array_dict, segmentation_arr, roi_params_metadata,
+                   anat_out_dir, subject_name, session_name, custom_roi_groupings = None,
+                   color_lut_path = None, writer = None):
+    '''Calculate and save ROI statistics for the aseg regions and any custom groupings
+
+    A quantile sketch of every map within every segmentation label is also
+    saved (desc-AsegROIs_quantiles.npz, see quantile_sketch.calc_label_sketches),
+    from which other statistics can later be derived for the whole cohort.
+
+    Parameters
+    ----------
+    maps_array_dict : dict
+        dictionary whose keys are map names (i.e. T1, T2, PD) and whose
+        values are arrays with the map values in qMRI space
+    segmentation_arr : numpy.ndarray
+        segmentation that has been registered to qMRI space
+    roi_params_metadata : dict
+        metadata to store in the desc-AsegROIs_scalarstats.json file. The
+        same metadata (without the Original_qMRI_Images field) is stored
+        for any custom groupings.
+    anat_out_dir : str
+        folder where the scalarstats files will be saved
+    subject_name : str
+        Name of the subject (i.e. sub-01)
+    session_name : str
+        Name of the session (i.e. ses-01)
+    custom_roi_groupings : list, dict, or None
+        Paths to json files with custom groupings of regions, or
+        the output of roi_groupings.compile_roi_groupings
+    color_lut_path : str or None
+        Path to the FreeSurfer Color Look Up Table. If None, the
+        copy of the table that ships with the tool is used.
+    writer : output_writer.BackgroundWriter or None
+        If provided, the tsv/json files are written in the background
+        by this writer. Otherwise they are written immediately.
+
+    '''
+
+    if type(writer) == type(None):
+        writer = output_writer.BackgroundWriter(num_threads = 0)
+    if type(custom_roi_groupings) != type(None) and type(custom_roi_groupings) != dict:
+        custom_roi_groupings = roi_groupings.compile_roi_groupings(custom_roi_groupings, color_lut.load_color_lut(color_lut_path))
+
+    label_index = roi_stats.build_label_index(segmentation_arr)
+    sorted_values = roi_stats.sort_maps_by_label(maps_array_dict, label_index)
+    roi_tables = calc_roi_stats_tables(maps_array_dict, segmentation_arr, custom_roi_groupings = custom_roi_groupings,
+                                       color_lut_path = color_lut_path, label_index = label_index, sorted_values = sorted_values)
+    sketches = quantile_sketch.calc_label_sketches(sorted_values, label_index, region_names = roi_tables['AsegROIs']['Region_Name'].tolist())
+
+    if os.path.exists(anat_out_dir) == False:
+        os.makedirs(anat_out_dir)
+    output_tsv_path = os.path.join(anat_out_dir, '{}_{}_desc-AsegROIs_scalarstats.tsv'.format(subject_name, session_name))
+    writer.submit(roi_tables['AsegROIs'].to_csv, output_tsv_path, index=False, sep = '\t')
+
+    roi_params_metadata_json = json.dumps(roi_params_metadata, indent = 5)
+    output_json_path = os.path.join(anat_out_dir, '{}_{}_desc-AsegROIs_scalarstats.json'.format(subject_name, session_name))
+    writer.submit(write_text_file, output_json_path, roi_params_metadata_json)
+    output_sketch_path = os.path.join(anat_out_dir, '{}_{}_desc-AsegROIs_quantiles.npz'.format(subject_name, session_name))
+    writer.submit(quantile_sketch.save_sketches, sketches, output_sketch_path)
+
+    #Also save the tables of any custom groupings of regions
+    if type(custom_roi_groupings) != type(None):
+        for temp_grouping_file in custom_roi_groupings['grouping_files']:
+            temp_grouping_partial_name = temp_grouping_file['name']
+            output_tsv_path = os.path.join(anat_out_dir, '{}_{}_desc-{}_scalarstats.tsv'.format(subject_name, session_name, temp_grouping_partial_name))
+            writer.submit(roi_tables[temp_grouping_partial_name].to_csv, output_tsv_path, index=False, sep = '\t')
+
+            custom_roi_params_metadata = {}
+            for temp_key in roi_params_metadata.keys():
+                if temp_key != 'Original_qMRI_Images':
+                    custom_roi_params_metadata[temp_key] = roi_params_metadata[temp_key]
+            custom_roi_params_metadata['Custom_ROI_Grouping'] = temp_grouping_file['groupings']
+            custom_roi_params_metadata_json = json.dumps(custom_roi_params_metadata, indent = 5)
+            output_json_path = os.path.join(anat_out_dir, '{}_{}_desc-{}_scalarstats.json'.format(subject_name, session_name, temp_grouping_partial_name))
+            writer.submit(write_text_file, output_json_path, custom_roi_params_metadata_json)
+
+    return
+
+
+def register_qmri_to_reference(anatomical_reference, qmri_for_reg, mask,
+                               registration_type = 'Rigid', registration_metric = 'mattes',
+                               registration_profile = registration.default_registration_profile,
+                               adaptive_registration = False,
+                               adaptive_registration_threshold = registration.default_adaptive_threshold,
+                               transform_directory = None):
+    '''Register a qMRI synthetic weighted image to the anatomical reference
+
+    The brain mask is cleaned up and dilated (see mask_prep.prepare_registration_mask)
+    before being used to restrict where the registration metric is evaluated.
+    If adaptive_registration is True, the header alignment and a quick rigid
+    registration are tried before the full registration, and the first one
+    whose correlation within the brain mask reaches adaptive_registration_threshold
+    is used (see registration.register_adaptively). The identity transform
+    of the adaptive registration is written to transform_directory, which
+    must be given (and is owned by the caller) when adaptive_registration is True.
+
+    Returns
+    -------
+    reg : dict
+        output of ants.registration (see registration.register_to_reference)
+    registration_info : dict
+        information about the registration, including its runtime
+
+    '''
+
+    dilated_mask = mask_prep.prepare_registration_mask(mask)
+    if adaptive_registration:
+        return registration.register_adaptively(anatomical_reference, qmri_for_reg, dilated_mask, mask, transform_directory,
+                                                registration_type = registration_type, registration_metric = registration_metric,
+                                                registration_profile = registration_profile,
+                                                threshold = adaptive_registration_threshold)
+
+    return registration.register_to_reference(anatomical_reference, qmri_for_reg, dilated_mask,
+                                              registration_type = registration_type, registration_metric = registration_metric,
+                                              registration_profile = registration_profile)
+
+
+def resample_qmri_map(anatomical_reference, qmri_map, transforms):
+    '''Resample a qMRI map into the space of the anatomical reference'''
+
+    import ants
+
+    return ants.apply_transforms(anatomical_reference, qmri_map, transforms, interpolator = map_interpolation_scheme)
+
+
+def resample_segmentation(qmri_for_reg, segmentation, transforms):
+    '''Resample a segmentation from the space of the anatomical reference into qMRI space'''
+
+    import ants
+
+    return ants.apply_transforms(qmri_for_reg, segmentation, transforms, interpolator = segmentation_interpolation_scheme, whichtoinvert = [True])
+
+
+def calc_mask_correlation(warped_qmri, anatomical_reference, mask):
+    '''Correlation between the registered qMRI image and the anatomical reference within the brain mask'''
+
+    return registration.score_alignment(anatomical_reference, warped_qmri, mask)
+
+
+def compute_qmri_stats(anatomical_reference, qmri_for_reg, mask, segmentation, qmri_maps,
+                       custom_roi_groupings = None, color_lut_path = None,
+                       registration_metric = 'mattes',
+                       registration_type = 'Rigid',
+                       registration_profile = registration.default_registration_profile,
+                       adaptive_registration = False,
+                       adaptive_registration_threshold = registration.default_adaptive_threshold,
+                       transform_directory = None, low_memory = False):
+    '''Register qMRI maps to an anatomical reference and calculate ROI statistics in memory
+
+    This runs the same stages as calc_qmri_stats, but takes images that
+    are already loaded and returns its results instead of writing them,
+    so that sessions can be processed from a notebook or another pipeline
+    without going through the filesystem (ANTs still uses a temporary
+    file for the transform it calculates). Images can be provided as ANTs
+    images, paths, or (array, affine) pairs (see image_store.to_image).
+
+    Parameters
+    ----------
+    anatomical_reference : ants.ANTsImage, str, or tuple
+        T1w or T2w anatomical reference image
+    qmri_for_reg : ants.ANTsImage, str, or tuple
+        qMRI synthetic weighted image with the same contrast as the
+        anatomical reference (i.e. the qMRI T2w for a T2w reference)
+    mask : ants.ANTsImage, str, or tuple
+        brain mask in the space of the anatomical reference
+    segmentation : ants.ANTsImage, str, or tuple
+        aseg segmentation in the space of the anatomical reference
+    qmri_maps : dict
+        dictionary whose keys are map names (i.e. T1, T2, PD) and
+        whose values are the qMRI maps
+    custom_roi_groupings : list, dict, or None
+        Paths to json files with custom groupings of regions, or
+        the output of roi_groupings.compile_roi_groupings
+    color_lut_path : str or None
+        Path to the FreeSurfer Color Look Up Table. If None, the
+        copy of the table that ships with the tool is used.
+    registration_metric : str
+        Metric used by ANTs for the registration (mattes, GC, or meansquares)
+    registration_type : str
+        Type of ANTs registration (Rigid, Similarity, or Affine)
+    registration_profile : str
+        Speed/accuracy preset for the registration (fast, standard, or accurate).
+    adaptive_registration : bool
+        If True, the full registration is only run when neither the header
+        alignment nor a quick rigid registration reaches adaptive_registration_threshold
+        (see registration.register_adaptively).
+    adaptive_registration_threshold : float
+        Correlation within the brain mask a step of the adaptive registration needs to reach
+    transform_directory : str or None
+        Existing directory the transform files of the registration are
+        moved to, so that they can be returned as 'fwdtransforms'. If None,
+        the transform files are removed once the images are resampled and
+        only the transform in memory is returned.
+    low_memory : bool
+        If True, only the bounding box of the segmentation's labels is
+        copied out of the images before calculating statistics.
+
+    Returns
+    -------
+    results : dict
+        dictionary with the following keys:
+        'transform' : ants.ANTsTransform that resamples qMRI images into
+        the space of the anatomical reference, 'fwdtransforms' : the
+        transform files (in transform_directory) that can be passed to
+        ants.apply_transforms, or None if no transform_directory was given,
+        'registration_info' : dict, 'registered_maps' : dict with the maps
+        in the space of the anatomical reference, 'registered_segmentation' :
+        the segmentation in qMRI space, 'voxel_correlation_within_mask' : float,
+        'stats' : dict of pandas DataFrames (see calc_roi_stats_tables),
+        and 'quantile_sketches' : dict (see quantile_sketch.calc_label_sketches)
+
+    '''
+
+    import ants
+
+    anatomical_reference = image_store.to_image(anatomical_reference)
+    qmri_for_reg = image_store.to_image(qmri_for_reg)
+    mask = image_store.to_image(mask)
+    segmentation = image_store.to_image(segmentation)
+    qmri_maps = {temp_qmri_map : image_store.to_image(qmri_maps[temp_qmri_map]) for temp_qmri_map in qmri_maps.keys()}
+
+    #The transform files are only kept when the caller asks for them
+    if type(transform_directory) == type(None):
+        temporary_directory = tempfile.TemporaryDirectory(prefix = 'qmri_registration_')
+        registration_directory = temporary_directory.name
+    else:
+        temporary_directory = None
+        registration_directory = transform_directory
+    reg, registration_info = register_qmri_to_reference(anatomical_reference, qmri_for_reg, mask,
+                                                        registration_type = registration_type, registration_metric = registration_metric,
+                                                        registration_profile = registration_profile,
+                                                        adaptive_registration = adaptive_registration,
+                                                        adaptive_registration_threshold = adaptive_registration_threshold,
+                                                        transform_directory = registration_directory)
+    registered_maps = {}
+    for temp_qmri_map in qmri_maps.keys():
+        registered_maps[temp_qmri_map] = resample_qmri_map(anatomical_reference, qmri_maps[temp_qmri_map], reg['fwdtransforms'])
+    registered_segmentation = resample_segmentation(qmri_for_reg, segmentation, reg['fwdtransforms'])
+    transform = ants.read_transform(reg['fwdtransforms'][0])
+    if type(temporary_directory) == type(None):
+        fwdtransforms = registration.move_transform_files(reg, transform_directory)
+    else:
+        fwdtransforms = None
+        registration.remove_transform_files(reg)
+        temporary_directory.cleanup()
+    mask_corr_coef = calc_mask_correlation(reg['warpedmovout'], anatomical_reference, mask)
+
+    if low_memory:
+        map_views = {temp_qmri_map : qmri_maps[temp_qmri_map].view() for temp_qmri_map in qmri_maps.keys()}
+        segmentation_arr, maps_array_dict = roi_stats.crop_to_labels(registered_segmentation.view(), map_views)
+    else:
+        segmentation_arr = registered_segmentation.numpy()
+        maps_array_dict = {temp_qmri_map : qmri_maps[temp_qmri_map].numpy() for temp_qmri_map in qmri_maps.keys()}
+    label_index = roi_stats.build_label_index(segmentation_arr)
+    sorted_values = roi_stats.sort_maps_by_label(maps_array_dict, label_index)
+    roi_tables = calc_roi_stats_tables(maps_array_dict, segmentation_arr, custom_roi_groupings = custom_roi_groupings,
+                                       color_lut_path = color_lut_path, label_index = label_index, sorted_values = sorted_values)
+    sketches = quantile_sketch.calc_label_sketches(sorted_values, label_index, region_names = roi_tables['AsegROIs']['Region_Name'].tolist())
+
+    results = {'transform' : transform,
+               'fwdtransforms' : fwdtransforms,
+               'registration_info' : registration_info,
+               'registered_maps' : registered_maps,
+               'registered_segmentation' : registered_segmentation,
+               'voxel_correlation_within_mask' : mask_corr_coef,
+               'stats' : roi_tables,
+               'quantile_sketches' : sketches}
+
+    return results
+
 
 def calc_qmri_stats(bids_directory, bibsnet_directory,
                      qmri_directory, output_directory,
                      subject_name, session_name, custom_roi_groupings = None,
                      sequence_name_source = 'acq',
                      registration_metric = 'mattes',
-                     registration_type = 'Rigid'):
+                     registration_type = 'Rigid',
+                     registration_profile = registration.default_registration_profile,
+                     adaptive_registration = False,
+                     adaptive_registration_threshold = registration.default_adaptive_threshold,
+                     use_checkpoints = True,
+                     color_lut_path = None,
+                     compression_level = nifti_io.default_compression_level,
+                     compression_threads = 1,
+                     qc_dpi = 400,
+                     defer_qc = False,
+                     session_inputs = None,
+                     profile_mode = None,
+                     stage_timings_in_json = False,
+                     low_memory = False,
+                     scratch_dir = None,
+                     scratch_max_size_gb = scratch_cache.default_max_size_gb,
+                     write_threads = 1):
     '''Function to generate items of interest based on quantitative MRI maps
     
     
@@ -237,6 +653,70 @@ def calc_qmri_stats(bids_directory, bibsnet_directory,
         Name of the session to be processed (i.e. ses-01). Since these
         scripts are designed for HBCD which has sessions in the BIDS structure,
         this is required.
+    custom_roi_groupings : list, dict, or None
+        Paths to json files with custom groupings of regions, or
+        the output of roi_groupings.compile_roi_groupings
+    color_lut_path : str or None
+        Path to the FreeSurfer Color Look Up Table. If None, the
+        copy of the table that ships with the tool is used.
+    sequence_name_source : str
+        Key of the key/value pair in the qMRI file names to grab the sequence name from
+    registration_metric : str
+        Metric used by ANTs for the registration (mattes, GC, or meansquares)
+    registration_type : str
+        Type of ANTs registration (Rigid, Similarity, or Affine)
+    registration_profile : str
+        Speed/accuracy preset for the registration (fast, standard, or accurate).
+        See registration.registration_profiles.
+    adaptive_registration : bool
+        If True, the alignment given by the image headers and a quick rigid
+        registration are scored (by the voxel correlation within the brain mask)
+        before the full registration, which is only run if neither reaches
+        adaptive_registration_threshold. The steps taken and their scores are
+        saved in the desc-AsegROIs_scalarstats.json file.
+    adaptive_registration_threshold : float
+        Correlation within the brain mask a step of the adaptive registration needs to reach
+    use_checkpoints : bool
+        If True, the registration, registered maps, and registered segmentation
+        are stored as checkpoints under the session's output folder and reused
+        by later runs whose inputs and registration settings are unchanged.
+    compression_level : int
+        gzip compression level (1-9) used for the nifti outputs
+    compression_threads : int
+        Number of threads used to compress each nifti output. If greater
+        than 1, outputs are written as multi-member (block) gzip files.
+    qc_dpi : int
+        Resolution of the desc-RegistrationQCAid.png figure
+    defer_qc : bool
+        If True, only the desc-RegistrationQCAid.json file is written and
+        the figure is left to be made later by make_registration_qc_figure.
+    session_inputs : dict or None
+        The session's input files, as found by dataset_index.DatasetIndex.get_session_inputs.
+        If None, the session's folders are searched for the inputs.
+    profile_mode : str or None
+        If 'cprofile' or 'tracemalloc', a cProfile profile or the python
+        memory allocations are also captured for each stage of processing
+        (see profiling.StageProfiler). The wall time, CPU time, and peak
+        memory of each stage are always saved to desc-StageTimings.json.
+    stage_timings_in_json : bool
+        If True, the timings of each stage are also added to the
+        desc-AsegROIs_scalarstats.json file as Stage_Timings.
+    low_memory : bool
+        If True, the qMRI maps and the registered segmentation are not copied
+        out of their images. Instead, only the bounding box of the segmentation's
+        labels is copied (as float32) before calculating statistics.
+    scratch_dir : str or None
+        Folder (ideally on node-local disk) where decompressed copies of the
+        input images are cached (see scratch_cache.ScratchCache) and shared
+        with later runs and other workers. If None, inputs are read directly.
+    scratch_max_size_gb : float
+        Size limit of the scratch cache. The least recently used
+        copies are removed when the cache grows above it.
+    write_threads : int
+        Number of background threads that write the outputs (nifti, tsv,
+        json, png, and checkpoints) while processing continues. If 0,
+        outputs are written before moving on. The function only returns
+        once every output has been written.
     
     
     '''
@@ -246,14 +726,25 @@ def calc_qmri_stats(bids_directory, bibsnet_directory,
     bibsnet_directory = os.path.join(bibsnet_directory, '')
     qmri_directory = os.path.join(qmri_directory, '')
     bids_directory = os.path.join(bids_directory, '')
+
+    #Measure the resources used by each stage of processing
+    session_out_dir = os.path.join(output_directory, subject_name, session_name)
+    profiler = profiling.StageProfiler(profile_mode = profile_mode, profile_directory = os.path.join(session_out_dir, 'profiling'),
+                                       file_prefix = '{}_{}_'.format(subject_name, session_name))
+
+    #The session is only marked as complete once all of its outputs are written
+    checkpoints.remove_completion_marker(session_out_dir)
+    profiler.start_stage('input_discovery')
     
     
     ##########################################################################################
     ##########################################################################################
     ##########Identify the images that should be used in processing###########################
     ##########################################################################################
-    t1w_segs = glob.glob(os.path.join(bibsnet_directory, subject_name, session_name, 'anat', '*space-T1w_desc-aseg_dseg.nii.gz'))
-    t2w_segs = glob.glob(os.path.join(bibsnet_directory, subject_name, session_name, 'anat', '*space-T2w_desc-aseg_dseg.nii.gz'))
+    if type(session_inputs) == type(None):
+        session_inputs = dataset_index.DatasetIndex(bids_directory, bibsnet_directory, qmri_directory).get_session_inputs(subject_name, session_name)
+    t1w_segs = session_inputs['T1w_segmentations']
+    t2w_segs = session_inputs['T2w_segmentations']
     
     #If possible, use T2w image instead of T1w
     if len(t2w_segs):
@@ -261,9 +752,9 @@ def calc_qmri_stats(bids_directory, bibsnet_directory,
         anatomical_reference_modality = 'T2w'
         bibsnet_seg_path = t2w_segs[0]
         bibsnet_mask_path = bibsnet_seg_path.replace('desc-aseg_dseg.nii.gz', 'desc-brain_mask.nii.gz')
-        if os.path.exists(bibsnet_mask_path) == False:
+        if bibsnet_mask_path not in session_inputs['T2w_masks']:
             raise ValueError('Error: A T2w BIBSNET segmentation was found without a corresponding mask. Expected to find mask with name: {}'.format(bibsnet_mask_path))
-        possible_anatomical_references = glob.glob(os.path.join(bids_directory, subject_name, session_name, 'anat', '*T2w.nii.gz'))
+        possible_anatomical_references = session_inputs['T2w_references']
         if len(possible_anatomical_references) != 1:
             raise ValueError('Error: If a T2w segmentation is to be used for processing, only 1 T2w reference found in the subjects anat directory must be present but {} were found'.format(len(possible_anatomical_references)))
         else:
@@ -274,9 +765,9 @@ def calc_qmri_stats(bids_directory, bibsnet_directory,
         anatomical_reference_modality = 'T1w'
         bibsnet_seg_path = t1w_segs[0]
         bibsnet_mask_path = bibsnet_seg_path.replace('desc-aseg_dseg.nii.gz', 'desc-brain_mask.nii.gz')
-        if os.path.exists(bibsnet_mask_path) == False:
+        if bibsnet_mask_path not in session_inputs['T1w_masks']:
             raise ValueError('Error: A T1w BIBSNET segmentation was found without a corresponding mask. Expected to find mask with name: {}'.format(bibsnet_mask_path))
-        possible_anatomical_references = glob.glob(os.path.join(bids_directory, subject_name, session_name, 'anat', '*T1w.nii.gz'))
+        possible_anatomical_references = session_inputs['T1w_references']
         if len(possible_anatomical_references) != 1:
             raise ValueError('Error: If a T1w segmentation is to be used for processing, only 1 T1w reference found in the subjects anat directory must be present but {} were found'.format(len(possible_anatomical_references)))
         else:
@@ -285,12 +776,12 @@ def calc_qmri_stats(bids_directory, bibsnet_directory,
         raise ValueError('No segmentation found for {} and {} within {}'.format(subject_name, session_name, bibsnet_directory))
         
         
-    #Find the qMRI Maps
-    qmri_t1 = glob.glob(os.path.join(qmri_directory, subject_name, 'ses*', 'anat', '*T1map.nii.gz'))
-    qmri_t2 = glob.glob(os.path.join(qmri_directory, subject_name, 'ses*', 'anat', '*T2map.nii.gz'))
-    qmri_pd = glob.glob(os.path.join(qmri_directory, subject_name, 'ses*', 'anat', '*PDmap.nii.gz')) 
-    qmri_t1w_path = glob.glob(os.path.join(qmri_directory, subject_name, 'ses*', 'anat', '*T1w.nii.gz'))
-    qmri_t2w_path = glob.glob(os.path.join(qmri_directory, subject_name, 'ses*', 'anat', '*T2w.nii.gz'))
+    #Find the qMRI Maps (only within this session's folder)
+    qmri_t1 = session_inputs['T1maps']
+    qmri_t2 = session_inputs['T2maps']
+    qmri_pd = session_inputs['PDmaps']
+    qmri_t1w_path = session_inputs['qMRI_T1w']
+    qmri_t2w_path = session_inputs['qMRI_T2w']
 
     if len(qmri_t1w_path)*len(qmri_t2w_path) != 1:
         raise ValueError('Error: Expected to have exactly one T1w and T2w image, but found the following images {}.'.format(qmri_t1w_path + qmri_t2w_path))
@@ -324,13 +815,34 @@ def calc_qmri_stats(bids_directory, bibsnet_directory,
     #Define the out dir
     anat_out_dir = os.path.join(output_directory, subject_name, session_name, 'anat')
         
-    #Load some of the images that will be used
+    if anatomical_reference_modality == 'T1w':
+        qmri_for_reg_path = qmri_t1w_path[0]
+    elif anatomical_reference_modality == 'T2w':
+        qmri_for_reg_path = qmri_t2w_path[0]
+
+    #Every image is read at most once and served from memory to each stage
+    #that uses it. Images are dropped after the last stage that needs them.
+    #Inputs are decompressed once into the scratch cache. The cache already knows the
+    #hash of each input, so the checkpoint keys don't require reading the inputs again.
+    if type(scratch_dir) != type(None):
+        input_cache = scratch_cache.ScratchCache(scratch_dir, max_size_gb = scratch_max_size_gb)
+        for temp_path in [anatomical_reference_path, qmri_for_reg_path, bibsnet_mask_path, bibsnet_seg_path] + list(qmri_map_path_dict.values()):
+            if temp_path.endswith('.gz'):
+                checkpoints.remember_file_hash(temp_path, input_cache.cache_file(temp_path)[1])
+    else:
+        input_cache = None
+
     print('   Loading qMRI maps')
-    anatomical_reference = ants.image_read(anatomical_reference_path)
-    segmentation = ants.image_read(bibsnet_seg_path)
-    qmri_image_dict = {}
+    images = image_store.SessionImageStore(scratch_cache = input_cache)
+    images.add('anatomical_reference', path = anatomical_reference_path, stages = ['registration', 'resampling', 'metrics'])
+    images.add('qmri_for_reg', path = qmri_for_reg_path, stages = ['registration', 'segmentation'])
+    images.add('mask', path = bibsnet_mask_path, stages = ['registration', 'metrics'])
+    images.add('segmentation', path = bibsnet_seg_path, stages = ['segmentation', 'qc_plot'])
     for temp_qmri_map in qmri_map_path_dict.keys():
-        qmri_image_dict[temp_qmri_map] = ants.image_read(qmri_map_path_dict[temp_qmri_map])
+        if low_memory:
+            images.add(temp_qmri_map + 'map', path = qmri_map_path_dict[temp_qmri_map], stages = ['resampling', 'roi_stats'])
+        else:
+            images.add(temp_qmri_map + 'map', path = qmri_map_path_dict[temp_qmri_map], stages = ['resampling'])
 
     #Load the JSON metadata from one of original qmri outputs.
     #Also remove SeriesDescription/ImageType fields that are specific to weighting.
@@ -343,114 +855,132 @@ def calc_qmri_stats(bids_directory, bibsnet_directory,
     except:
         pass
 
-    def remove_extra_clusters_from_mask(mask_image_ants):
-
-        temp_data = np.round(mask_image_ants[:])
-        labels, nb = ndimage.label(temp_data)
-        largest_label_size = 0
-        largest_label = 0
-        for i in range(nb + 1):
-            if i == 0:
-                continue
-            label_size = np.sum(labels == i)
-            if label_size > largest_label_size:
-                largest_label_size = label_size
-                largest_label = i
-        new_mask_data = np.zeros(temp_data.shape)
-        new_mask_data[labels == largest_label] = 1
-        new_mask = mask_image_ants.new_image_like(new_mask_data)
-
-        return new_mask
-    
-    #Register to the anatomical reference space using either a T1w/T2w workflow
-    print('   Registering qMRI synthetic weighted image to anatomical reference space')
-    anatomical_reference = ants.image_read(anatomical_reference_path)
-    bibsnet_mask = ants.image_read(bibsnet_mask_path)
-    adjusted_bibsnet_mask = remove_extra_clusters_from_mask(bibsnet_mask)
-    dilated_mask = ants.utils.morphology(adjusted_bibsnet_mask, 'dilate', 35)
-    if anatomical_reference_modality == 'T1w':
-        qmri_for_reg = ants.image_read(qmri_t1w_path[0])
-    elif anatomical_reference_modality == 'T2w':
-        qmri_for_reg = ants.image_read(qmri_t2w_path[0])
-    reg = ants.registration(fixed=anatomical_reference, moving=qmri_for_reg, mask=dilated_mask, type_of_transform=registration_type, aff_metric=registration_metric)
+    #Outputs are written in the background by a bounded number of threads
+    writer = output_writer.BackgroundWriter(num_threads = write_threads)
+
+    #Register to the anatomical reference space using either a T1w/T2w workflow.
+    profiler.start_stage('registration')
+    #Each expensive stage is stored as a checkpoint keyed by the contents of its
+    #inputs, so that a rerun with unchanged inputs can skip the stage.
+    if use_checkpoints:
+        checkpoint_root = checkpoints.get_checkpoint_root(output_directory, subject_name, session_name)
+    else:
+        checkpoint_root = None
+    registration_parameters = {'registration_type' : registration_type, 'registration_metric' : registration_metric,
+                               'registration_profile' : registration_profile}
+    if adaptive_registration:
+        registration_parameters['adaptive_registration_threshold'] = adaptive_registration_threshold
+    registration_key = checkpoints.compute_stage_key('registration',
+                                                     input_files = {'fixed' : anatomical_reference_path, 'moving' : qmri_for_reg_path, 'mask' : bibsnet_mask_path},
+                                                     parameters = registration_parameters)
+    registration_checkpoint = checkpoints.get_stage_directory(checkpoint_root, 'registration', registration_key)
+    registration_checkpoint_metadata = checkpoints.load_checkpoint(registration_checkpoint)
+    transform_directory = None
+    if type(registration_checkpoint_metadata) != type(None):
+        print('   Reusing registration of qMRI synthetic weighted image from checkpoint')
+        reg = {'fwdtransforms' : [os.path.join(registration_checkpoint, 'fwdtransform.mat')],
+               'warpedmovout' : image_store.read_image(os.path.join(registration_checkpoint, 'warpedmovout.nii.gz'))}
+        registration_info = registration_checkpoint_metadata.get('Registration_Info', {'Registration_Profile' : registration_profile})
+    else:
+        print('   Registering qMRI synthetic weighted image to anatomical reference space ({} profile)'.format(registration_profile))
+        #The identity transform of the adaptive registration is kept here until every output is written
+        transform_directory = tempfile.TemporaryDirectory(prefix = 'qmri_registration_')
+        reg, registration_info = register_qmri_to_reference(images.get('anatomical_reference'), images.get('qmri_for_reg'), images.get('mask'),
+                                                            registration_type = registration_type, registration_metric = registration_metric,
+                                                            registration_profile = registration_profile,
+                                                            adaptive_registration = adaptive_registration,
+                                                            adaptive_registration_threshold = adaptive_registration_threshold,
+                                                            transform_directory = transform_directory.name)
+        writer.submit(save_registration_checkpoint, dict(reg), registration_checkpoint,
+                      {'Registration_Type' : registration_type, 'Registration_Metric' : registration_metric,
+                       'Registration_Info' : registration_info},
+                      compression_level = compression_level, compression_threads = compression_threads)
+    images.finish_stage('registration')
+
+    #The registered map used as the underlay of the registration QC figure
+    for temp_qmri_map in ['T2', 'T1', 'PD']:
+        if temp_qmri_map in qmri_map_path_dict.keys():
+            underlay_map = temp_qmri_map
+            break
 
     #Apply the transform calculated above to the t1map, t2map, and pdmap images
-    Map_Interpolation_Scheme = 'bSpline'
+    Map_Interpolation_Scheme = map_interpolation_scheme
     maps_array_dict = {}
     registered_maps_paths = {}
     print('   Generating and saving registered qMRI maps')
     for temp_qmri_map in qmri_map_path_dict.keys():
-        temp_map = ants.image_read(qmri_map_path_dict[temp_qmri_map])
-        temp_map_transformed = ants.apply_transforms(anatomical_reference, temp_map, reg['fwdtransforms'], interpolator = Map_Interpolation_Scheme)
-        maps_array_dict[temp_qmri_map] = np.array(temp_map[:])
-        registered_temp_map_path = os.path.join(anat_out_dir, '{}_{}_space-{}_desc-{}_{}map.nii'.format(subject_name, session_name, anatomical_reference_modality, sequence_name, temp_qmri_map))
-        print('      Saving {}'.format(registered_temp_map_path))
+        temp_map = images.get(temp_qmri_map + 'map')
+        if low_memory == False:
+            maps_array_dict[temp_qmri_map] = temp_map.numpy()
+        registered_temp_map_path = os.path.join(anat_out_dir, '{}_{}_space-{}_desc-{}_{}map.nii.gz'.format(subject_name, session_name, anatomical_reference_modality, sequence_name, temp_qmri_map))
         if os.path.exists(anat_out_dir) == False:
             os.makedirs(anat_out_dir)
-        ants.image_write(temp_map_transformed, registered_temp_map_path)
-        replace_file_with_gzipped_version(registered_temp_map_path)
-        registered_maps_paths[temp_qmri_map] = registered_temp_map_path + '.gz'
+        profiler.start_stage('resampling')
+        map_key = checkpoints.compute_stage_key('resampled{}map'.format(temp_qmri_map),
+                                                input_files = {'map' : qmri_map_path_dict[temp_qmri_map]},
+                                                parameters = {'interpolation' : Map_Interpolation_Scheme},
+                                                parent_keys = [registration_key])
+        map_checkpoint = checkpoints.get_stage_directory(checkpoint_root, 'resampled{}map'.format(temp_qmri_map), map_key)
+        if type(checkpoints.load_checkpoint(map_checkpoint)) != type(None):
+            print('      Restoring {} from checkpoint'.format(registered_temp_map_path))
+            checkpoints.restore_from_checkpoint(map_checkpoint, 'registered_map.nii.gz', registered_temp_map_path)
+            if temp_qmri_map == underlay_map and defer_qc == False:
+                images.add('underlay', path = registered_temp_map_path, stages = ['qc_plot'])
+        else:
+            temp_map_transformed = resample_qmri_map(images.get('anatomical_reference'), temp_map, reg['fwdtransforms'])
+            if temp_qmri_map == underlay_map and defer_qc == False:
+                images.add('underlay', path = registered_temp_map_path, image = temp_map_transformed, stages = ['qc_plot'])
+            profiler.start_stage('write_outputs')
+            print('      Saving {}'.format(registered_temp_map_path))
+            writer.submit(save_registered_image, temp_map_transformed, registered_temp_map_path, map_checkpoint, 'registered_map.nii.gz',
+                          compression_level = compression_level, compression_threads = compression_threads)
+        registered_maps_paths[temp_qmri_map] = registered_temp_map_path
         
-        #save the registration as well
-        transform = sitk.ReadTransform(reg['fwdtransforms'][0])
-        transform_out_path = os.path.join(anat_out_dir, '{}_{}_from-QALAS-to-{}_mode-image_xfm.txt'.format(subject_name, session_name, anatomical_reference_modality))
-        sitk.WriteTransform(transform, transform_out_path)
+    images.finish_stage('resampling')
+
+    #save the registration as well
+    profiler.start_stage('write_outputs')
+    transform_out_path = os.path.join(anat_out_dir, '{}_{}_from-QALAS-to-{}_mode-image_xfm.txt'.format(subject_name, session_name, anatomical_reference_modality))
+    writer.submit(write_transform, reg['fwdtransforms'][0], transform_out_path)
 
     #Also transform the segmentation image back to qMRI (i.e. T1map/T2map/PDmap) space
-    Segmentation_Interpolation_Scheme = 'nearestNeighbor'
-    segmentation_reverse_transformed = ants.apply_transforms(qmri_for_reg, segmentation, reg['fwdtransforms'], interpolator = Segmentation_Interpolation_Scheme, whichtoinvert = [True])
+    profiler.start_stage('resampling')
+    Segmentation_Interpolation_Scheme = segmentation_interpolation_scheme
     bibnset_file = bibsnet_seg_path.split('/')[-1]
-    registered_segmentation_path = os.path.join(anat_out_dir, bibnset_file.replace(bibnset_file.split('_')[-3], 'space-{}'.format(sequence_name))).replace('.gz', '')
-    ants.image_write(segmentation_reverse_transformed, registered_segmentation_path)
-    registered_segmentation_path = replace_file_with_gzipped_version(registered_segmentation_path)
-
-    
-    #Load the maps and registered segmentation as arrays to extract ROI values
-    segmentation_reverse_transformed_arr = np.array(segmentation_reverse_transformed[:])
-    mask_arr = np.array(ants.image_read(bibsnet_mask_path)[:])
-    anatomical_reference_arr = np.array(anatomical_reference[:])
+    registered_segmentation_path = os.path.join(anat_out_dir, bibnset_file.replace(bibnset_file.split('_')[-3], 'space-{}'.format(sequence_name)))
+    segmentation_key = checkpoints.compute_stage_key('segmentation',
+                                                     input_files = {'segmentation' : bibsnet_seg_path},
+                                                     parameters = {'interpolation' : Segmentation_Interpolation_Scheme},
+                                                     parent_keys = [registration_key])
+    segmentation_checkpoint = checkpoints.get_stage_directory(checkpoint_root, 'segmentation', segmentation_key)
+    if type(checkpoints.load_checkpoint(segmentation_checkpoint)) != type(None):
+        print('   Restoring registered segmentation from checkpoint')
+        registered_segmentation_path = checkpoints.restore_from_checkpoint(segmentation_checkpoint, 'registered_segmentation.nii.gz', registered_segmentation_path)
+        segmentation_reverse_transformed = image_store.read_image(registered_segmentation_path)
+    else:
+        segmentation_reverse_transformed = resample_segmentation(images.get('qmri_for_reg'), images.get('segmentation'), reg['fwdtransforms'])
+        profiler.start_stage('write_outputs')
+        writer.submit(save_registered_image, segmentation_reverse_transformed, registered_segmentation_path, segmentation_checkpoint, 'registered_segmentation.nii.gz',
+                      compression_level = compression_level, compression_threads = compression_threads)
+    images.finish_stage('segmentation')
 
-    #Load the freesurfer color lut
-    color_lut_df = load_color_lut_df()
     
-    #Initialize a dictionary to store all the ROI values/names
-    measure_types = ['Mean', 'Median', '1-percentile', '99-percentile', 'Std']
-    roi_params_dict = {'Region_Name' : []}
-    for temp_image_type in maps_array_dict.keys():
-        for temp_measure in measure_types:
-            roi_params_dict[temp_image_type + '_' + temp_measure] = []
-    
-    #Find unique segmentation values########################################################
-    ########################################################################################
-    print('   Calculating Standard ROI Relaxometry Values')
-    unique_segmentation_vals = np.unique(segmentation_reverse_transformed_arr)
-    for seg_val in unique_segmentation_vals:
-        if seg_val != 0: #Exclude 0 from analyses
-            temp_df = color_lut_df[color_lut_df['Region_Number'] == seg_val]
-            if temp_df.shape[0] == 0:
-                raise ValueError('Error: Segmentation had value [{}] but there was no region with this value found in FreeSurfer Color LUT'.format(seg_val))
-            else:
-                temp_region_name = temp_df['Region_Name'].values[0]
-                roi_params_dict['Region_Name'].append(temp_region_name)
-                voxel_inds = segmentation_reverse_transformed_arr == seg_val
-                for temp_image_type in maps_array_dict.keys():
-                    temp_vals = maps_array_dict[temp_image_type][voxel_inds]
-                    roi_params_dict[temp_image_type + '_Mean'].append(np.mean(temp_vals))
-                    roi_params_dict[temp_image_type + '_Median'].append(np.median(temp_vals))
-                    roi_params_dict[temp_image_type + '_1-percentile'].append(np.percentile(temp_vals, 1))
-                    roi_params_dict[temp_image_type + '_99-percentile'].append(np.percentile(temp_vals, 99))
-                    roi_params_dict[temp_image_type + '_Std'].append(np.std(temp_vals))
-
-    if os.path.exists(anat_out_dir) == False:
-        os.makedirs(anat_out_dir)
-    output_tsv_path = os.path.join(anat_out_dir, '{}_{}_desc-AsegROIs_scalarstats.tsv'.format(subject_name, session_name))
-    params_df = pd.DataFrame(roi_params_dict)
-    params_df.to_csv(output_tsv_path, index=False, sep = '\t') 
-
-    mask_inds = mask_arr > 0.5
-    mask_corr_coef = np.corrcoef(reg['warpedmovout'][mask_inds], anatomical_reference_arr[mask_inds])[0,1]
+    #Load the registered segmentation as an array to extract ROI values
+    profiler.start_stage('roi_stats')
+    if low_memory:
+        map_views = {temp_qmri_map : images.get(temp_qmri_map + 'map').view() for temp_qmri_map in qmri_map_path_dict.keys()}
+        segmentation_reverse_transformed_arr, maps_array_dict = roi_stats.crop_to_labels(segmentation_reverse_transformed.view(), map_views)
+        del map_views
+        images.finish_stage('roi_stats')
+    else:
+        segmentation_reverse_transformed_arr = segmentation_reverse_transformed.numpy()
+    del segmentation_reverse_transformed
 
+    mask_corr_coef = calc_mask_correlation(reg['warpedmovout'], images.get('anatomical_reference'), images.get('mask'))
+    del reg['warpedmovout']
+    images.finish_stage('metrics')
 
+    anatomical_reference_metadata = grab_anatomical_reference_metadata(anatomical_reference_path)
     roi_params_metadata = {
                            'Original_Segmentation_Path' : ["bids:bibsnet:{}".format(bibsnet_seg_path.split(bibsnet_directory)[-1])],
                            'qMRI_Registered_Segmentation_Path' : ["bids:qmri_postproc:{}".format(registered_segmentation_path.split(output_directory)[-1])],
@@ -460,131 +990,209 @@ def calc_qmri_stats(bids_directory, bibsnet_directory,
                            'Segmentation_Resampling_Scheme' : Segmentation_Interpolation_Scheme,
                            'Voxel_Correlation_Within_Mask' : mask_corr_coef,
                            'Voxel_Correlation_Within_Mask_Description' : 'This is the correlation of voxel intensities between the anatomical reference image and the synthetic weighted image from qmri following registration, using only voxels defined in the brain mask.'}
+    roi_params_metadata.update(registration_info)
     
     roi_params_metadata['Original_qMRI_Images'] = []
     for temp_qmri_map in qmri_map_path_dict.keys():
         roi_params_metadata['Original_qMRI_Images'].append("bids:qmri:{}".format(qmri_map_path_dict[temp_qmri_map].split(qmri_directory)[-1]))
-    roi_params_metadata.update(grab_anatomical_reference_metadata(anatomical_reference_path))
+    roi_params_metadata.update(anatomical_reference_metadata)
     roi_params_metadata['Original_qMRI_JSON_Metadata'] = qmri_json_dict
 
-    roi_params_metadata_json = json.dumps(roi_params_metadata, indent = 5)
-    output_json_path = os.path.join(anat_out_dir, '{}_{}_desc-AsegROIs_scalarstats.json'.format(subject_name, session_name))
-    with open(output_json_path, 'w') as f:
-        f.write(roi_params_metadata_json)
-
-
-    ##########################################################################################
-    ##########################################################################################
-    #Also create tsv file for any custom groupings of regions
-    if type(custom_roi_groupings) != type(None):
-        for temp_grouping_path in custom_roi_groupings:
-            print('   Calculating Custom ROI Relaxometry Values for {}'.format(temp_grouping_path))
-            custom_roi_params_dict = {'Region_Name' : []}
-            for temp_image_type in maps_array_dict.keys():
-                for temp_measure in measure_types:
-                    custom_roi_params_dict[temp_image_type + '_' + temp_measure] = []
-
-
-            with open(temp_grouping_path, 'r') as f:
-                temp_groupings = json.load(f)
-            for temp_grouping in temp_groupings.keys():
-                allowed_values = []
-                for i, temp_region in enumerate(temp_groupings[temp_grouping]):
-                    allowed_values.append(color_lut_df[color_lut_df['Region_Name'] == temp_region]['Region_Number'].values[0])
-                
-                voxel_inds = segmentation_reverse_transformed_arr == allowed_values[0]
-                for i in range(len(allowed_values)):
-                    voxel_inds = voxel_inds + (segmentation_reverse_transformed_arr == allowed_values[i])
-                for x, temp_image_type in enumerate(maps_array_dict.keys()):
-                    temp_vals = maps_array_dict[temp_image_type][voxel_inds]
-                    try:
-                        if temp_vals.shape[0] == 0:
-                            custom_roi_params_dict[temp_image_type + '_Mean'].append(np.nan)
-                            custom_roi_params_dict[temp_image_type + '_Median'].append(np.nan)
-                            custom_roi_params_dict[temp_image_type + '_1-percentile'].append(np.nan)
-                            custom_roi_params_dict[temp_image_type + '_99-percentile'].append(np.nan)
-                            custom_roi_params_dict[temp_image_type + '_Std'].append(np.nan)
-                        else:
-                            temp_mean = np.mean(temp_vals)
-                            temp_median = np.median(temp_vals)
-                            temp_1pct = np.percentile(temp_vals, 1)
-                            temp_99pct = np.percentile(temp_vals, 99)
-                            temp_std = np.std(temp_vals)
-
-                            custom_roi_params_dict[temp_image_type + '_Mean'].append(temp_mean)
-                            custom_roi_params_dict[temp_image_type + '_Median'].append(temp_median)
-                            custom_roi_params_dict[temp_image_type + '_1-percentile'].append(temp_1pct)
-                            custom_roi_params_dict[temp_image_type + '_99-percentile'].append(temp_99pct)
-                            custom_roi_params_dict[temp_image_type + '_Std'].append(temp_std)
-                        if x == 0:
-                            custom_roi_params_dict['Region_Name'].append(temp_grouping)
-                    except:
-                        raise ValueError('   Error: Unknown error when calculating custom summary statistics for {}.'.format(temp_grouping))
-
-            temp_grouping_partial_name = temp_grouping_path.split('/')[-1].replace('.json', '')
-            output_tsv_path = os.path.join(anat_out_dir, '{}_{}_desc-{}_scalarstats.tsv'.format(subject_name, session_name, temp_grouping_partial_name))
-            params_df = pd.DataFrame(custom_roi_params_dict)
-            params_df.to_csv(output_tsv_path, index=False, sep = '\t') 
-
-            custom_roi_params_metadata = {'Original_Segmentation_Path' : ["bids:bibsnet:{}".format(bibsnet_seg_path.split(bibsnet_directory)[-1])],
-                           'qMRI_Registered_Segmentation_Path' : ["bids:qmri_postproc:{}".format(registered_segmentation_path.split(output_directory)[-1])],
-                           'Mask_Path' : ["bids:bibsnet:{}".format(bibsnet_mask_path.split(bibsnet_directory)[-1])],
-                           'Anatomical_Reference_Path' : ["bids:assembly_bids:{}".format(anatomical_reference_path.split(bids_directory)[-1])],
-                           'Anatomical_Reference_Modality' : anatomical_reference_modality,
-                           'Segmentation_Resampling_Scheme' : Segmentation_Interpolation_Scheme,
-                           'Voxel_Correlation_Within_Mask' : mask_corr_coef,
-                           'Voxel_Correlation_Within_Mask_Description' : 'This is the correlation of voxel intensities between the anatomical reference image and the synthetic weighted image from qmri following registration, using only voxels defined in the brain mask.'}
-            custom_roi_params_metadata.update(grab_anatomical_reference_metadata(anatomical_reference_path))
-            custom_roi_params_metadata['Original_qMRI_JSON_Metadata'] = qmri_json_dict
-            custom_roi_params_metadata['Custom_ROI_Grouping'] = temp_groupings
-            roi_params_metadata['Original_qMRI_Images'] = []
-            for temp_qmri_map in qmri_map_path_dict.keys():
-                roi_params_metadata['Original_qMRI_Images'].append("bids:qmri:{}".format(qmri_map_path_dict[temp_qmri_map].split(qmri_directory)[-1]))
-            custom_roi_params_metadata_json = json.dumps(custom_roi_params_metadata, indent = 5)
-            output_json_path = os.path.join(anat_out_dir, '{}_{}_desc-{}_scalarstats.json'.format(subject_name, session_name, temp_grouping_partial_name))
-
-            with open(output_json_path, 'w') as f:
-                f.write(custom_roi_params_metadata_json)
-
+    save_roi_stats(maps_array_dict, segmentation_reverse_transformed_arr, roi_params_metadata,
+                   anat_out_dir, subject_name, session_name, custom_roi_groupings = custom_roi_groupings,
+                   color_lut_path = color_lut_path, writer = writer)
 
     #########################################################################################################
     #########################################################################################################
     
     #Add json metadata for the PD/T1/T2map images that have been registered to the anatomical template
+    profiler.start_stage('write_outputs')
     resampled_images_metadata = {'Segmentation_Path' : ["bids:bibsnet:{}".format(bibsnet_seg_path.split(bibsnet_directory)[-1])],
                            'Mask_Path' : ["bids:bibsnet:{}".format(bibsnet_mask_path.split(bibsnet_directory)[-1])],
                            'Anatomical_Reference_Path' : ["bids:assembly_bids:{}".format(anatomical_reference_path.split(bids_directory)[-1])],
                            'Anatomical_Reference_Modality' : anatomical_reference_modality,
                            'Resampling_Scheme' : Map_Interpolation_Scheme}
-    roi_params_metadata['Original_qMRI_Images'] = []
-    for temp_qmri_map in qmri_map_path_dict.keys():
-        roi_params_metadata['Original_qMRI_Images'].append("bids:qmri:{}".format(qmri_map_path_dict[temp_qmri_map].split(qmri_directory)[-1]))
-    resampled_images_metadata.update(grab_anatomical_reference_metadata(anatomical_reference_path))
+    resampled_images_metadata.update(anatomical_reference_metadata)
     resampled_images_metadata['Original_qMRI_JSON_Metadata'] = qmri_json_dict
     resampled_images_metadata_json = json.dumps(resampled_images_metadata, indent = 5)
     for temp_qmri_map in qmri_map_path_dict.keys():
         output_json_path = os.path.join(anat_out_dir, '{}_{}_space-{}_desc-{}_{}map.json'.format(subject_name, session_name, anatomical_reference_modality, sequence_name, temp_qmri_map))
-        with open(output_json_path, 'w') as f:
-            f.write(resampled_images_metadata_json) 
+        writer.submit(write_text_file, output_json_path, resampled_images_metadata_json)
     
     #Make a figure with the segmentation as overlay and t2map as underlay to assess registration quality
     alignment_figure_output = os.path.join(anat_out_dir, '{}_{}_desc-RegistrationQCAid.png'.format(subject_name, session_name))
-    if 'T2' in registered_maps_paths.keys():
-        registered_path_for_underlay = registered_maps_paths['T2']
-    elif 'T1' in registered_maps_paths.keys():
-        registered_path_for_underlay = registered_maps_paths['T1']
-    elif 'PD' in registered_maps_paths.keys():
-        registered_path_for_underlay = registered_maps_paths['PD']
-    else:
-        raise ValueError('Error: Expected to have at least one of T1, T2, or PD maps but none were found.')
+    registered_path_for_underlay = registered_maps_paths[underlay_map]
     
-    make_outline_overlay_underlay_plot_ribbon(registered_path_for_underlay, bibsnet_seg_path, ap_buffer_size = 3, crop_buffer=20, num_total_images=9, dpi=400,
-                                    underlay_cmap='Greys', linewidths=.1, output_path=alignment_figure_output, close_plot=True)
-    with open(alignment_figure_output.replace('.png', '.json'), 'w') as f:
-        alignment_figure_metadata = {
-                                     'Segmentation_Path' : ["bids:bibsnet:{}".format(bibsnet_seg_path.split(bibsnet_directory)[-1])],
-                                     'Underlay_Path' : ["bids:qmri_postproc:{}".format(registered_path_for_underlay.split(output_directory)[-1])],
-                                     }
-        json.dump(alignment_figure_metadata, f, indent = 5)
-
-    return
\ No newline at end of file
+    if defer_qc == False:
+        profiler.start_stage('qc_plot')
+        fig = make_outline_overlay_underlay_plot_ribbon(images.get('underlay'), images.get('segmentation'), ap_buffer_size = 3, crop_buffer=20, num_total_images=9, dpi=qc_dpi,
+                                        underlay_cmap='Greys', linewidths=.1, output_path=None, close_plot=False)
+        writer.submit(save_figure, fig, alignment_figure_output, dpi = qc_dpi)
+    alignment_figure_metadata = {
+                                 'Segmentation_Path' : ["bids:bibsnet:{}".format(bibsnet_seg_path.split(bibsnet_directory)[-1])],
+                                 'Underlay_Path' : ["bids:qmri_postproc:{}".format(registered_path_for_underlay.split(output_directory)[-1])],
+                                 }
+    writer.submit(write_text_file, alignment_figure_output.replace('.png', '.json'), json.dumps(alignment_figure_metadata, indent = 5))
+    images.finish_stage('qc_plot')
+
+    #Wait for every output to be written before the session is done
+    profiler.start_stage('flush_outputs')
+    writer.close()
+    if type(transform_directory) != type(None):
+        #The transform files written by the registration are no longer needed
+        registration.remove_transform_files(reg)
+        transform_directory.cleanup()
+    profiler.stop()
+
+    #Save the resources used by each stage
+    stage_timings_path = os.path.join(anat_out_dir, '{}_{}_desc-StageTimings.json'.format(subject_name, session_name))
+    profiler.save(stage_timings_path, extra_fields = {'Low_Memory' : low_memory})
+    peak_rss = profiler.get_peak_rss_mb()
+    if type(peak_rss) != type(None):
+        print('   Peak memory use (RSS) while processing session: {:.0f} MB'.format(peak_rss))
+    if stage_timings_in_json:
+        scalarstats_json_path = os.path.join(anat_out_dir, '{}_{}_desc-AsegROIs_scalarstats.json'.format(subject_name, session_name))
+        with open(scalarstats_json_path, 'r') as f:
+            scalarstats_metadata = json.load(f)
+        scalarstats_metadata['Stage_Timings'] = {}
+        for temp_stage, temp_timings in profiler.stages.items():
+            scalarstats_metadata['Stage_Timings'][temp_stage] = {temp_key : temp_timings[temp_key] for temp_key in ['Wall_Time_Seconds', 'CPU_Time_Seconds', 'Peak_RSS_MB']}
+        with open(scalarstats_json_path, 'w') as f:
+            json.dump(scalarstats_metadata, f, indent = 5)
+    checkpoints.write_completion_marker(session_out_dir)
+
+    return
+
+def make_registration_qc_figure(bibsnet_directory, output_directory,
+                                subject_name, session_name, qc_dpi = 400,
+                                scratch_dir = None, scratch_max_size_gb = scratch_cache.default_max_size_gb):
+    '''Make the desc-RegistrationQCAid figure for a session that was already processed
+
+    This is used to render the figures of sessions that were processed
+    with defer_qc = True. The underlay and segmentation are taken from
+    the session's desc-RegistrationQCAid.json file.
+
+    Parameters
+    ----------
+    bibsnet_directory : str
+        Path to the study-level BIBSNET directory
+    output_directory : str
+        Path to the study-level directory where output was saved
+    subject_name : str
+        Name of the subject (i.e. sub-01)
+    session_name : str
+        Name of the session (i.e. ses-01)
+    qc_dpi : int
+        Resolution of the figure
+    scratch_dir : str or None
+        Folder of the scratch cache (see calc_qmri_stats). If provided,
+        the segmentation is read from its decompressed copy.
+    scratch_max_size_gb : float
+        Size limit of the scratch cache
+
+    '''
+
+    #Be sure that different directories ends in file seperator
+    output_directory = os.path.join(output_directory, '')
+    bibsnet_directory = os.path.join(bibsnet_directory, '')
+
+    anat_out_dir = os.path.join(output_directory, subject_name, session_name, 'anat')
+    alignment_figure_output = os.path.join(anat_out_dir, '{}_{}_desc-RegistrationQCAid.png'.format(subject_name, session_name))
+    alignment_figure_json = alignment_figure_output.replace('.png', '.json')
+    if os.path.exists(alignment_figure_json) == False:
+        raise ValueError('Error: Registration QC figures can only be made for sessions that have already been processed, but no file was found at: {}'.format(alignment_figure_json))
+    with open(alignment_figure_json, 'r') as f:
+        alignment_figure_metadata = json.load(f)
+    underlay_path = os.path.join(output_directory, alignment_figure_metadata['Underlay_Path'][0].replace('bids:qmri_postproc:', '', 1))
+    segmentation_path = os.path.join(bibsnet_directory, alignment_figure_metadata['Segmentation_Path'][0].replace('bids:bibsnet:', '', 1))
+
+    if type(scratch_dir) != type(None):
+        input_cache = scratch_cache.ScratchCache(scratch_dir, max_size_gb = scratch_max_size_gb)
+    else:
+        input_cache = None
+
+    with scratch_cache.local_copy(input_cache, segmentation_path) as local_segmentation_path:
+        make_outline_overlay_underlay_plot_ribbon(underlay_path, local_segmentation_path, ap_buffer_size = 3, crop_buffer=20, num_total_images=9, dpi=qc_dpi,
+                                        underlay_cmap='Greys', linewidths=.1, output_path=alignment_figure_output, close_plot=True)
+
+    return
+
+def recalc_qmri_stats(qmri_directory, output_directory,
+                      subject_name, session_name, custom_roi_groupings = None,
+                      color_lut_path = None, low_memory = False,
+                      scratch_dir = None, scratch_max_size_gb = scratch_cache.default_max_size_gb):
+    '''Regenerate the scalarstats files of a session that was already processed
+
+    Only the segmentation that calc_qmri_stats previously registered to
+    qMRI space and the native qMRI maps are loaded, so no registration
+    or resampling is performed. The metadata (including the registration
+    quality metrics) is taken from the existing desc-AsegROIs_scalarstats.json
+    file, and all scalarstats tsv/json files are rewritten.
+
+    Parameters
+    ----------
+    qmri_directory : str
+        Path to the study-level qMRI directory
+    output_directory : str
+        Path to the study-level directory where output was saved
+    subject_name : str
+        Name of the subject to be processed (i.e. sub-01)
+    session_name : str
+        Name of the session to be processed (i.e. ses-01)
+    custom_roi_groupings : list, dict, or None
+        Paths to json files with custom groupings of regions, or
+        the output of roi_groupings.compile_roi_groupings
+    color_lut_path : str or None
+        Path to the FreeSurfer Color Look Up Table. If None, the
+        copy of the table that ships with the tool is used.
+    low_memory : bool
+        If True, only the bounding box of the segmentation's labels
+        is copied (as float32) out of the loaded images.
+    scratch_dir : str or None
+        Folder of the scratch cache (see calc_qmri_stats). If provided,
+        the qMRI maps are read from their decompressed copies.
+    scratch_max_size_gb : float
+        Size limit of the scratch cache
+
+    '''
+
+    #Be sure that different directories ends in file seperator
+    output_directory = os.path.join(output_directory, '')
+    qmri_directory = os.path.join(qmri_directory, '')
+
+    anat_out_dir = os.path.join(output_directory, subject_name, session_name, 'anat')
+    aseg_json_path = os.path.join(anat_out_dir, '{}_{}_desc-AsegROIs_scalarstats.json'.format(subject_name, session_name))
+    if os.path.exists(aseg_json_path) == False:
+        raise ValueError('Error: Statistics can only be recalculated for sessions that have already been processed, but no file was found at: {}'.format(aseg_json_path))
+    with open(aseg_json_path, 'r') as f:
+        roi_params_metadata = json.load(f)
+    #Timings of the original run do not describe the recalculated statistics
+    roi_params_metadata.pop('Stage_Timings', None)
+
+    print('   Loading registered segmentation and qMRI maps')
+    registered_segmentation_path = os.path.join(output_directory, roi_params_metadata['qMRI_Registered_Segmentation_Path'][0].replace('bids:qmri_postproc:', '', 1))
+    if type(scratch_dir) != type(None):
+        input_cache = scratch_cache.ScratchCache(scratch_dir, max_size_gb = scratch_max_size_gb)
+    else:
+        input_cache = None
+    segmentation_image = image_store.read_image(registered_segmentation_path)
+    map_images = {}
+    for temp_qmri_image in roi_params_metadata['Original_qMRI_Images']:
+        temp_qmri_path = os.path.join(qmri_directory, temp_qmri_image.replace('bids:qmri:', '', 1))
+        for temp_qmri_map in ['T1', 'T2', 'PD']:
+            if temp_qmri_path.endswith('{}map.nii.gz'.format(temp_qmri_map)):
+                map_images[temp_qmri_map] = image_store.read_image(temp_qmri_path, scratch_cache = input_cache)
+    if segmentation_image.shape != next(iter(map_images.values())).shape:
+        raise ValueError('Error: The registered segmentation at {} does not have the same dimensions as the qMRI maps.'.format(registered_segmentation_path))
+    if low_memory:
+        segmentation_arr, maps_array_dict = roi_stats.crop_to_labels(segmentation_image.view(), {temp_key : temp_image.view() for temp_key, temp_image in map_images.items()})
+    else:
+        segmentation_arr = segmentation_image.numpy()
+        maps_array_dict = {temp_key : temp_image.numpy() for temp_key, temp_image in map_images.items()}
+    del segmentation_image, map_images
+
+    save_roi_stats(maps_array_dict, segmentation_arr, roi_params_metadata,
+                   anat_out_dir, subject_name, session_name, custom_roi_groupings = custom_roi_groupings,
+                   color_lut_path = color_lut_path)
+
+    return
@@ -0,0 +1,265 @@
+#!/usr/local/bin/python3
+import re
+import numpy as np
+import roi_stats
+
+#Levels (fractions of the voxels in a region) at which the quantiles of each
+#region/map are stored. With steps of 0.1%, the median and the 1/99 percentiles
+#fall exactly on stored levels, and other percentiles are interpolated.
+quantile_levels = np.linspace(0, 1, 1001)
+
+#Statistics (besides the <p>-percentile and TrimmedMean-<p> families)
+#that can be derived from a sketch
+derived_stat_names = ['Mean', 'Std', 'Median', 'Min', 'Max', 'IQR', 'Mode', 'Skewness', 'Kurtosis']
+
+#Forms of the statistics with a parameter, i.e. 25-percentile or TrimmedMean-10
+percentile_pattern = re.compile(r'^([0-9]+(\.[0-9]+)?)-percentile$')
+trimmed_mean_pattern = re.compile(r'^TrimmedMean-([0-9]+(\.[0-9]+)?)$')
+
+
+def calc_label_sketches(sorted_values, label_index, region_names = None):
+    '''Summarize the distribution of every map within every segmentation label
+
+    For each label and map, the quantiles at quantile_levels (calculated
+    the same way as numpy.percentile) and the mean and sums of the 2nd to
+    4th powers of the deviations from the mean are stored. These can be
+    combined across labels (see merge_sketches), so that statistics that
+    were not calculated during processing can later be derived for any
+    region or grouping of regions without loading the images again.
+
+    Parameters
+    ----------
+    sorted_values : dict
+        output of roi_stats.sort_maps_by_label, with the values of
+        each map sorted within every label
+    label_index : dict
+        output of roi_stats.build_label_index for the segmentation
+    region_names : list or None
+        name of each label in label_index['labels']
+
+    Returns
+    -------
+    sketches : dict
+        dictionary with the labels ('labels'), their names ('region_names'),
+        their number of voxels ('voxel_counts'), the map names ('maps'),
+        the quantile levels ('quantile_levels'), and for each map an array
+        of quantiles ('<map>_quantiles', labels x levels) and of moments
+        ('<map>_moments', labels x [mean, sums of 2nd/3rd/4th powers
+        of the deviations from the mean])
+
+    '''
+
+    labels = np.asarray(label_index['labels'])
+    voxel_counts = np.asarray(label_index['stops']) - np.asarray(label_index['starts'])
+    if type(region_names) == type(None):
+        region_names = [str(temp_label) for temp_label in labels.tolist()]
+    sketches = {'labels' : labels.astype(np.int64),
+                'region_names' : np.asarray(region_names, dtype = str),
+                'voxel_counts' : voxel_counts.astype(np.int64),
+                'maps' : np.asarray(list(sorted_values.keys()), dtype = str),
+                'quantile_levels' : quantile_levels}
+    for temp_image_type in sorted_values.keys():
+        temp_quantiles = np.zeros((labels.shape[0], quantile_levels.shape[0]), dtype = np.float32)
+        temp_moments = np.zeros((labels.shape[0], 4), dtype = np.float64)
+        for i, (start, stop) in enumerate(zip(label_index['starts'].tolist(), label_index['stops'].tolist())):
+            temp_vals = sorted_values[temp_image_type][start:stop].astype(np.float64)
+            temp_quantiles[i] = roi_stats.interpolate_sorted(temp_vals, quantile_levels)
+            temp_mean = np.mean(temp_vals)
+            temp_deviations = temp_vals - temp_mean
+            temp_squared_deviations = temp_deviations*temp_deviations
+            temp_moments[i] = [temp_mean, np.sum(temp_squared_deviations),
+                               np.sum(temp_squared_deviations*temp_deviations),
+                               np.sum(temp_squared_deviations*temp_squared_deviations)]
+        sketches[temp_image_type + '_quantiles'] = temp_quantiles
+        sketches[temp_image_type + '_moments'] = temp_moments
+
+    return sketches
+
+
+def save_sketches(sketches, output_path):
+    '''Save the output of calc_label_sketches to a compressed npz file'''
+
+    np.savez_compressed(output_path, **sketches)
+
+    return
+
+
+def load_sketches(sketch_path):
+    '''Load sketches saved with save_sketches'''
+
+    with np.load(sketch_path, allow_pickle = False) as f:
+        sketches = {temp_key : f[temp_key] for temp_key in f.files}
+
+    return sketches
+
+
+def merge_sketches(voxel_counts, moments, quantiles):
+    '''Combine the sketches of several labels into the sketch of the region they make up together
+
+    The moments are combined exactly. The quantiles are found by inverting
+    the voxel count weighted average of the labels' (piecewise linear)
+    cumulative distributions, so they are close to, but not always exactly
+    equal to, the quantiles of the combined voxels.
+
+    Parameters
+    ----------
+    voxel_counts : numpy.ndarray
+        number of voxels of each label
+    moments : numpy.ndarray
+        labels x [mean, sums of 2nd/3rd/4th powers of deviations]
+    quantiles : numpy.ndarray
+        labels x quantile levels
+
+    Returns
+    -------
+    voxel_count : int
+    moments : numpy.ndarray
+    quantiles : numpy.ndarray
+
+    '''
+
+    keep = voxel_counts > 0
+    voxel_counts, moments, quantiles = voxel_counts[keep], moments[keep], quantiles[keep]
+    if voxel_counts.shape[0] == 0:
+        return 0, np.full(4, np.nan), np.full(quantile_levels.shape[0], np.nan)
+    elif voxel_counts.shape[0] == 1:
+        return int(voxel_counts[0]), moments[0], quantiles[0]
+
+    #Sums of powers of deviations from the combined mean
+    voxel_count = np.sum(voxel_counts)
+    merged_mean = np.sum(voxel_counts*moments[:, 0])/voxel_count
+    d = moments[:, 0] - merged_mean
+    m2, m3, m4 = moments[:, 1], moments[:, 2], moments[:, 3]
+    merged_moments = np.array([merged_mean,
+                               np.sum(m2 + voxel_counts*d**2),
+                               np.sum(m3 + 3*d*m2 + voxel_counts*d**3),
+                               np.sum(m4 + 4*d*m3 + 6*d**2*m2 + voxel_counts*d**4)])
+
+    #Invert the combined cumulative distribution
+    values = np.unique(quantiles.astype(np.float64))
+    cumulative = np.zeros(values.shape[0])
+    for temp_count, temp_quantiles in zip(voxel_counts.tolist(), quantiles.astype(np.float64)):
+        cumulative += temp_count*np.interp(values, temp_quantiles, quantile_levels, left = 0, right = 1)
+    cumulative = cumulative/voxel_count
+    merged_quantiles = np.interp(quantile_levels, cumulative, values)
+
+    return int(voxel_count), merged_moments, merged_quantiles
+
+
+def check_stat_names(stat_names):
+    '''Check that every statistic can be derived from a sketch (raises ValueError otherwise)'''
+
+    problems = []
+    for temp_name in stat_names:
+        percentile_match = percentile_pattern.match(temp_name)
+        trimmed_mean_match = trimmed_mean_pattern.match(temp_name)
+        if temp_name in derived_stat_names:
+            continue
+        elif type(percentile_match) != type(None):
+            if float(percentile_match.group(1)) > 100:
+                problems.append('{}: percentiles must be between 0 and 100'.format(temp_name))
+        elif type(trimmed_mean_match) != type(None):
+            if float(trimmed_mean_match.group(1)) >= 50:
+                problems.append('{}: the percent trimmed from each tail must be below 50'.format(temp_name))
+        else:
+            problems.append(temp_name)
+    if len(problems):
+        raise ValueError('Error: The following statistics can not be derived: {}. Statistics must be one of {}, <p>-percentile (i.e. 25-percentile), or TrimmedMean-<p> (i.e. TrimmedMean-10, which trims p percent from each tail).'.format(', '.join(problems), ', '.join(derived_stat_names)))
+
+    return
+
+
+def get_quantiles(quantiles, levels):
+    '''Interpolate sketch quantiles (regions x quantile_levels) at other levels (returns regions x levels)'''
+
+    positions = np.asarray(levels, dtype = np.float64)*(quantile_levels.shape[0] - 1)
+    below = np.minimum(np.floor(positions).astype(int), quantile_levels.shape[0] - 2)
+    fractions = positions - below
+
+    return quantiles[:, below] + (quantiles[:, below + 1] - quantiles[:, below])*fractions
+
+
+def get_half_sample_mode(quantiles):
+    '''Estimate the mode of each region by repeatedly keeping the shortest interval that holds half of the voxels'''
+
+    rows = np.arange(quantiles.shape[0])
+    lower = np.zeros(quantiles.shape[0], dtype = int)
+    span = quantiles.shape[1] - 1
+    while span > 2:
+        width = span//2
+        offsets = np.arange(span - width + 1)
+        interval_lengths = quantiles[rows[:, None], lower[:, None] + offsets + width] - quantiles[rows[:, None], lower[:, None] + offsets]
+        lower = lower + np.argmin(interval_lengths, axis = 1)
+        span = width
+
+    return (quantiles[rows, lower] + quantiles[rows, lower + span])/2
+
+
+def calc_derived_stats(voxel_counts, moments, quantiles, stat_names):
+    '''Derive statistics for many regions from their sketches
+
+    Parameters
+    ----------
+    voxel_counts : numpy.ndarray
+        number of voxels of each region
+    moments : numpy.ndarray
+        regions x [mean, sums of 2nd/3rd/4th powers of deviations]
+    quantiles : numpy.ndarray
+        regions x quantile_levels
+    stat_names : list
+        statistics to derive (see check_stat_names). Std is the
+        population standard deviation (as numpy.std), and Kurtosis
+        is the excess kurtosis.
+
+    Returns
+    -------
+    derived_stats : dict
+        dictionary with one array (one value per region) for each
+        statistic. Regions without voxels get NaN.
+
+    '''
+
+    voxel_counts = np.asarray(voxel_counts, dtype = np.float64)
+    quantiles = np.asarray(quantiles, dtype = np.float64)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        variance = moments[:, 1]/voxel_counts
+        derived_stats = {}
+        for temp_name in stat_names:
+            percentile_match = percentile_pattern.match(temp_name)
+            trimmed_mean_match = trimmed_mean_pattern.match(temp_name)
+            if temp_name == 'Mean':
+                derived_stats[temp_name] = moments[:, 0].copy()
+            elif temp_name == 'Std':
+                derived_stats[temp_name] = np.sqrt(variance)
+            elif temp_name == 'Median':
+                derived_stats[temp_name] = get_quantiles(quantiles, [0.5])[:, 0]
+            elif temp_name == 'Min':
+                derived_stats[temp_name] = quantiles[:, 0].copy()
+            elif temp_name == 'Max':
+                derived_stats[temp_name] = quantiles[:, -1].copy()
+            elif temp_name == 'IQR':
+                temp_quartiles = get_quantiles(quantiles, [0.25, 0.75])
+                derived_stats[temp_name] = temp_quartiles[:, 1] - temp_quartiles[:, 0]
+            elif temp_name == 'Mode':
+                derived_stats[temp_name] = get_half_sample_mode(quantiles)
+            elif temp_name == 'Skewness':
+                derived_stats[temp_name] = (moments[:, 2]/voxel_counts)/variance**1.5
+            elif temp_name == 'Kurtosis':
+                derived_stats[temp_name] = (moments[:, 3]/voxel_counts)/variance**2 - 3
+            elif type(percentile_match) != type(None):
+                derived_stats[temp_name] = get_quantiles(quantiles, [float(percentile_match.group(1))/100])[:, 0]
+            elif type(trimmed_mean_match) != type(None):
+                #Average of the quantile function between the trimmed levels
+                trim = float(trimmed_mean_match.group(1))/100
+                inner_levels = quantile_levels[(quantile_levels > trim) & (quantile_levels < 1 - trim)]
+                temp_levels = np.concatenate(([trim], inner_levels, [1 - trim]))
+                temp_quantiles = get_quantiles(quantiles, temp_levels)
+                temp_areas = (temp_quantiles[:, 1:] + temp_quantiles[:, :-1])/2*np.diff(temp_levels)
+                derived_stats[temp_name] = np.sum(temp_areas, axis = 1)/(1 - 2*trim)
+            else:
+                check_stat_names([temp_name])
+    empty = voxel_counts == 0
+    for temp_name in derived_stats.keys():
+        derived_stats[temp_name][empty] = np.nan
+
+    return derived_stats
@@ -0,0 +1,355 @@
+#!/usr/local/bin/python3
+import os, time, shutil, itertools
+import numpy as np
+
+#Settings for each registration profile. The standard profile uses ANTs'
+#default multi-resolution settings on the full images (as in previous
+#versions of the tool), so that existing results can be reproduced. The
+#other profiles restrict both images to the bounding box of the registration
+#mask before registering.
+registration_profiles = {'fast' : {'crop_to_mask' : True,
+                                   'aff_shrink_factors' : (8, 4, 2),
+                                   'aff_smoothing_sigmas' : (3, 2, 1),
+                                   'aff_iterations' : (1000, 500, 100),
+                                   'aff_random_sampling_rate' : 0.1},
+                         'standard' : {'crop_to_mask' : False},
+                         'accurate' : {'crop_to_mask' : True,
+                                       'aff_shrink_factors' : (6, 4, 2, 1),
+                                       'aff_smoothing_sigmas' : (3, 2, 1, 0),
+                                       'aff_iterations' : (2100, 1200, 1200, 200),
+                                       'aff_random_sampling_rate' : 0.5}}
+
+default_registration_profile = 'standard'
+
+#Settings of the quick (low resolution) rigid registration that the adaptive
+#registration tries before falling back to the full registration
+quick_rigid_settings = {'crop_to_mask' : True,
+                        'aff_shrink_factors' : (6, 4),
+                        'aff_smoothing_sigmas' : (3, 2),
+                        'aff_iterations' : (500, 200),
+                        'aff_random_sampling_rate' : 0.2}
+
+#Alignment score (voxel correlation within the brain mask) that a step
+#of the adaptive registration needs to reach to be accepted
+default_adaptive_threshold = 0.85
+
+
+def get_mask_bounding_box(mask_image, margin = 0):
+    '''Get the index bounding box of the nonzero voxels of a mask
+
+    Parameters
+    ----------
+    mask_image : ants.ANTsImage
+        mask image
+    margin : int
+        number of voxels to pad the box with on each side
+
+    Returns
+    -------
+    lower_inds : tuple or None
+        first index of the box along each axis, or None if the mask is empty
+    upper_inds : tuple or None
+        index after the last index of the box along each axis
+
+    '''
+
+    foreground_inds = np.nonzero(mask_image.numpy() > 0.5)
+    if foreground_inds[0].shape[0] == 0:
+        return None, None
+    lower_inds = []
+    upper_inds = []
+    for i in range(mask_image.dimension):
+        lower_inds.append(max(int(np.min(foreground_inds[i])) - margin, 0))
+        upper_inds.append(min(int(np.max(foreground_inds[i])) + margin + 1, mask_image.shape[i]))
+
+    return tuple(lower_inds), tuple(upper_inds)
+
+
+def get_overlapping_bounding_box(reference_image, lower_inds, upper_inds, target_image, min_size = 8):
+    '''Find the box in one image that covers the physical extent of a box in another image
+
+    Parameters
+    ----------
+    reference_image : ants.ANTsImage
+        image the box was defined in
+    lower_inds : tuple
+        first index of the box in reference_image
+    upper_inds : tuple
+        index after the last index of the box in reference_image
+    target_image : ants.ANTsImage
+        image to find the corresponding box in
+    min_size : int
+        minimum number of voxels along each axis for the
+        box to be considered valid
+
+    Returns
+    -------
+    target_lower_inds : tuple or None
+        first index of the box in target_image, or None if the
+        box does not sufficiently overlap the target image
+    target_upper_inds : tuple or None
+        index after the last index of the box in target_image
+
+    '''
+
+    import ants
+
+    corner_inds = []
+    for temp_corner in itertools.product(*[(temp_lower, temp_upper - 1) for temp_lower, temp_upper in zip(lower_inds, upper_inds)]):
+        temp_point = ants.transform_index_to_physical_point(reference_image, list(temp_corner))
+        corner_inds.append(ants.transform_physical_point_to_index(target_image, list(temp_point)))
+    corner_inds = np.array(corner_inds)
+    target_lower_inds = np.maximum(np.floor(np.min(corner_inds, axis = 0)).astype(int), 0)
+    target_upper_inds = np.minimum(np.ceil(np.max(corner_inds, axis = 0)).astype(int) + 1, np.array(target_image.shape))
+    if np.any((target_upper_inds - target_lower_inds) < min_size):
+        return None, None
+
+    return tuple(target_lower_inds.tolist()), tuple(target_upper_inds.tolist())
+
+
+def run_registration(fixed, moving, mask, registration_type = 'Rigid', registration_metric = 'mattes',
+                     crop_to_mask = False, **registration_settings):
+    '''Run ants.registration, optionally restricting both images to the bounding box of the mask
+
+    Parameters
+    ----------
+    fixed : ants.ANTsImage
+        anatomical reference image
+    moving : ants.ANTsImage
+        image to register to the anatomical reference
+    mask : ants.ANTsImage
+        mask (in the space of the fixed image) that defines where
+        the registration metric is evaluated
+    registration_type : str
+        Type of ANTs registration (Rigid, Similarity, or Affine)
+    registration_metric : str
+        Metric used by ANTs for the registration (mattes, GC, or meansquares)
+    crop_to_mask : bool
+        if True, both images are cropped to the bounding box of the mask
+    registration_settings
+        other arguments passed to ants.registration (i.e. aff_iterations)
+
+    Returns
+    -------
+    reg : dict
+        output of ants.registration. If the images were cropped, the
+        'warpedmovout' image is regenerated in the full space of the
+        fixed image.
+    registration_info : dict
+        information about the registration, including its runtime
+        and the boxes the images were cropped to
+
+    '''
+
+    import ants
+
+    start_time = time.time()
+    registration_info = {'Registration_Cropped_To_Mask' : False}
+    fixed_for_reg = fixed
+    moving_for_reg = moving
+    mask_for_reg = mask
+    if crop_to_mask:
+        lower_inds, upper_inds = get_mask_bounding_box(mask)
+        if type(lower_inds) != type(None):
+            moving_lower_inds, moving_upper_inds = get_overlapping_bounding_box(fixed, lower_inds, upper_inds, moving)
+            fixed_for_reg = ants.crop_indices(fixed, lower_inds, upper_inds)
+            mask_for_reg = ants.crop_indices(mask, lower_inds, upper_inds)
+            registration_info['Registration_Cropped_To_Mask'] = True
+            registration_info['Registration_Fixed_Shape'] = list(fixed_for_reg.shape)
+            if type(moving_lower_inds) != type(None):
+                moving_for_reg = ants.crop_indices(moving, moving_lower_inds, moving_upper_inds)
+            registration_info['Registration_Moving_Shape'] = list(moving_for_reg.shape)
+
+    reg = ants.registration(fixed=fixed_for_reg, moving=moving_for_reg, mask=mask_for_reg, type_of_transform=registration_type,
+                            aff_metric=registration_metric, **registration_settings)
+    if registration_info['Registration_Cropped_To_Mask']:
+        reg['warpedmovout'] = ants.apply_transforms(fixed, moving, reg['fwdtransforms'])
+    registration_info['Registration_Runtime_Seconds'] = time.time() - start_time
+
+    return reg, registration_info
+
+
+def register_to_reference(fixed, moving, mask, registration_type = 'Rigid', registration_metric = 'mattes',
+                          registration_profile = default_registration_profile):
+    '''Register an image to an anatomical reference using a registration profile
+
+    Parameters
+    ----------
+    fixed : ants.ANTsImage
+        anatomical reference image
+    moving : ants.ANTsImage
+        image to register to the anatomical reference
+    mask : ants.ANTsImage
+        mask (in the space of the fixed image) that defines where
+        the registration metric is evaluated
+    registration_type : str
+        Type of ANTs registration (Rigid, Similarity, or Affine)
+    registration_metric : str
+        Metric used by ANTs for the registration (mattes, GC, or meansquares)
+    registration_profile : str
+        one of the keys of registration_profiles (fast, standard, accurate)
+
+    Returns
+    -------
+    reg : dict
+        output of ants.registration. If the images were cropped, the
+        'warpedmovout' image is regenerated in the full space of the
+        fixed image.
+    registration_info : dict
+        information about the registration, including its runtime
+        and the boxes the images were cropped to
+
+    '''
+
+    if registration_profile not in registration_profiles.keys():
+        raise ValueError('Error: Registration profile must be one of {}, but {} was provided'.format(list(registration_profiles.keys()), registration_profile))
+
+    reg, registration_info = run_registration(fixed, moving, mask, registration_type = registration_type,
+                                              registration_metric = registration_metric,
+                                              **registration_profiles[registration_profile])
+    registration_info = dict({'Registration_Profile' : registration_profile}, **registration_info)
+
+    return reg, registration_info
+
+
+def score_alignment(fixed, warped_moving, mask):
+    '''Correlation of voxel intensities between the fixed image and the warped moving image within a mask'''
+
+    #Only the voxels within the mask are copied out of the images
+    mask_inds = mask.view() > 0.5
+
+    return np.corrcoef(warped_moving.view()[mask_inds], fixed.view()[mask_inds])[0,1]
+
+
+def make_identity_transform(transform_path, dimension = 3):
+    '''Write an identity transform to transform_path (in the format ants.registration writes its transforms)'''
+
+    import ants
+
+    transform = ants.create_ants_transform(transform_type = 'AffineTransform', dimension = dimension)
+    ants.write_transform(transform, transform_path)
+
+    return transform_path
+
+
+def remove_transform_files(reg):
+    '''Remove the transform files written by a registration (i.e. the temporary files of ants.registration)'''
+
+    for temp_path in set(reg['fwdtransforms'] + reg['invtransforms']):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return
+
+
+def move_transform_files(reg, transform_directory):
+    '''Move the transform files written by a registration into transform_directory
+
+    Returns
+    -------
+    fwdtransforms : list
+        paths of the forward transforms in transform_directory
+
+    '''
+
+    new_paths = {}
+    for temp_path in reg['fwdtransforms'] + reg['invtransforms']:
+        if temp_path in new_paths or os.path.dirname(os.path.abspath(temp_path)) == os.path.abspath(transform_directory):
+            continue
+        new_paths[temp_path] = shutil.move(temp_path, os.path.join(transform_directory, os.path.basename(temp_path)))
+
+    return [new_paths.get(temp_path, temp_path) for temp_path in reg['fwdtransforms']]
+
+
+def register_adaptively(fixed, moving, mask, score_mask, transform_directory, registration_type = 'Rigid', registration_metric = 'mattes',
+                        registration_profile = default_registration_profile,
+                        threshold = default_adaptive_threshold):
+    '''Register an image to an anatomical reference, only running the full registration when needed
+
+    The qMRI and anatomical images usually come from the same scan session,
+    so they are often already close to aligned in scanner space. The steps
+    below are tried in order, and the first one whose alignment score (the
+    voxel correlation within score_mask, see score_alignment) reaches the
+    threshold is used:
+
+    1. identity: the alignment given by the image headers
+    2. quick_rigid: a low resolution rigid registration (see quick_rigid_settings)
+    3. full: the registration given by registration_type/registration_profile,
+       which is used regardless of its score
+
+    Parameters
+    ----------
+    fixed : ants.ANTsImage
+        anatomical reference image
+    moving : ants.ANTsImage
+        image to register to the anatomical reference
+    mask : ants.ANTsImage
+        mask (in the space of the fixed image) that defines where
+        the registration metric is evaluated
+    score_mask : ants.ANTsImage
+        mask (in the space of the fixed image) used to score each step
+    transform_directory : str
+        existing directory (owned by the caller) that the identity
+        transform is written to. The transform files of the steps that
+        are not selected are removed.
+    registration_type : str
+        Type of ANTs registration (Rigid, Similarity, or Affine) of the full registration
+    registration_metric : str
+        Metric used by ANTs for the registration (mattes, GC, or meansquares)
+    registration_profile : str
+        one of the keys of registration_profiles (fast, standard, accurate)
+        used for the full registration
+    threshold : float
+        score a step needs to reach to be accepted
+
+    Returns
+    -------
+    reg : dict
+        dictionary with 'fwdtransforms', 'invtransforms', and 'warpedmovout'
+        (as returned by ants.registration) for the accepted step
+    registration_info : dict
+        information about the registration, including the steps that
+        were tried (Registration_Adaptive_Path), their scores
+        (Registration_Adaptive_Scores), and the total runtime
+
+    '''
+
+    import ants
+
+    if registration_profile not in registration_profiles.keys():
+        raise ValueError('Error: Registration profile must be one of {}, but {} was provided'.format(list(registration_profiles.keys()), registration_profile))
+
+    start_time = time.time()
+    scores = {}
+    identity_path = make_identity_transform(os.path.join(transform_directory, 'identity.mat'), fixed.dimension)
+    reg = {'fwdtransforms' : [identity_path],
+           'invtransforms' : [identity_path],
+           'warpedmovout' : ants.apply_transforms(fixed, moving, [identity_path])}
+    registration_info = {'Registration_Profile' : registration_profile,
+                         'Registration_Cropped_To_Mask' : False}
+    scores['identity'] = score_alignment(fixed, reg['warpedmovout'], score_mask)
+    print('      Alignment score of the image headers (identity): {:.4f}'.format(scores['identity']))
+
+    if scores['identity'] < threshold:
+        remove_transform_files(reg)
+        reg, step_info = run_registration(fixed, moving, mask, registration_type = 'Rigid',
+                                          registration_metric = registration_metric, **quick_rigid_settings)
+        registration_info = dict({'Registration_Profile' : registration_profile}, **step_info)
+        scores['quick_rigid'] = score_alignment(fixed, reg['warpedmovout'], score_mask)
+        print('      Alignment score of the quick rigid registration: {:.4f}'.format(scores['quick_rigid']))
+
+        if scores['quick_rigid'] < threshold:
+            print('      Running the full registration')
+            remove_transform_files(reg)
+            reg, registration_info = register_to_reference(fixed, moving, mask, registration_type = registration_type,
+                                                           registration_metric = registration_metric,
+                                                           registration_profile = registration_profile)
+            scores['full'] = score_alignment(fixed, reg['warpedmovout'], score_mask)
+
+    registration_info['Registration_Adaptive_Threshold'] = threshold
+    registration_info['Registration_Adaptive_Path'] = list(scores.keys())
+    registration_info['Registration_Adaptive_Scores'] = {temp_step : float(temp_score) for temp_step, temp_score in scores.items()}
+    registration_info['Registration_Adaptive_Selected_Step'] = list(scores.keys())[-1]
+    registration_info['Registration_Runtime_Seconds'] = time.time() - start_time
+
+    return reg, registration_info
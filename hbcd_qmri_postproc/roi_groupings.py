@@ -0,0 +1,108 @@
+#!/usr/local/bin/python3
+import json
+import numpy as np
+
+
+def compile_roi_groupings(grouping_json_paths, freesurfer_color_lut):
+    '''Compile custom region grouping jsons into a label to group lookup table
+
+    All grouping files are resolved against the FreeSurfer Color LUT
+    once, and combined into a single dense lookup table whose rows are
+    segmentation labels and whose columns are groups (from all files).
+    Since a label can belong to any number of groups, overlapping groups
+    are supported. Every region name is checked while compiling, so that
+    invalid files are rejected before any processing starts.
+
+    Parameters
+    ----------
+    grouping_json_paths : list
+        paths to json files whose keys are group names and whose
+        values are lists of region names from the FreeSurfer Color LUT
+    freesurfer_color_lut : color_lut.ColorLUT
+        output of color_lut.load_color_lut
+
+    Returns
+    -------
+    compiled_groupings : dict
+        dictionary with the names of all groups ('group_names'), the
+        boolean lookup table with shape (max label + 1, number of groups)
+        ('label_to_groups'), and a list with one entry per grouping
+        file ('grouping_files'). Each entry has the path to the file
+        ('path'), the name used for the output files ('name'), the
+        contents of the json ('groupings'), and the start/stop columns of
+        the file's groups in the lookup table ('columns').
+
+    '''
+
+    compiled_groupings = {'group_names' : [], 'grouping_files' : []}
+    group_labels = []
+    problems = []
+    for temp_grouping_path in grouping_json_paths:
+        try:
+            with open(temp_grouping_path, 'r') as f:
+                temp_groupings = json.load(f)
+        except (OSError, ValueError) as e:
+            problems.append('{}: unable to load json ({})'.format(temp_grouping_path, e))
+            continue
+        if type(temp_groupings) != dict:
+            problems.append('{}: expected a json object whose keys are group names'.format(temp_grouping_path))
+            continue
+        start = len(compiled_groupings['group_names'])
+        for temp_grouping in temp_groupings.keys():
+            temp_regions = temp_groupings[temp_grouping]
+            if type(temp_regions) != list or len(temp_regions) == 0:
+                problems.append('{}: group "{}" must be a non-empty list of region names'.format(temp_grouping_path, temp_grouping))
+                continue
+            temp_labels = []
+            for temp_region in temp_regions:
+                temp_label = freesurfer_color_lut.get_number(temp_region)
+                if type(temp_label) != type(None):
+                    temp_labels.append(temp_label)
+                else:
+                    problems.append('{}: region "{}" in group "{}" was not found in the FreeSurfer Color LUT'.format(temp_grouping_path, temp_region, temp_grouping))
+            compiled_groupings['group_names'].append(temp_grouping)
+            group_labels.append(temp_labels)
+        compiled_groupings['grouping_files'].append({'path' : temp_grouping_path,
+                                                     'name' : temp_grouping_path.split('/')[-1].replace('.json', ''),
+                                                     'groupings' : temp_groupings,
+                                                     'columns' : (start, len(compiled_groupings['group_names']))})
+    if len(problems):
+        raise ValueError('Error: The following problems were found in the region groupings json files:\n   ' + '\n   '.join(problems))
+
+    label_to_groups = np.zeros((freesurfer_color_lut.number_to_index.shape[0], len(group_labels)), dtype = bool)
+    for i, temp_labels in enumerate(group_labels):
+        label_to_groups[temp_labels, i] = True
+    compiled_groupings['label_to_groups'] = label_to_groups
+
+    return compiled_groupings
+
+
+def get_group_labels(compiled_groupings, label_index):
+    '''Get the labels of the segmentation that belong to every group of the compiled groupings
+
+    Parameters
+    ----------
+    compiled_groupings : dict
+        output of compile_roi_groupings
+    label_index : dict
+        output of roi_stats.build_label_index for the segmentation
+
+    Returns
+    -------
+    group_labels : list
+        array with the labels found in the segmentation for each
+        group, in the same order as compiled_groupings['group_names']
+
+    '''
+
+    label_to_groups = compiled_groupings['label_to_groups']
+    present_labels = np.asarray(label_index['labels'])
+    in_table = (present_labels >= 0) & (present_labels < label_to_groups.shape[0]) & (present_labels == np.round(present_labels))
+    membership = np.zeros((present_labels.shape[0], label_to_groups.shape[1]), dtype = bool)
+    membership[in_table] = label_to_groups[present_labels[in_table].astype(int)]
+
+    group_labels = []
+    for i in range(label_to_groups.shape[1]):
+        group_labels.append(present_labels[membership[:, i]])
+
+    return group_labels
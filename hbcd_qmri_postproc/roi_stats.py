@@ -0,0 +1,280 @@
+#!/usr/local/bin/python3
+import numpy as np
+
+#The summary statistics that are calculated for every region/map
+measure_types = ['Mean', 'Median', '1-percentile', '99-percentile', 'Std']
+
+
+def build_label_index(segmentation_arr, exclude_zero = True):
+    '''Group the voxels of a segmentation by label in a single pass
+
+    The voxels are ordered by label with one stable sort, so that
+    the voxels belonging to any label can later be accessed (and their
+    values sorted, see sort_label_values) without building a full-volume
+    mask. Because the sort is stable, the voxels within a label stay in
+    the same (C) order that boolean mask indexing would produce.
+
+    Parameters
+    ----------
+    segmentation_arr : numpy.ndarray
+        array with one label per voxel
+    exclude_zero : bool
+        if True, voxels with label 0 are not included in the index
+
+    Returns
+    -------
+    label_index : dict
+        dictionary with the flat voxel indices ordered by label ('order'),
+        the unique labels ('labels'), the start/stop positions of each
+        label within 'order' ('starts', 'stops'), and a dictionary mapping
+        each label to its (start, stop) positions ('positions')
+
+    '''
+
+    flat_segmentation = np.ravel(segmentation_arr)
+    if exclude_zero:
+        voxel_inds = np.flatnonzero(flat_segmentation)
+        order = voxel_inds[np.argsort(flat_segmentation[voxel_inds], kind = 'stable')]
+    else:
+        order = np.argsort(flat_segmentation, kind = 'stable')
+    sorted_labels = flat_segmentation[order]
+    if sorted_labels.shape[0] == 0:
+        starts = np.zeros(0, dtype = int)
+    else:
+        starts = np.concatenate(([0], np.flatnonzero(sorted_labels[1:] != sorted_labels[:-1]) + 1))
+    stops = np.append(starts[1:], sorted_labels.shape[0])
+    labels = sorted_labels[starts]
+
+    label_index = {'order' : order,
+                   'labels' : labels,
+                   'starts' : starts,
+                   'stops' : stops,
+                   'positions' : dict(zip(labels.tolist(), zip(starts.tolist(), stops.tolist())))}
+
+    return label_index
+
+
+def sort_label_values(map_arr, label_index):
+    '''Sort the values of a map within every label of a segmentation in a single pass
+
+    The voxels of every label are gathered in the order given by
+    build_label_index, and the values of each label are then sorted in
+    place, so that they form a sorted run at the same start/stop
+    positions as in label_index. Any statistic of a label
+    (or group of labels) can then be read from these runs without
+    partitioning or sorting the label's values again.
+
+    Parameters
+    ----------
+    map_arr : numpy.ndarray
+        array with the values of a quantitative map. Must have the
+        same shape as the segmentation used to make label_index.
+    label_index : dict
+        output of build_label_index
+
+    Returns
+    -------
+    sorted_vals : numpy.ndarray
+        the values of the labelled voxels, sorted within each label
+
+    '''
+
+    #Sorting each label on its own is much faster than a lexsort by (label, value)
+    sorted_vals = np.ravel(map_arr)[label_index['order']]
+    for start, stop in zip(label_index['starts'].tolist(), label_index['stops'].tolist()):
+        sorted_vals[start:stop].sort()
+
+    return sorted_vals
+
+
+def sort_maps_by_label(maps_array_dict, label_index):
+    '''Sort the values of every map within every label (see sort_label_values)
+
+    Returns
+    -------
+    sorted_values : dict
+        dictionary whose keys are the map names and whose
+        values are the outputs of sort_label_values
+
+    '''
+
+    return {temp_image_type : sort_label_values(maps_array_dict[temp_image_type], label_index) for temp_image_type in maps_array_dict.keys()}
+
+
+def interpolate_sorted(sorted_vals, levels):
+    '''Get the quantiles of sorted values at the provided levels (linear interpolation, as in numpy.percentile)'''
+
+    positions = levels*(sorted_vals.shape[0] - 1)
+    below = np.floor(positions).astype(int)
+    above = np.minimum(below + 1, sorted_vals.shape[0] - 1)
+    fractions = positions - below
+
+    return sorted_vals[below] + (sorted_vals[above] - sorted_vals[below])*fractions
+
+
+def calc_roi_stats(sorted_vals, label_index, label_groups):
+    '''Calculate summary statistics from one map for many regions
+
+    The mean and standard deviation of each label come from sums over
+    its run of sorted values, and are combined exactly for regions made
+    of several labels. The median and 1/99 percentiles are interpolated
+    (as in numpy.percentile) from the sorted run of the region's values.
+
+    Parameters
+    ----------
+    sorted_vals : numpy.ndarray
+        output of sort_label_values for the map
+    label_index : dict
+        output of build_label_index
+    label_groups : list
+        list with the labels that make up each region. Labels not
+        found in the segmentation are ignored.
+
+    Returns
+    -------
+    map_stats : dict
+        dictionary with one list per entry in measure_types, with
+        one value per region. Regions without voxels get NaN.
+
+    '''
+
+    #Statistics are calculated in double precision and stored with
+    #the precision of the map (as numpy.mean would return them)
+    if np.issubdtype(sorted_vals.dtype, np.floating):
+        output_dtype = sorted_vals.dtype
+    else:
+        output_dtype = np.float64
+    starts = np.asarray(label_index['starts'])
+    stops = np.asarray(label_index['stops'])
+    counts = stops - starts
+    vals = sorted_vals.astype(np.float64)
+    if counts.shape[0]:
+        means = np.add.reduceat(vals, starts)/counts
+        deviations = vals - np.repeat(means, counts)
+        squared_deviations = np.add.reduceat(deviations*deviations, starts)
+    else:
+        means = np.zeros(0)
+        squared_deviations = np.zeros(0)
+    run_inds = {temp_label : i for i, temp_label in enumerate(label_index['labels'].tolist())}
+    percentile_levels = np.array([0.5, 0.01, 0.99])
+
+    region_stats = np.full((len(label_groups), len(measure_types)), np.nan)
+    for i, temp_labels in enumerate(label_groups):
+        temp_runs = [run_inds[temp_label] for temp_label in np.unique(temp_labels).tolist() if temp_label in run_inds]
+        if len(temp_runs) == 0:
+            continue
+        elif len(temp_runs) == 1:
+            temp_vals = vals[starts[temp_runs[0]]:stops[temp_runs[0]]]
+        else:
+            #Merging the sorted runs of the labels (timsort takes advantage of the runs)
+            temp_vals = np.sort(np.concatenate([vals[starts[j]:stops[j]] for j in temp_runs]), kind = 'stable')
+        temp_counts = counts[temp_runs]
+        temp_mean = np.sum(temp_counts*means[temp_runs])/np.sum(temp_counts)
+        temp_squared_deviations = np.sum(squared_deviations[temp_runs]) + np.sum(temp_counts*(means[temp_runs] - temp_mean)**2)
+        temp_percentiles = interpolate_sorted(temp_vals, percentile_levels)
+        #NaNs are sorted last, and make every statistic NaN (as with numpy)
+        if np.isnan(temp_vals[-1]):
+            temp_percentiles[:] = np.nan
+        region_stats[i] = [temp_mean, temp_percentiles[0], temp_percentiles[1], temp_percentiles[2],
+                           np.sqrt(temp_squared_deviations/np.sum(temp_counts))]
+
+    region_stats = region_stats.astype(output_dtype)
+    map_stats = {}
+    for j, temp_measure in enumerate(measure_types):
+        map_stats[temp_measure] = list(region_stats[:, j])
+
+    return map_stats
+
+
+def calc_roi_stats_for_maps(sorted_values, label_index, label_groups):
+    '''Calculate summary statistics for every map and region
+
+    Parameters
+    ----------
+    sorted_values : dict
+        output of sort_maps_by_label
+    label_index : dict
+        output of build_label_index
+    label_groups : list
+        list with the labels that make up each region
+
+    Returns
+    -------
+    roi_params_dict : dict
+        dictionary with keys following <map>_<measure> (i.e. T1_Mean)
+        and one value per region
+
+    '''
+
+    roi_params_dict = {}
+    for temp_image_type in sorted_values.keys():
+        map_stats = calc_roi_stats(sorted_values[temp_image_type], label_index, label_groups)
+        for temp_measure in measure_types:
+            roi_params_dict[temp_image_type + '_' + temp_measure] = map_stats[temp_measure]
+
+    return roi_params_dict
+
+
+def get_label_bounding_box(segmentation_arr):
+    '''Find the smallest box that contains every labelled (nonzero) voxel
+
+    Parameters
+    ----------
+    segmentation_arr : numpy.ndarray
+        array with one label per voxel
+
+    Returns
+    -------
+    crop : tuple
+        one slice per axis. If there are no labelled
+        voxels, the slices are empty.
+
+    '''
+
+    labelled = segmentation_arr != 0
+    crop = []
+    for i in range(labelled.ndim):
+        other_axes = tuple([temp_axis for temp_axis in range(labelled.ndim) if temp_axis != i])
+        temp_inds = np.flatnonzero(np.any(labelled, axis = other_axes))
+        if temp_inds.shape[0] == 0:
+            crop.append(slice(0, 0))
+        else:
+            crop.append(slice(int(temp_inds[0]), int(temp_inds[-1]) + 1))
+
+    return tuple(crop)
+
+
+def crop_to_labels(segmentation_arr, maps_array_dict):
+    '''Crop a segmentation and the maps to the bounding box of the labelled voxels
+
+    Only the voxels within the bounding box are copied, so views of
+    the image buffers (i.e. ANTsImage.view()) can be provided to avoid
+    copying the full volumes. The crops are stored in C order so that
+    they can be flattened without another copy. Because the relative
+    order of the voxels is unchanged, statistics calculated from the
+    crops are identical to those from the full volumes.
+
+    Parameters
+    ----------
+    segmentation_arr : numpy.ndarray
+        array with one label per voxel
+    maps_array_dict : dict
+        dictionary whose keys are map names (i.e. T1, T2, PD) and whose
+        values are arrays with the same shape as the segmentation
+
+    Returns
+    -------
+    cropped_segmentation_arr : numpy.ndarray
+        the cropped segmentation
+    cropped_maps_array_dict : dict
+        the cropped maps (as float32)
+
+    '''
+
+    crop = get_label_bounding_box(segmentation_arr)
+    cropped_segmentation_arr = np.ascontiguousarray(segmentation_arr[crop])
+    cropped_maps_array_dict = {}
+    for temp_image_type in maps_array_dict.keys():
+        cropped_maps_array_dict[temp_image_type] = np.ascontiguousarray(maps_array_dict[temp_image_type][crop], dtype = np.float32)
+
+    return cropped_segmentation_arr, cropped_maps_array_dict
@@ -1,8 +1,15 @@
 #!/usr/local/bin/python3
-import numpy as np
-import matplotlib.pyplot as plt
-import qmri_postproc
-import os, glob, shutil
+import os, sys, shutil
+import scheduler
+import checkpoints
+import roi_groupings
+import color_lut
+import dataset_index
+import group_tables
+import quantile_sketch
+import work_queue
+import run_ledger
+import preflight
 import argparse
 from my_parser import build_parser
 
@@ -23,14 +30,9 @@ def main():
     if os.path.isabs(output_dir) == False:
         output_dir = os.path.join(cwd, output_dir)
     analysis_level = args.analysis_level
-    if analysis_level != 'participant':
-        raise ValueError('Error: analysis level must be participant, but program received: ' + analysis_level)
-    qmri_deriv_dir = args.qmri_deriv_dir
-    if os.path.isabs(qmri_deriv_dir) == False:
-        qmri_deriv_dir = os.path.join(cwd, qmri_deriv_dir)
-    bibsnet_deriv_dir = args.bibsnet_deriv_dir
-    if os.path.isabs(bibsnet_deriv_dir) == False:
-        bibsnet_deriv_dir = os.path.join(cwd, bibsnet_deriv_dir)
+    if analysis_level not in ['participant', 'group']:
+        raise ValueError('Error: analysis level must be participant or group, but program received: ' + analysis_level)
+
     if type(args.region_groupings_json) != type(None):
         region_groupings_json = []
         for temp_grouping_json in args.region_groupings_json:
@@ -40,6 +42,70 @@ def main():
     else:
         region_groupings_json = None
 
+    color_lut_path = args.color_lut_path
+    if type(color_lut_path) != type(None) and os.path.isabs(color_lut_path) == False:
+        color_lut_path = os.path.join(cwd, color_lut_path)
+
+    #The group level only combines the outputs of sessions that were already processed
+    if analysis_level == 'group':
+        if type(args.derive_stats) != type(None):
+            quantile_sketch.check_stat_names(args.derive_stats)
+        if args.dry_run:
+            print('Dry run, the following group tables would be updated:')
+        group_summary = group_tables.aggregate_scalarstats(output_dir, table_format = args.group_format,
+                                                           metadata_fields = args.group_metadata_fields,
+                                                           dry_run = args.dry_run)
+        for temp_grouping, temp_summary in group_summary.items():
+            print('   {}: {} session(s) added/updated, {} removed, {} unchanged ({})'.format(temp_grouping, temp_summary['updated'], temp_summary['removed'],
+                                                                                           temp_summary['unchanged'], temp_summary['table']))
+
+        #Derive other statistics from the quantile sketches of every session
+        if type(args.derive_stats) != type(None):
+            if type(region_groupings_json) != type(None):
+                region_groupings_json = roi_groupings.compile_roi_groupings(region_groupings_json, color_lut.load_color_lut(color_lut_path))
+            derived_summary = group_tables.derive_group_stats(output_dir, args.derive_stats, table_format = args.group_format,
+                                                              compiled_groupings = region_groupings_json, dry_run = args.dry_run)
+            if args.dry_run:
+                print('Dry run, the following derived statistics tables would be made:')
+            for temp_grouping, temp_summary in derived_summary.items():
+                print('   {}: {} derived for {} session(s) ({})'.format(temp_grouping, ', '.join(args.derive_stats), temp_summary['sessions'], temp_summary['table']))
+        return
+    qmri_deriv_dir = args.qmri_deriv_dir
+    if os.path.isabs(qmri_deriv_dir) == False:
+        qmri_deriv_dir = os.path.join(cwd, qmri_deriv_dir)
+    bibsnet_deriv_dir = args.bibsnet_deriv_dir
+    if os.path.isabs(bibsnet_deriv_dir) == False:
+        bibsnet_deriv_dir = os.path.join(cwd, bibsnet_deriv_dir)
+
+    if args.stats_only and args.qc_only:
+        raise ValueError('Error: --stats_only and --qc_only can not be used together')
+    if args.lease_seconds <= 0:
+        raise ValueError('Error: --lease_seconds must be greater than 0, but {} was provided'.format(args.lease_seconds))
+    if args.write_threads < 0:
+        raise ValueError('Error: --write_threads must be 0 or greater, but {} was provided'.format(args.write_threads))
+
+    scratch_dir = args.scratch_dir
+    if type(scratch_dir) != type(None) and os.path.isabs(scratch_dir) == False:
+        scratch_dir = os.path.join(cwd, scratch_dir)
+
+    #Compile the region groupings once, so that invalid region
+    #names are caught before any session is processed
+    configuration_problems = []
+    freesurfer_color_lut = None
+    try:
+        freesurfer_color_lut = color_lut.load_color_lut(color_lut_path)
+    except (OSError, ValueError, IndexError) as error:
+        if args.preflight == 'off':
+            raise
+        configuration_problems.append('unable to load the FreeSurfer Color LUT ({})'.format(error))
+    if type(region_groupings_json) != type(None) and type(freesurfer_color_lut) != type(None):
+        try:
+            region_groupings_json = roi_groupings.compile_roi_groupings(region_groupings_json, freesurfer_color_lut)
+        except ValueError as error:
+            if args.preflight == 'off':
+                raise
+            configuration_problems.append(str(error).split('Error: ', 1)[-1])
+
     #Set session label
     if args.session_id:
         session_label = args.session_id
@@ -48,6 +114,40 @@ def main():
     else:
         session_label = None
         
+    #All folder listings go through a single index of the input trees, which
+    #is cached on disk so that unchanged folders don't need to be listed again
+    index_path = args.dataset_index
+    if type(index_path) == type(None):
+        index_path = os.path.join(output_dir, dataset_index.default_index_name)
+    elif os.path.isabs(index_path) == False:
+        index_path = os.path.join(cwd, index_path)
+    index = dataset_index.DatasetIndex(bids_dir, bibsnet_deriv_dir, qmri_deriv_dir, index_path = index_path)
+
+    #Sessions can be shared with other workers (on any node) through a work queue
+    queue = None
+    if type(args.work_queue) != type(None):
+        queue_dir = args.work_queue
+        if queue_dir == '':
+            queue_dir = os.path.join(output_dir, work_queue.default_queue_name)
+        elif os.path.isabs(queue_dir) == False:
+            queue_dir = os.path.join(cwd, queue_dir)
+        queue = work_queue.WorkQueue(queue_dir, lease_seconds = args.lease_seconds)
+
+    #The function that will be run for each session
+    if args.stats_only:
+        session_function = 'recalc_qmri_stats'
+    elif args.qc_only:
+        session_function = 'make_registration_qc_figure'
+    else:
+        session_function = 'calc_qmri_stats'
+
+    #Every session job and its outcome is recorded in a run ledger, which is
+    #used to find the sessions that failed or were interrupted in earlier runs
+    ledger = run_ledger.RunLedger(os.path.join(output_dir, run_ledger.default_ledger_name))
+    ledger_records = ledger.load_latest()
+    run_id = run_ledger.make_run_id()
+    planning_failures = []
+
     #Find participants to try running
     if args.participant_label:
         participant_split = args.participant_label.split(' ')
@@ -58,57 +158,251 @@ def main():
             else:
                 participants.append(temp_participant)
     else:
-        os.chdir(bids_dir)
-        participants = glob.glob('sub-*')
+        participants = index.get_subjects()
         
-    #Iterate through all participants
+    #Iterate through all participants to build the list of sessions to process
+    session_jobs = []
+    replace_when_claimed = set()
     for temp_participant in participants:
         
         #Check that participant exists at expected path
+        #(problems with one participant are reported without stopping the others)
         subject_path = os.path.join(bids_dir, temp_participant)
-        if os.path.exists(subject_path):
-            os.chdir(subject_path)
-        else:
-            raise AttributeError('Error: no directory found at: ' + subject_path)
+        if os.path.exists(subject_path) == False:
+            planning_failures.append({'participant' : temp_participant, 'session' : session_label if session_label else '',
+                                      'function' : session_function, 'status' : 'failed',
+                                      'error' : 'no directory found at: ' + subject_path})
+            print('Error: no directory found at: ' + subject_path)
+            continue
         
         #Find session/sessions
         if session_label == None:
-            sessions = glob.glob('ses*')
+            sessions = index.get_sessions(temp_participant)
             if len(sessions) < 1:
                 sessions = ['']
-        elif os.path.exists(session_label):
+        elif os.path.exists(os.path.join(subject_path, session_label)):
             sessions = [session_label]
         else:
-            raise AttributeError('Error: session with name ' + session_label + ' does not exist at ' + subject_path)
+            planning_failures.append({'participant' : temp_participant, 'session' : session_label,
+                                      'function' : session_function, 'status' : 'failed',
+                                      'error' : 'session with name ' + session_label + ' does not exist at ' + subject_path})
+            print('Error: session with name ' + session_label + ' does not exist at ' + subject_path)
+            continue
 
         #Iterate through sessions
         for temp_session in sessions:
 
+            #Checkpoints from previous runs don't count as existing outputs
             session_path = os.path.join(output_dir, temp_participant, temp_session)
-            if os.path.exists(session_path) and args.skip_existing:
+            session_exists = checkpoints.session_has_outputs(session_path)
+
+            #Sessions finished by any worker of the work queue are skipped (even
+            #with --overwrite_existing, since the workers of one queue are usually
+            #started at different times and would otherwise redo each other's work)
+            if type(queue) != type(None) and queue.is_done(work_queue.get_item_name(temp_participant, temp_session, session_function)):
+                print('   Already finished in the work queue, skipping: {}, {}'.format(temp_participant, temp_session))
+                continue
+
+            #Outputs without a completion marker were left by a run that failed or was interrupted
+            ledger_record = ledger_records.get((temp_participant, temp_session, session_function))
+            session_incomplete = (session_exists and session_function == 'calc_qmri_stats'
+                                  and checkpoints.session_is_incomplete(session_path, ledger_record))
+            if args.retry_failed:
+                if session_incomplete == False and (type(ledger_record) == type(None) or ledger_record['status'] not in run_ledger.retry_statuses):
+                    continue
+                print('   Retrying session that failed or was interrupted in an earlier run: {}, {}'.format(temp_participant, temp_session))
+
+            #Only recompute statistics for sessions that were already processed
+            if args.stats_only:
+                if session_exists == False:
+                    print('   No existing outputs found for the following, skipping statistics recalculation: {}, {}'.format(temp_participant, temp_session))
+                    continue
+                if index.session_exists('qmri', temp_participant, temp_session) == False:
+                    print('   No qMRI Relaxometry Maps directory found for the following, skipping statistics recalculation: {}, {}'.format(temp_participant, temp_session))
+                    continue
+                session_jobs.append({'participant' : temp_participant,
+                                     'session' : temp_session,
+                                     'function' : 'recalc_qmri_stats',
+                                     'calc_kwargs' : {'qmri_directory' : qmri_deriv_dir,
+                                                      'output_directory' : output_dir,
+                                                      'subject_name' : temp_participant,
+                                                      'session_name' : temp_session,
+                                                      'custom_roi_groupings' : region_groupings_json,
+                                                      'color_lut_path' : color_lut_path,
+                                                      'low_memory' : args.low_memory,
+                                                      'scratch_dir' : scratch_dir,
+                                                      'scratch_max_size_gb' : args.scratch_max_gb}})
+                continue
+
+            #Only make the registration QC figures of sessions that were already processed
+            if args.qc_only:
+                qc_json_path = os.path.join(session_path, 'anat', '{}_{}_desc-RegistrationQCAid.json'.format(temp_participant, temp_session))
+                if os.path.exists(qc_json_path) == False:
+                    print('   No existing outputs found for the following, skipping registration QC figure: {}, {}'.format(temp_participant, temp_session))
+                    continue
+                if os.path.exists(qc_json_path.replace('.json', '.png')) and args.overwrite_existing == False:
+                    print('   Registration QC figure already exists for the following, skipping: {}, {}'.format(temp_participant, temp_session))
+                    continue
+                session_jobs.append({'participant' : temp_participant,
+                                     'session' : temp_session,
+                                     'function' : 'make_registration_qc_figure',
+                                     'calc_kwargs' : {'bibsnet_directory' : bibsnet_deriv_dir,
+                                                      'output_directory' : output_dir,
+                                                      'subject_name' : temp_participant,
+                                                      'session_name' : temp_session,
+                                                      'qc_dpi' : args.qc_dpi,
+                                                      'scratch_dir' : scratch_dir,
+                                                      'scratch_max_size_gb' : args.scratch_max_gb}})
+                continue
+
+            if session_exists and type(queue) != type(None) and (args.overwrite_existing or args.retry_failed or session_incomplete):
+                #Another worker may be processing the session, so its outputs
+                #are only replaced once the session has been claimed
+                replace_when_claimed.add((temp_participant, temp_session))
+                if args.dry_run:
+                    print('Existing session outputs would be replaced once the session is claimed at: ' + session_path)
+            elif session_exists and args.skip_existing and session_incomplete == False:
                 print('Session folder already exists at the following path. Skipping: ' + session_path)
                 continue
-            elif os.path.exists(session_path) and args.overwrite_existing:
-                shutil.rmtree(session_path)
-                print('Removing existing session folder at: ' + session_path)
-            elif os.path.exists(session_path):
+            elif session_exists and (args.overwrite_existing or args.retry_failed or session_incomplete):
+                if session_incomplete:
+                    print('Session folder was left incomplete by an earlier run (no completion marker), processing again: ' + session_path)
+                if args.dry_run:
+                    print('Existing session outputs would be removed at: ' + session_path)
+                elif args.no_checkpoints:
+                    shutil.rmtree(session_path)
+                    print('Removing existing session folder at: ' + session_path)
+                else:
+                    checkpoints.remove_session_outputs(session_path)
+                    print('Removing existing session outputs (keeping checkpoints) at: ' + session_path)
+            elif session_exists:
                 print('Session folder already exists at the following path. Either delete folder, run with --overwrite_existing flag to reprocess, or with --skip_existing to ignore existing folders: ' + session_path)
                 continue
-            print('Starting processing for: {}, {}'.format(temp_participant, temp_session))
-            if os.path.exists(os.path.join(qmri_deriv_dir, temp_participant, temp_session)) == False:
+            if index.session_exists('qmri', temp_participant, temp_session) == False:
                 print('   No qMRI Relaxometry Maps directory found for the following, skipping processing: {}, {}'.format(temp_participant, temp_session))
                 continue
-            if os.path.exists(os.path.join(bibsnet_deriv_dir, temp_participant, temp_session)) == False:
+            if index.session_exists('bibsnet', temp_participant, temp_session) == False:
                 print('   No BIBSNET/CABINET segmentations directory found for the following, skipping processing: {}, {}'.format(temp_participant, temp_session))
                 continue
-            qmri_postproc.calc_qmri_stats(bids_dir, bibsnet_deriv_dir,
-                                        qmri_deriv_dir, output_dir,
-                                        temp_participant, temp_session,
-                                        custom_roi_groupings = region_groupings_json,
-                                        sequence_name_source = args.sequence_name_source,
-                                        registration_metric = args.ants_reg_metric,
-                                        registration_type = args.ants_reg_type)
-            print('Finished with: {}, {}'.format(temp_participant, temp_session))
+            session_jobs.append({'participant' : temp_participant,
+                                 'session' : temp_session,
+                                 'function' : 'calc_qmri_stats',
+                                 'calc_kwargs' : {'bids_directory' : bids_dir,
+                                                  'bibsnet_directory' : bibsnet_deriv_dir,
+                                                  'qmri_directory' : qmri_deriv_dir,
+                                                  'output_directory' : output_dir,
+                                                  'subject_name' : temp_participant,
+                                                  'session_name' : temp_session,
+                                                  'custom_roi_groupings' : region_groupings_json,
+                                                  'sequence_name_source' : args.sequence_name_source,
+                                                  'registration_metric' : args.ants_reg_metric,
+                                                  'registration_type' : args.ants_reg_type,
+                                                  'registration_profile' : args.reg_profile,
+                                                  'adaptive_registration' : args.adaptive_registration,
+                                                  'adaptive_registration_threshold' : args.adaptive_reg_threshold,
+                                                  'use_checkpoints' : args.no_checkpoints == False,
+                                                  'color_lut_path' : color_lut_path,
+                                                  'compression_level' : args.compression_level,
+                                                  'compression_threads' : args.compression_threads,
+                                                  'qc_dpi' : args.qc_dpi,
+                                                  'defer_qc' : args.defer_qc,
+                                                  'profile_mode' : args.profile,
+                                                  'stage_timings_in_json' : args.stage_timings_in_json,
+                                                  'low_memory' : args.low_memory,
+                                                  'scratch_dir' : scratch_dir,
+                                                  'scratch_max_size_gb' : args.scratch_max_gb,
+                                                  'write_threads' : args.write_threads,
+                                                  'session_inputs' : index.get_session_inputs(temp_participant, temp_session)}})
+
+    #Check the inputs of every session (reading only headers and json sidecars)
+    #before any processing starts, and report every problem at once
+    if args.preflight != 'off' and session_function == 'calc_qmri_stats':
+        if len(session_jobs):
+            print('Running preflight checks for {} session(s)'.format(len(session_jobs)))
+        session_problems = preflight.check_sessions(session_jobs, freesurfer_color_lut = freesurfer_color_lut,
+                                                    check_labels = args.preflight_labels)
+        for temp_problem in configuration_problems:
+            print('   Configuration problem: ' + temp_problem)
+        for temp_session_problems in session_problems:
+            for temp_problem in temp_session_problems['problems']:
+                print('   {}, {}: {}'.format(temp_session_problems['participant'], temp_session_problems['session'], temp_problem))
+        report_path = os.path.join(output_dir, preflight.report_name)
+        if len(configuration_problems) + len(session_problems):
+            print('Preflight checks found problems with {} of {} session(s)'.format(len(session_problems), len(session_jobs)))
+            if args.dry_run == False:
+                preflight.save_report(report_path, configuration_problems, session_problems, len(session_jobs), args.preflight)
+                print('The problems are listed in: ' + report_path)
+        elif args.dry_run == False and os.path.exists(report_path):
+            #Don't leave the report of an earlier run behind
+            os.remove(report_path)
+        if len(configuration_problems) or (args.preflight == 'strict' and len(session_problems)):
+            print('Error: Not starting any processing because of the problems found by the preflight checks')
+            sys.exit(1)
+
+        #Skip the sessions with problems, which are reported as failed at the end of the run
+        problem_sessions = set([(temp_session_problems['participant'], temp_session_problems['session']) for temp_session_problems in session_problems])
+        session_jobs = [temp_job for temp_job in session_jobs if (temp_job['participant'], temp_job['session']) not in problem_sessions]
+        for temp_session_problems in session_problems:
+            print('   Skipping because of the problems found by the preflight checks: {}, {}'.format(temp_session_problems['participant'], temp_session_problems['session']))
+            planning_failures.append({'participant' : temp_session_problems['participant'], 'session' : temp_session_problems['session'],
+                                      'function' : session_function, 'status' : 'failed',
+                                      'error' : 'preflight: ' + '; '.join(temp_session_problems['problems'])})
+    elif len(configuration_problems):
+        raise ValueError('Error: ' + '\n'.join(configuration_problems))
+
+    #Only report what would be processed
+    if args.dry_run == False:
+        index.save()
+    if args.dry_run:
+        print('Dry run, the following {} session(s) would be processed:'.format(len(session_jobs)))
+        for temp_job in session_jobs:
+            print('   {}, {} ({})'.format(temp_job['participant'], temp_job['session'], temp_job['function']))
+        return
+
+    #Record the participants/sessions that could not be found, and let
+    #every session job record its outcome in the run ledger
+    for temp_failure in planning_failures:
+        ledger.record(temp_failure['participant'], temp_failure['session'], temp_failure['function'], 'failed',
+                      run_id = run_id, error = temp_failure['error'])
+    for temp_job in session_jobs:
+        temp_job['ledger_path'] = ledger.ledger_path
+        temp_job['run_id'] = run_id
+
+    #In a work queue, each session is only processed by the worker that claims it
+    job_function = scheduler.run_session_job
+    if type(queue) != type(None):
+        queue_names = []
+        for temp_job in session_jobs:
+            temp_job['work_queue'] = {'directory' : queue.queue_directory,
+                                      'lease_seconds' : queue.lease_seconds,
+                                      'name' : work_queue.get_item_name(temp_job['participant'], temp_job['session'], temp_job['function']),
+                                      'session_path' : os.path.join(output_dir, temp_job['participant'], temp_job['session'])}
+            if temp_job['function'] == 'calc_qmri_stats' and (temp_job['participant'], temp_job['session']) in replace_when_claimed:
+                temp_job['work_queue']['remove_existing_outputs'] = 'all' if args.no_checkpoints else 'outputs'
+            queue_names.append(temp_job['work_queue']['name'])
+        queue_status = queue.get_status(queue_names, work_queue.get_worker_id())
+        print('Work queue at {}: {} session(s) available, {} claimed by other workers, {} with expired claims'.format(queue.queue_directory, queue_status['available'],
+                                                                                                                     queue_status['claimed'], queue_status['stale']))
+        job_function = work_queue.run_queued_session_job
+
+    #Process the sessions, either one at a time or across a pool of workers
+    results = scheduler.run_session_jobs(session_jobs, n_jobs = args.n_jobs,
+                                         threads_per_job = args.threads_per_job,
+                                         mem_per_job_gb = args.mem_per_job_gb,
+                                         job_function = job_function)
+
+    #Summarize the run, and exit with an error if any session failed
+    failures = planning_failures + [temp_result for temp_result in results if temp_result['status'] == 'failed']
+    num_succeeded = len([temp_result for temp_result in results if temp_result['status'] == 'succeeded'])
+    print('Finished {} session job(s): {} succeeded, {} failed'.format(len(results), num_succeeded, len(failures) - len(planning_failures)))
+    if len(planning_failures):
+        print('{} session(s) could not be started'.format(len(planning_failures)))
+    if len(failures):
+        for temp_failure in failures:
+            print('   Failed: {}, {} ({})'.format(temp_failure['participant'], temp_failure['session'], temp_failure['error']))
+        print('Details are in the run ledger at: ' + ledger.ledger_path)
+        print('Failed sessions can be processed again with --retry_failed')
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
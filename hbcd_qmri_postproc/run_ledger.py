@@ -0,0 +1,131 @@
+#!/usr/local/bin/python3
+import os, json, time, uuid, fcntl, socket
+
+#Name of the ledger file (within the output directory)
+default_ledger_name = '.run_ledger.jsonl'
+
+#Statuses that mean a session job needs to be run again by --retry_failed.
+#A job whose last record is 'started' was interrupted (i.e. its worker was killed).
+retry_statuses = ['started', 'failed']
+
+
+def make_run_id():
+    '''Get an id for one call of the tool'''
+
+    return '{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:8])
+
+
+def get_input_fingerprints(session_inputs):
+    '''Get the size and modification time of each input file of a session
+
+    Parameters
+    ----------
+    session_inputs : dict or None
+        dictionary whose values are lists of input paths (see
+        dataset_index.DatasetIndex.get_session_inputs)
+
+    Returns
+    -------
+    fingerprints : dict
+        dictionary mapping each path to [size, mtime_ns]. Files
+        that can't be found are given None.
+
+    '''
+
+    fingerprints = {}
+    if type(session_inputs) == type(None):
+        return fingerprints
+    for temp_paths in session_inputs.values():
+        for temp_path in temp_paths:
+            try:
+                temp_stat = os.stat(temp_path)
+                fingerprints[temp_path] = [temp_stat.st_size, temp_stat.st_mtime_ns]
+            except OSError:
+                fingerprints[temp_path] = None
+
+    return fingerprints
+
+
+class RunLedger:
+    '''Append-only record (json lines) of every session job that was run
+
+    One line is added when a session job starts, and another when it
+    succeeds or fails (with its wall time and error). Lines are appended
+    while holding a lock on the file, so that any number of workers
+    (processes or nodes) can share one ledger. The last line for each
+    (participant, session, function) gives the current state of that job.
+
+    Parameters
+    ----------
+    ledger_path : str
+        path to the ledger file
+
+    '''
+
+    def __init__(self, ledger_path):
+
+        self.ledger_path = ledger_path
+
+    def record(self, participant, session, function, status, **fields):
+        '''Append a record for a session job
+
+        Parameters
+        ----------
+        participant : str
+            participant label (i.e. sub-01)
+        session : str
+            session label (i.e. ses-01)
+        function : str
+            name of the qmri_postproc function the job runs
+        status : str
+            started, succeeded, failed, or skipped
+        fields
+            other json serializable fields (i.e. error, wall_time_seconds)
+
+        '''
+
+        entry = {'participant' : participant,
+                 'session' : session,
+                 'function' : function,
+                 'status' : status,
+                 'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 'host' : socket.gethostname(),
+                 'pid' : os.getpid()}
+        entry.update(fields)
+        ledger_directory = os.path.dirname(self.ledger_path)
+        if ledger_directory != '' and os.path.exists(ledger_directory) == False:
+            os.makedirs(ledger_directory, exist_ok = True)
+        with open(self.ledger_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+        return
+
+    def load_latest(self):
+        '''Get the last record of every session job
+
+        Returns
+        -------
+        latest : dict
+            dictionary mapping (participant, session, function) to the
+            last record for that job. Lines that can't be parsed (i.e.
+            a partial line left by a worker that was killed) are ignored.
+
+        '''
+
+        latest = {}
+        if os.path.exists(self.ledger_path) == False:
+            return latest
+        with open(self.ledger_path, 'r') as f:
+            for temp_line in f:
+                try:
+                    temp_entry = json.loads(temp_line)
+                    latest[(temp_entry['participant'], temp_entry['session'], temp_entry['function'])] = temp_entry
+                except (ValueError, KeyError):
+                    continue
+
+        return latest
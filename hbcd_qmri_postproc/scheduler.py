@@ -0,0 +1,291 @@
+#!/usr/local/bin/python3
+import os, time, traceback
+import multiprocessing
+import run_ledger
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+#Environment variables that control the size of the thread pools used by
+#ITK/ANTs, SimpleITK and the numerical libraries underneath numpy/scipy
+thread_budget_environment_variables = ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS',
+                                       'OMP_NUM_THREADS',
+                                       'OPENBLAS_NUM_THREADS',
+                                       'MKL_NUM_THREADS']
+
+
+def get_available_cpu_count():
+    '''Get the number of CPUs this process is allowed to run on
+
+    Returns
+    -------
+    cpu_count : int
+        number of CPUs available to the process. This respects
+        CPU affinity (i.e. SLURM/cgroup cpusets) when possible.
+
+    '''
+
+    try:
+        cpu_count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpu_count = os.cpu_count()
+    if type(cpu_count) == type(None) or cpu_count < 1:
+        cpu_count = 1
+
+    return cpu_count
+
+
+def get_available_memory_gb():
+    '''Get the amount of memory currently available on the node
+
+    Returns
+    -------
+    available_memory : float or None
+        the MemAvailable entry of /proc/meminfo in GB, or None
+        if this can not be determined on the current platform
+
+    '''
+
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for temp_line in f:
+                if temp_line.startswith('MemAvailable:'):
+                    return float(temp_line.split()[1])/(1024**2)
+    except OSError:
+        pass
+
+    return None
+
+
+def set_thread_budget(threads_per_job):
+    '''Limit the number of threads ITK/ANTs and numerical libraries will use
+
+    This needs to be called before any ITK filter is constructed within
+    the current process, so it is used as the initializer for each worker
+    in the session pool.
+
+    Parameters
+    ----------
+    threads_per_job : int
+        maximum number of threads a single session may use
+
+    '''
+
+    if type(threads_per_job) == type(None):
+        return
+    for temp_variable in thread_budget_environment_variables:
+        os.environ[temp_variable] = str(int(threads_per_job))
+
+    return
+
+
+def run_session_job(session_job):
+    '''Run the processing for a single (participant, session) pair
+
+    Errors are caught, so that one failing session does not stop the
+    processing of the others. If the session job has a 'ledger_path', the
+    start and outcome (with timings, input fingerprints, and any error) of
+    the job are recorded in that run ledger (see run_ledger.RunLedger).
+
+    Parameters
+    ----------
+    session_job : dict
+        dictionary with 'participant' and 'session' labels, the
+        name of the qmri_postproc function to run ('function', which
+        defaults to calc_qmri_stats), along with 'calc_kwargs' that
+        will be passed to that function
+
+    Returns
+    -------
+    result : dict
+        dictionary with the 'participant', 'session', 'function', the
+        'status' (succeeded or failed), the 'wall_time_seconds', and the
+        'error' (None if the job succeeded)
+
+    '''
+
+    import qmri_postproc
+
+    function_name = session_job.get('function', 'calc_qmri_stats')
+    result = make_session_result(session_job, 'succeeded')
+    ledger = get_session_ledger(session_job)
+    if type(ledger) != type(None):
+        ledger.record(session_job['participant'], session_job['session'], function_name, 'started',
+                      run_id = session_job.get('run_id'),
+                      input_fingerprints = run_ledger.get_input_fingerprints(session_job['calc_kwargs'].get('session_inputs')))
+
+    print('Starting processing for: {}, {}'.format(session_job['participant'], session_job['session']))
+    start_time = time.time()
+    error_traceback = None
+    try:
+        session_function = getattr(qmri_postproc, function_name)
+        session_function(**session_job['calc_kwargs'])
+    except Exception as error:
+        error_traceback = traceback.format_exc()
+        result['status'] = 'failed'
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+        print('Error while processing {}, {}:\n{}'.format(session_job['participant'], session_job['session'], error_traceback))
+    result['wall_time_seconds'] = time.time() - start_time
+    if type(ledger) != type(None):
+        ledger.record(session_job['participant'], session_job['session'], function_name, result['status'],
+                      run_id = session_job.get('run_id'), wall_time_seconds = result['wall_time_seconds'],
+                      error = result['error'], traceback = error_traceback)
+    if result['status'] == 'succeeded':
+        print('Finished with: {}, {}'.format(session_job['participant'], session_job['session']))
+
+    return result
+
+
+def make_session_result(session_job, status, wall_time_seconds = None, error = None):
+    '''Make the result dictionary of a session job (see run_session_job)'''
+
+    return {'participant' : session_job['participant'],
+            'session' : session_job['session'],
+            'function' : session_job.get('function', 'calc_qmri_stats'),
+            'status' : status,
+            'wall_time_seconds' : wall_time_seconds,
+            'error' : error}
+
+
+def get_session_ledger(session_job):
+    '''Get the run ledger a session job records its outcome in (None if it has no 'ledger_path')'''
+
+    if type(session_job.get('ledger_path')) == type(None):
+        return None
+
+    return run_ledger.RunLedger(session_job['ledger_path'])
+
+
+def run_session_jobs(session_jobs, n_jobs = 1, threads_per_job = None, mem_per_job_gb = None, job_function = run_session_job):
+    '''Run a collection of independent session jobs, optionally in parallel
+
+    When n_jobs is 1, sessions are processed one after another in the
+    current process. Otherwise sessions are sent to a pool of n_jobs
+    worker processes. Each worker limits ITK/ANTs to threads_per_job
+    threads so that n_jobs x threads_per_job fits on the node. A new
+    session is only admitted to the pool if the node currently has at
+    least mem_per_job_gb of memory available and the memory reserved for
+    the sessions that are already running fits in the memory that was
+    available when the pool was started. One session is always allowed
+    to run so that processing can't stall.
+
+    If a worker process dies (i.e. ITK crashes on a corrupt image), the
+    pool can no longer be used and every session that was running in it
+    is interrupted. Those sessions are then run again one at a time in a
+    new pool, so the session that caused the crash is found and reported
+    as failed without stopping the others.
+
+    Parameters
+    ----------
+    session_jobs : list
+        list of session job dictionaries (see run_session_job)
+    n_jobs : int
+        number of sessions to process concurrently
+    threads_per_job : int or None
+        number of ITK/ANTs threads per session. If None, the
+        available CPUs are split evenly across the n_jobs workers
+        (or the current thread settings are kept if n_jobs is 1).
+    mem_per_job_gb : float or None
+        estimated peak memory for one session in GB. If None,
+        sessions are admitted without looking at memory usage.
+    job_function : callable
+        function that will be called with each session job. Must
+        be defined at module level so it can be sent to workers.
+
+    Returns
+    -------
+    results : list
+        the return values of job_function, in the order that the
+        sessions finished processing
+
+    '''
+
+    session_jobs = list(session_jobs)
+    if n_jobs < 1:
+        raise ValueError('Error: n_jobs must be at least 1, but received: {}'.format(n_jobs))
+
+    results = []
+    if n_jobs == 1 or len(session_jobs) < 2:
+        set_thread_budget(threads_per_job)
+        for temp_job in session_jobs:
+            results.append(job_function(temp_job))
+        return results
+
+    if type(threads_per_job) == type(None):
+        threads_per_job = max(1, get_available_cpu_count()//n_jobs)
+
+    print('Processing {} sessions with {} workers ({} threads per worker)'.format(len(session_jobs), n_jobs, threads_per_job))
+    memory_budget = get_available_memory_gb()
+    pending_jobs = list(reversed(session_jobs))
+    interrupted_jobs = []
+    while len(pending_jobs):
+        interrupted_jobs += _run_pool(pending_jobs, n_jobs, threads_per_job, mem_per_job_gb, memory_budget, job_function, results)
+
+    #Run the sessions that were interrupted by a crashed worker on their own
+    for temp_job in interrupted_jobs:
+        print('Processing again on its own after a worker crashed: {}, {}'.format(temp_job['participant'], temp_job['session']))
+        if len(_run_pool([temp_job], 1, threads_per_job, mem_per_job_gb, memory_budget, job_function, results)):
+            error = 'worker process terminated abruptly (i.e. crashed or was killed)'
+            print('Error while processing {}, {}: {}'.format(temp_job['participant'], temp_job['session'], error))
+            ledger = get_session_ledger(temp_job)
+            if type(ledger) != type(None):
+                ledger.record(temp_job['participant'], temp_job['session'], temp_job.get('function', 'calc_qmri_stats'), 'failed',
+                              run_id = temp_job.get('run_id'), error = error)
+            results.append(make_session_result(temp_job, 'failed', error = error))
+
+    return results
+
+
+def _run_pool(pending_jobs, n_jobs, threads_per_job, mem_per_job_gb, memory_budget, job_function, results):
+    '''Run session jobs (taken from the end of pending_jobs) in a new pool of workers
+
+    The return value of each job is added to results. If a worker dies,
+    the pool is stopped and the jobs that were running are returned (jobs
+    that were not started yet are left in pending_jobs).
+
+    '''
+
+    running = {}
+
+    #Use spawn so each worker sets its thread budget before ITK is loaded
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers = n_jobs, mp_context = context,
+                             initializer = set_thread_budget, initargs = (threads_per_job,)) as executor:
+        try:
+            while len(pending_jobs) or len(running):
+                while len(pending_jobs) and len(running) < n_jobs and _memory_allows_admission(len(running), mem_per_job_gb, memory_budget):
+                    temp_job = pending_jobs.pop()
+                    running[executor.submit(job_function, temp_job)] = temp_job
+                done = wait(running, timeout = 5, return_when = FIRST_COMPLETED).done
+                for temp_future in done:
+                    try:
+                        results.append(temp_future.result())
+                    except BrokenProcessPool:
+                        continue
+                    running.pop(temp_future)
+
+                #Jobs that are done but still running were interrupted by a crashed worker
+                if any([temp_future.done() for temp_future in running]):
+                    print('A worker process terminated abruptly, {} running session(s) were interrupted'.format(len(running)))
+                    return list(running.values())
+        except BaseException:
+            for temp_future in running:
+                temp_future.cancel()
+            raise
+
+    return []
+
+
+def _memory_allows_admission(num_running, mem_per_job_gb, memory_budget):
+    '''Decide whether another session can be started without exhausting memory'''
+
+    if num_running == 0 or type(mem_per_job_gb) == type(None):
+        return True
+    available_memory = get_available_memory_gb()
+    if type(available_memory) == type(None) or type(memory_budget) == type(None):
+        return True
+    if (num_running + 1)*mem_per_job_gb > memory_budget:
+        return False
+    if available_memory < mem_per_job_gb:
+        return False
+
+    return True
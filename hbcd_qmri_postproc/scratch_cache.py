@@ -0,0 +1,225 @@
+#!/usr/local/bin/python3
+import os, json, time, zlib, fcntl, hashlib, contextlib
+
+#Default limit on the total size of the decompressed images in a scratch cache
+default_max_size_gb = 50
+
+#Version of the on-disk index format. Indexes with a different version are ignored.
+index_version = 1
+
+#Size of the chunks read from the (compressed) source files
+chunk_size = 4*1024*1024
+
+
+class ScratchCache:
+    '''Cache of decompressed copies of input images on a (node-local) scratch disk
+
+    The first time a gzipped image is requested, it is read once from its
+    source location, decompressed, and stored under the sha256 hash of its
+    compressed contents (the same hash used to key checkpoints). An index
+    maps the path, size, and modification time of every source file to its
+    hash, so later requests for an unchanged file (from the same or any other
+    process) are served from the uncompressed copy without reading the source
+    file at all. Uncompressed copies can be read quickly and memory-mapped
+    (i.e. by nibabel).
+
+    When the cache grows above its size limit, the least recently used copies
+    are removed. The cache can be shared by concurrent workers: new copies are
+    written to a temporary file and renamed into place, the index is only
+    updated while holding an exclusive lock (flock) on the cache, and readers
+    hold a shared lock while reading so that a copy is never removed while it
+    is being read.
+
+    Parameters
+    ----------
+    cache_directory : str
+        folder where the decompressed copies are stored (ideally on node-local disk)
+    max_size_gb : float
+        the least recently used copies are removed when the total size
+        of the copies is above this limit
+
+    '''
+
+    def __init__(self, cache_directory, max_size_gb = default_max_size_gb):
+
+        self.cache_directory = cache_directory
+        self.entries_directory = os.path.join(cache_directory, 'entries')
+        self.index_path = os.path.join(cache_directory, 'index.json')
+        self.lock_path = os.path.join(cache_directory, '.lock')
+        self.max_size_bytes = int(max_size_gb*1024*1024*1024)
+        os.makedirs(self.entries_directory, exist_ok = True)
+
+    @contextlib.contextmanager
+    def _lock(self, lock_type):
+        '''Hold a shared (fcntl.LOCK_SH) or exclusive (fcntl.LOCK_EX) lock on the cache'''
+
+        with open(self.lock_path, 'a') as f:
+            fcntl.flock(f, lock_type)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load_index(self):
+
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+            if index.get('version') == index_version:
+                return index
+        except (OSError, ValueError):
+            pass
+
+        return {'version' : index_version, 'files' : {}}
+
+    def _save_index(self, index):
+
+        temporary_path = '{}.tmp-{}'.format(self.index_path, os.getpid())
+        with open(temporary_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(temporary_path, self.index_path)
+
+        return
+
+    def _get_entry_path(self, content_key):
+
+        return os.path.join(self.entries_directory, '{}.nii'.format(content_key))
+
+    def _decompress(self, source_path):
+        '''Decompress a file into a temporary file in the cache, hashing the compressed bytes in the same pass
+
+        Files made of several gzip members (i.e. written with more than
+        one compression thread) are supported.
+
+        '''
+
+        temporary_path = os.path.join(self.entries_directory, '.tmp-{}-{}'.format(os.getpid(), time.time_ns()))
+        file_hash = hashlib.sha256()
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            with open(source_path, 'rb') as f_in, open(temporary_path, 'wb') as f_out:
+                for temp_chunk in iter(lambda: f_in.read(chunk_size), b''):
+                    file_hash.update(temp_chunk)
+                    while len(temp_chunk):
+                        f_out.write(decompressor.decompress(temp_chunk))
+                        if decompressor.eof:
+                            temp_chunk = decompressor.unused_data
+                            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        else:
+                            temp_chunk = b''
+                f_out.write(decompressor.flush())
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+        return temporary_path, file_hash.hexdigest()
+
+    def _evict(self, index, keep_key):
+        '''Remove the least recently used copies until the cache is within its size limit'''
+
+        entries = []
+        total_size = 0
+        with os.scandir(self.entries_directory) as it:
+            for temp_entry in it:
+                #Temporary files left behind by workers that were killed
+                if temp_entry.name.startswith('.tmp-') and (time.time() - temp_entry.stat().st_mtime) > 24*60*60:
+                    os.remove(temp_entry.path)
+                if temp_entry.name.endswith('.nii') == False:
+                    continue
+                temp_stat = temp_entry.stat()
+                entries.append((temp_stat.st_mtime, temp_entry.name[:-len('.nii')], temp_stat.st_size))
+                total_size += temp_stat.st_size
+        removed_keys = set()
+        for temp_mtime, temp_key, temp_size in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            if temp_key == keep_key:
+                continue
+            os.remove(self._get_entry_path(temp_key))
+            removed_keys.add(temp_key)
+            total_size -= temp_size
+        if len(removed_keys):
+            for temp_path in list(index['files'].keys()):
+                if index['files'][temp_path]['key'] in removed_keys:
+                    del index['files'][temp_path]
+
+        return
+
+    def cache_file(self, source_path):
+        '''Get the decompressed copy of a gzipped file, making it if needed
+
+        Parameters
+        ----------
+        source_path : str
+            path to a .gz file
+
+        Returns
+        -------
+        local_path : str
+            path to the decompressed copy
+        content_key : str
+            sha256 hash of the compressed file
+
+        '''
+
+        source_path = os.path.abspath(source_path)
+        source_stat = os.stat(source_path)
+        signature = [source_stat.st_size, source_stat.st_mtime_ns]
+        with self._lock(fcntl.LOCK_EX):
+            index = self._load_index()
+            file_info = index['files'].get(source_path)
+            if type(file_info) != type(None) and file_info['signature'] == signature:
+                local_path = self._get_entry_path(file_info['key'])
+                if os.path.exists(local_path):
+                    #The modification time of a copy marks when it was last used
+                    os.utime(local_path)
+                    return local_path, file_info['key']
+
+        #Decompress without holding the lock so other workers are not blocked
+        temporary_path, content_key = self._decompress(source_path)
+        local_path = self._get_entry_path(content_key)
+        with self._lock(fcntl.LOCK_EX):
+            if os.path.exists(local_path):
+                os.remove(temporary_path)
+                os.utime(local_path)
+            else:
+                os.replace(temporary_path, local_path)
+            index = self._load_index()
+            index['files'][source_path] = {'signature' : signature, 'key' : content_key}
+            self._evict(index, content_key)
+            self._save_index(index)
+
+        return local_path, content_key
+
+    @contextlib.contextmanager
+    def open_local_copy(self, source_path):
+        '''Context manager that provides the path of a local copy of a file while it is being read
+
+        Files that are not gzipped are read from their source. If the local
+        copy can not be made (i.e. the scratch disk is full), or was removed
+        by another worker before it could be read, the source path is used.
+
+        '''
+
+        if source_path.endswith('.gz') == False:
+            yield source_path
+            return
+        try:
+            local_path = self.cache_file(source_path)[0]
+        except OSError as error:
+            print('   Warning: could not cache {} in {} ({}), reading it from its source instead'.format(source_path, self.cache_directory, error))
+            local_path = source_path
+        with self._lock(fcntl.LOCK_SH):
+            if os.path.exists(local_path) == False:
+                local_path = source_path
+            yield local_path
+
+
+def local_copy(cache, source_path):
+    '''Context manager for the local copy of a file in a cache (or the file itself if cache is None)'''
+
+    if type(cache) == type(None):
+        return contextlib.nullcontext(source_path)
+
+    return cache.open_local_copy(source_path)
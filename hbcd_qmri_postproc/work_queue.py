@@ -0,0 +1,329 @@
+#!/usr/local/bin/python3
+import os, json, time, uuid, shutil, socket, threading
+import scheduler
+import checkpoints
+
+#Default folder (within the output directory) where the work queue is kept
+default_queue_name = '.work_queue'
+
+#Default number of seconds a claim stays valid without being renewed
+default_lease_seconds = 600
+
+#Claims are renewed this many times per lease, so a few
+#slow renewals (i.e. a busy filesystem) don't lose the claim
+renewals_per_lease = 10
+
+#Identifies the current process in the claims it makes
+_worker_id = None
+
+
+def get_worker_id():
+    '''Get an id for the current process that is unique across nodes'''
+
+    global _worker_id
+    if type(_worker_id) == type(None):
+        _worker_id = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+    return _worker_id
+
+
+def get_item_name(participant, session, function):
+    '''Get the name used for a session job in the work queue (i.e. sub-01_ses-01_calc_qmri_stats)'''
+
+    name_parts = [participant]
+    if session != '':
+        name_parts.append(session)
+    name_parts.append(function)
+
+    return '_'.join(name_parts)
+
+
+class WorkQueue:
+    '''Queue of session jobs shared by workers through lock files on a shared filesystem
+
+    Any number of workers (processes on any number of nodes, i.e. the tasks of
+    a SLURM array job) can be pointed at the same queue folder. A worker claims
+    an item by creating claims/<item>.claim with O_CREAT|O_EXCL, which only
+    one worker can do. While it processes the item the worker renews the claim
+    (its lease) by updating the claim file's modification time. If a worker
+    dies, its claim is no longer renewed and, once it is older than
+    lease_seconds, any other worker can reclaim the item. Reclaiming renames
+    the stale claim file, which only one worker can do, before claiming the
+    item as usual. When an item is finished, done/<item>.json is written and
+    the claim is removed, so the item is skipped by all later workers.
+
+    Lease ages are measured with the clock of the filesystem (by touching a
+    file in the queue folder), so the clocks of the nodes don't need to agree.
+    SQLite is not used because its locking is unreliable on network filesystems.
+
+    Parameters
+    ----------
+    queue_directory : str
+        folder (on a filesystem shared by all workers) where the queue is kept
+    lease_seconds : float
+        claims that have not been renewed for this long are considered to
+        belong to a dead worker and can be reclaimed
+
+    '''
+
+    def __init__(self, queue_directory, lease_seconds = default_lease_seconds):
+
+        self.queue_directory = queue_directory
+        self.claims_directory = os.path.join(queue_directory, 'claims')
+        self.done_directory = os.path.join(queue_directory, 'done')
+        self.lease_seconds = lease_seconds
+        os.makedirs(self.claims_directory, exist_ok = True)
+        os.makedirs(self.done_directory, exist_ok = True)
+
+    def get_claim_path(self, name):
+
+        return os.path.join(self.claims_directory, '{}.claim'.format(name))
+
+    def get_done_path(self, name):
+
+        return os.path.join(self.done_directory, '{}.json'.format(name))
+
+    def is_done(self, name):
+
+        return os.path.exists(self.get_done_path(name))
+
+    def get_claim_owner(self, name):
+        '''Get the id of the worker that holds the claim on an item (None if unclaimed)'''
+
+        try:
+            with open(self.get_claim_path(name), 'r') as f:
+                return json.load(f)['worker_id']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def get_filesystem_time(self, worker_id):
+        '''Get the current time according to the filesystem the queue is stored on'''
+
+        clock_path = os.path.join(self.claims_directory, '.clock-{}'.format(worker_id))
+        with open(clock_path, 'a'):
+            pass
+        os.utime(clock_path)
+        filesystem_time = os.stat(clock_path).st_mtime
+        os.remove(clock_path)
+
+        return filesystem_time
+
+    def _reclaim_if_stale(self, name, worker_id):
+        '''Remove the claim on an item if its lease has expired
+
+        Returns True if the item can now be claimed.
+
+        '''
+
+        claim_path = self.get_claim_path(name)
+        try:
+            claim_mtime = os.stat(claim_path).st_mtime
+        except FileNotFoundError:
+            return True
+        if self.get_filesystem_time(worker_id) - claim_mtime < self.lease_seconds:
+            return False
+
+        #Only one worker can rename the stale claim
+        stale_path = '{}.stale-{}'.format(claim_path, worker_id)
+        try:
+            os.rename(claim_path, stale_path)
+        except FileNotFoundError:
+            return False
+
+        #The claim may have been renewed (or replaced) between the check and the rename
+        if self.get_filesystem_time(worker_id) - os.stat(stale_path).st_mtime < self.lease_seconds:
+            try:
+                os.link(stale_path, claim_path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        print('   Reclaiming {} from a worker whose lease expired'.format(name))
+
+        return True
+
+    def claim(self, name, worker_id):
+        '''Try to claim an item. Returns True if the item was claimed by this worker.'''
+
+        if self.is_done(name):
+            return False
+        claim_path = self.get_claim_path(name)
+        for i in range(2):
+            try:
+                fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if i == 0 and self._reclaim_if_stale(name, worker_id):
+                    continue
+                return False
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'worker_id' : worker_id, 'host' : socket.gethostname(), 'pid' : os.getpid(),
+                           'claimed_at' : time.time()}, f)
+
+            #Another worker may have finished the item before it was claimed
+            if self.is_done(name):
+                self.release(name, worker_id)
+                return False
+            return True
+
+        return False
+
+    def renew(self, name, worker_id):
+        '''Renew the lease on a claimed item. Returns False if the claim is no longer held by this worker.'''
+
+        if self.get_claim_owner(name) != worker_id:
+            return False
+        os.utime(self.get_claim_path(name))
+
+        return True
+
+    def release(self, name, worker_id):
+        '''Remove the claim on an item (if it is still held by this worker) so that others can claim it'''
+
+        if self.get_claim_owner(name) == worker_id:
+            try:
+                os.remove(self.get_claim_path(name))
+            except FileNotFoundError:
+                pass
+
+        return
+
+    def mark_done(self, name, worker_id, info = None):
+        '''Record that an item is finished and release its claim'''
+
+        done_info = {'worker_id' : worker_id, 'host' : socket.gethostname(), 'finished_at' : time.time()}
+        if type(info) != type(None):
+            done_info.update(info)
+        done_path = self.get_done_path(name)
+        temporary_path = '{}.tmp-{}'.format(done_path, worker_id)
+        with open(temporary_path, 'w') as f:
+            json.dump(done_info, f, indent = 5)
+        os.replace(temporary_path, done_path)
+        self.release(name, worker_id)
+
+        return
+
+    def get_status(self, names, worker_id):
+        '''Count how many items are done, claimed by live workers, stale, or available'''
+
+        status = {'done' : 0, 'claimed' : 0, 'stale' : 0, 'available' : 0}
+        filesystem_time = self.get_filesystem_time(worker_id)
+        for temp_name in names:
+            if self.is_done(temp_name):
+                status['done'] += 1
+                continue
+            try:
+                temp_age = filesystem_time - os.stat(self.get_claim_path(temp_name)).st_mtime
+            except FileNotFoundError:
+                status['available'] += 1
+                continue
+            if temp_age < self.lease_seconds:
+                status['claimed'] += 1
+            else:
+                status['stale'] += 1
+
+        return status
+
+
+class LeaseHeartbeat:
+    '''Context manager that renews the claim on an item in a background thread
+
+    If the claim is found to be held by another worker (i.e. the lease
+    expired because the filesystem was unavailable for longer than the
+    lease), a warning is printed and lost is set to True.
+
+    '''
+
+    def __init__(self, queue, name, worker_id):
+
+        self.queue = queue
+        self.name = name
+        self.worker_id = worker_id
+        self.interval_seconds = max(queue.lease_seconds/renewals_per_lease, 0.1)
+        self.lost = False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target = self._run, name = 'lease_heartbeat', daemon = True)
+
+    def _run(self):
+
+        while self.stop_event.wait(self.interval_seconds) == False:
+            try:
+                renewed = self.queue.renew(self.name, self.worker_id)
+            except OSError as error:
+                print('   Warning: could not renew the claim on {} ({})'.format(self.name, error))
+                continue
+            if renewed == False:
+                self.lost = True
+                print('   Warning: the claim on {} is no longer held by this worker (its lease expired). Another worker may be processing it.'.format(self.name))
+                return
+
+    def __enter__(self):
+
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.stop_event.set()
+        self.thread.join()
+        return False
+
+
+def run_queued_session_job(session_job):
+    '''Claim a session job in the work queue, run it while renewing the claim, and mark it as done
+
+    The session job needs a 'work_queue' dictionary with the queue 'directory',
+    'lease_seconds', the item 'name', and optionally the 'session_path' and
+    'remove_existing_outputs' ('outputs' to keep checkpoints, 'all', or None).
+    If remove_existing_outputs is set (the session had incomplete outputs, or
+    --overwrite_existing/--retry_failed was used), the outputs found in the
+    session folder once the session is claimed are removed before processing.
+    Jobs that can't be claimed (done, or claimed by another live worker) are
+    skipped. If the job fails, its claim is released.
+
+    Returns
+    -------
+    result : dict
+        the result of scheduler.run_session_job, or a result
+        with status 'skipped' if the job could not be claimed
+
+    '''
+
+    queue_settings = session_job['work_queue']
+    queue = WorkQueue(queue_settings['directory'], lease_seconds = queue_settings['lease_seconds'])
+    worker_id = get_worker_id()
+    name = queue_settings['name']
+    if queue.claim(name, worker_id) == False:
+        print('Skipping (completed or claimed by another worker): {}, {}'.format(session_job['participant'], session_job['session']))
+        return {'participant' : session_job['participant'],
+                'session' : session_job['session'],
+                'function' : session_job.get('function', 'calc_qmri_stats'),
+                'status' : 'skipped',
+                'wall_time_seconds' : None,
+                'error' : None}
+
+    start_time = time.time()
+    try:
+        with LeaseHeartbeat(queue, name, worker_id):
+            session_path = queue_settings.get('session_path')
+            remove_existing_outputs = queue_settings.get('remove_existing_outputs')
+            if type(remove_existing_outputs) != type(None) and checkpoints.session_has_outputs(session_path):
+                if remove_existing_outputs == 'all':
+                    shutil.rmtree(session_path)
+                    print('Removing existing session folder at: ' + session_path)
+                else:
+                    checkpoints.remove_session_outputs(session_path)
+                    print('Removing existing session outputs (keeping checkpoints) at: ' + session_path)
+            result = scheduler.run_session_job(session_job)
+    except BaseException:
+        queue.release(name, worker_id)
+        raise
+    if result['status'] != 'succeeded':
+        queue.release(name, worker_id)
+        return result
+    queue.mark_done(name, worker_id, {'participant' : session_job['participant'],
+                                      'session' : session_job['session'],
+                                      'function' : session_job.get('function', 'calc_qmri_stats'),
+                                      'started_at' : start_time})
+
+    return result